@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Measures the memory retained per connection by the logic/network objects
+(PeerLogic + PeerConnection + NeighborState) created by Connector.
+
+    python -m bench.connection_memory --connections 2000 --pieces 100000
+"""
+import argparse
+import asyncio
+import json
+import tempfile
+import tracemalloc
+
+from logic.peer_node import PeerNode, NeighborState
+from net.connector import Connector
+from net.peer_connection import PeerConnection
+
+
+class _NullWriter:
+    def write(self, data: bytes) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+def build_node(total_pieces: int, data_dir: str) -> PeerNode:
+    return PeerNode(
+        total_pieces=total_pieces,
+        piece_size=1,
+        last_piece_size=1,
+        data_dir=data_dir,
+        start_with_full_file=False,
+        k_preferred=4,
+        preferred_interval_sec=5,
+        optimistic_interval_sec=15,
+        self_id=0,
+        all_peer_ids={0},
+        file_name='bench.dat',
+    )
+
+
+def measure(connections: int, total_pieces: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        node = build_node(total_pieces, tmp)
+        connector = Connector('127.0.0.1', 0, local_peer_id=0, logic_factory=node.make_callbacks)
+        reader = asyncio.StreamReader()
+        writer = _NullWriter()
+
+        kept = []
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        for i in range(connections):
+            logic = connector._make_logic(outbound=bool(i % 2))
+            conn = PeerConnection(reader, writer, callbacks=logic, local_peer_id=0)
+            logic.set_wire(conn)
+            logic.peer_id = i + 1
+            kept.append(NeighborState(i + 1, logic))
+        after, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        'connections': connections,
+        'total_pieces': total_pieces,
+        'bytes_total': after - before,
+        'bytes_per_connection': (after - before) / max(1, connections),
+        'peak_bytes': peak,
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--connections', type=int, default=1000)
+    ap.add_argument('--pieces', type=int, default=10_000)
+    args = ap.parse_args()
+    print(json.dumps(measure(args.connections, args.pieces), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Throughput and latency of two Connectors talking over loopback, for each
+combination of event loop and socket options.
+
+    python -m bench.loop_socket --piece-size 4194304 --pieces 64 --rounds 2000
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import socket
+import statistics
+import time
+from typing import Optional
+
+from logic.callbacks import LogicCallbacks, WireCommands
+from net.connector import Connector
+from net.socket_options import SocketOptions
+from util.event_loop import install_event_loop
+
+# REQUESTs at or above this index are answered with a tiny piece (latency probes)
+PING_BASE = 1 << 30
+
+
+class BenchLogic(LogicCallbacks):
+    def __init__(self, bulk_payload: bytes):
+        self.wire: Optional[WireCommands] = None
+        self.bulk = bulk_payload
+        self.ready = asyncio.get_running_loop().create_future()
+        self.waiter: Optional[asyncio.Future] = None
+        self.remaining = 0
+
+    def set_wire(self, wire: WireCommands) -> None:
+        self.wire = wire
+
+    def on_handshake(self, peer_id: int) -> None:
+        if not self.ready.done():
+            self.ready.set_result(self)
+
+    def on_request(self, index: int) -> None:
+        self.wire.send_piece(index, b'p' * 16 if index >= PING_BASE else self.bulk)
+
+    def on_piece(self, index: int, data: bytes) -> None:
+        self.remaining -= 1
+        if self.remaining <= 0 and self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def expect(self, n: int) -> asyncio.Future:
+        self.remaining = n
+        self.waiter = asyncio.get_running_loop().create_future()
+        return self.waiter
+
+    # the benchmark only moves REQUEST/PIECE traffic; the other callbacks are ignored
+    def on_disconnect(self) -> None:
+        pass
+
+    def on_choke(self) -> None:
+        pass
+
+    def on_unchoke(self) -> None:
+        pass
+
+    def on_interested(self) -> None:
+        pass
+
+    def on_not_interested(self) -> None:
+        pass
+
+    def on_have(self, index: int) -> None:
+        pass
+
+    def on_bitfield(self, bits: bytes) -> None:
+        pass
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def run_case(opts: SocketOptions, piece_size: int, pieces: int, rounds: int) -> dict:
+    bulk = b'x' * piece_size
+    port = free_port()
+    server_logics: list[BenchLogic] = []
+    client_logics: list[BenchLogic] = []
+
+    def server_factory() -> BenchLogic:
+        server_logics.append(BenchLogic(bulk))
+        return server_logics[-1]
+
+    def client_factory() -> BenchLogic:
+        client_logics.append(BenchLogic(bulk))
+        return client_logics[-1]
+
+    server = Connector('127.0.0.1', port, local_peer_id=1, logic_factory=server_factory, socket_options=opts)
+    client = Connector('127.0.0.1', port, local_peer_id=2, logic_factory=client_factory, socket_options=opts)
+    serve_task = asyncio.create_task(server.serve())
+    await asyncio.sleep(0.05)
+    try:
+        await client.connect_with_retry('127.0.0.1', port, attempts=20, initial_backoff=0.05)
+        logic = await client_logics[0].ready
+
+        done = logic.expect(pieces)
+        t0 = time.perf_counter()
+        for i in range(pieces):
+            logic.wire.send_request(i)
+        await done
+        elapsed = time.perf_counter() - t0
+
+        rtts = []
+        for i in range(rounds):
+            done = logic.expect(1)
+            t = time.perf_counter()
+            logic.wire.send_request(PING_BASE + i)
+            await done
+            rtts.append(time.perf_counter() - t)
+    finally:
+        await client.close_all()
+        await server.close_all()
+        serve_task.cancel()
+
+    rtts.sort()
+    return {
+        'throughput_mib_s': piece_size * pieces / elapsed / (1 << 20),
+        'rtt_p50_us': statistics.median(rtts) * 1e6,
+        'rtt_p99_us': rtts[int(len(rtts) * 0.99) - 1] * 1e6,
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--piece-size', type=int, default=1 << 20)
+    ap.add_argument('--pieces', type=int, default=64)
+    ap.add_argument('--rounds', type=int, default=1000)
+    ap.add_argument('--bufsizes', type=int, nargs='*', default=[0, 1 << 22],
+                    help='SO_SNDBUF/SO_RCVBUF values to try; 0 keeps the kernel default')
+    args = ap.parse_args()
+    logging.disable(logging.INFO)
+
+    results = []
+    for loop_kind, nodelay, buf in itertools.product(('asyncio', 'uvloop'), (True, False), args.bufsizes):
+        try:
+            used = install_event_loop(loop_kind)
+        except ImportError:
+            continue
+        opts = SocketOptions(nodelay=nodelay, sndbuf=buf or None, rcvbuf=buf or None)
+        res = asyncio.run(run_case(opts, args.piece_size, args.pieces, args.rounds))
+        results.append({'loop': used, 'nodelay': nodelay, 'bufsize': buf or 'default', **res})
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
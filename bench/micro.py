@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the codec, Bitfield and RequestManager hot paths. No network.
+
+    python -m bench.micro                          # run and print timings
+    python -m bench.micro --check                  # fail if anything is >25% slower than where this branch forked
+    python -m bench.micro --check --ref HEAD       # ... than another revision
+    python -m bench.micro --save                   # record a baseline file for this host
+    python -m bench.micro --check --baseline bench/micro_baseline.json
+
+--check runs the reference revision's benchmarks in the same invocation,
+alternating with the working tree's, so the comparison does not depend on
+which machine recorded a baseline. Without --ref the reference is the
+merge-base with the main branch, so regressions already committed on a
+branch are caught too; on the main branch itself, where that is HEAD,
+--check compares against the stored baseline instead. The report names
+the revision or file it compared against.
+"""
+import argparse
+import io
+import json
+import platform
+import random
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+from logic.bitfield import Bitfield
+from logic.request_manager import RequestManager
+from net.codec import encode_frame, decode_one, enc_have, enc_piece, dec_piece, enc_compact_bitfield
+from net.constants import MessageType, MAX_FRAME
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_BASELINE = Path(__file__).resolve().parent / 'micro_baseline.json'
+MAIN_BRANCHES = ('origin/main', 'main', 'origin/master', 'master')
+
+
+def best_of(fn: Callable[[], object], repeat: int, setup: Callable[[], object] | None = None) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        t0 = time.perf_counter()
+        fn() if setup is None else fn(arg)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def half_bitfield(n: int, seed: int) -> Bitfield:
+    rng = random.Random(seed)
+    return Bitfield.from_bytes(n, bytes(rng.getrandbits(8) for _ in range((n + 7) // 8)))
+
+
+def build_cases(pieces: int, frame_bytes: int, haves: int) -> dict[str, tuple[Callable, Callable | None]]:
+    # PIECE payload capped so the encoded frame stays within MAX_FRAME
+    data = b'\xab' * min(frame_bytes, MAX_FRAME - 5)
+    piece_payload = enc_piece(7, data)
+    have_stream = b''.join(encode_frame(MessageType.HAVE, enc_have(i)) for i in range(haves))
+    piece_frame = encode_frame(MessageType.PIECE, piece_payload)
+
+    local = half_bitfield(pieces, 1)
+    remote = half_bitfield(pieces, 2)
+    sparse = Bitfield.empty(pieces)
+    for i in range(0, pieces, 997):
+        sparse.set(i, True)
+
+    def decode_haves(buf: bytearray) -> None:
+        while decode_one(buf) is not None:
+            pass
+
+    def choose(rm: RequestManager) -> None:
+        rm.choose_for_neighbor(1, remote, local)
+
+    return {
+        'encode_frame_piece': (lambda: encode_frame(MessageType.PIECE, piece_payload), None),
+        'decode_one_piece': (lambda buf: decode_one(buf), lambda: bytearray(piece_frame)),
+        'decode_one_haves': (decode_haves, lambda: bytearray(have_stream)),
+        'enc_piece': (lambda: enc_piece(7, data), None),
+        'dec_piece': (lambda: dec_piece(piece_payload), None),
+        'bitfield_count': (lambda: local.count(), None),
+        'bitfield_missing_from': (lambda: local.missing_from(remote), None),
+        'choose_for_neighbor': (choose, lambda: RequestManager(pieces)),
+        'enc_compact_bitfield_sparse': (lambda: enc_compact_bitfield(sparse.to_bytes()), None),
+    }
+
+
+def run(args: argparse.Namespace) -> dict[str, float]:
+    cases = build_cases(args.pieces, args.frame_bytes, args.haves)
+    results = {}
+    for name, (fn, setup) in cases.items():
+        if args.only and name not in args.only:
+            continue
+        results[name] = best_of(fn, args.repeat, setup)
+        print(f'{name:24s} {results[name] * 1e3:10.3f} ms', file=sys.stderr)
+    return results
+
+
+def host_info() -> dict[str, str]:
+    return {'machine': platform.machine(), 'processor': platform.processor(), 'node': platform.node(),
+            'python': platform.python_version()}
+
+
+def run_tree(root: Path, args: argparse.Namespace) -> dict[str, float]:
+    """Runs bench.micro from the source tree at `root` in a fresh interpreter; returns its results."""
+    cmd = [sys.executable, '-m', 'bench.micro', '--pieces', str(args.pieces), '--frame-bytes', str(args.frame_bytes),
+           '--haves', str(args.haves), '--repeat', str(args.repeat)]
+    if args.only:
+        cmd += ['--only', *args.only]
+    out = subprocess.run(cmd, cwd=root, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    return json.loads(out)['results_s']
+
+
+def git(*cmd: str) -> str | None:
+    out = subprocess.run(['git', *cmd], cwd=REPO_ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return out.stdout.strip() if out.returncode == 0 else None
+
+
+def default_ref() -> tuple[str, str] | None:
+    """
+    The main branch and the commit HEAD forked from it; None when HEAD is on
+    the main branch, since that would compare HEAD with itself.
+    """
+    head = git('rev-parse', 'HEAD')
+    for branch in MAIN_BRANCHES:
+        base = git('merge-base', 'HEAD', branch)
+        if base is not None and base != head:
+            return branch, base
+    return None
+
+
+def export_revision(rev: str, dest: Path) -> None:
+    tar = subprocess.run(['git', 'archive', '--format=tar', rev], cwd=REPO_ROOT, check=True,
+                         stdout=subprocess.PIPE).stdout
+    with tarfile.open(fileobj=io.BytesIO(tar)) as tf:
+        tf.extractall(dest, filter='data')
+
+
+def run_against_ref(args: argparse.Namespace) -> tuple[dict[str, float], dict[str, float]]:
+    """Best times of the working tree and of `args.ref`, measured in alternating rounds."""
+    current: dict[str, float] = {}
+    reference: dict[str, float] = {}
+    with tempfile.TemporaryDirectory(prefix='micro_ref_') as tmp:
+        export_revision(args.ref, Path(tmp))
+        for _ in range(args.rounds):
+            for root, best in ((Path(tmp), reference), (REPO_ROOT, current)):
+                for name, t in run_tree(root, args).items():
+                    best[name] = min(t, best.get(name, float('inf')))
+    for name, t in current.items():
+        print(f'{name:24s} {t * 1e3:10.3f} ms  ref {reference.get(name, float("nan")) * 1e3:10.3f} ms',
+              file=sys.stderr)
+    return current, reference
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--pieces', type=int, default=1_000_000)
+    ap.add_argument('--frame-bytes', type=int, default=MAX_FRAME)
+    ap.add_argument('--haves', type=int, default=5_000, help='HAVE frames packed into one receive buffer')
+    ap.add_argument('--repeat', type=int, default=5)
+    ap.add_argument('--only', nargs='*', default=None, help='run only these benchmarks')
+    ap.add_argument('--baseline', type=Path, default=None,
+                    help=f'with --check, compare against this recorded file instead of --ref; '
+                         f'--save writes it (default {DEFAULT_BASELINE.name})')
+    ap.add_argument('--save', action='store_true', help='write results as the baseline for this host')
+    ap.add_argument('--check', action='store_true', help='compare against a reference and fail on regressions')
+    ap.add_argument('--ref', default=None,
+                    help='git revision --check measures against in the same run (default: merge-base with main)')
+    ap.add_argument('--rounds', type=int, default=3,
+                    help='alternating reference/working-tree runs for --check; the best time of each counts')
+    ap.add_argument('--threshold', type=float, default=1.25,
+                    help='allowed slowdown factor relative to the reference before --check fails')
+    args = ap.parse_args()
+
+    params = {'pieces': args.pieces, 'frame_bytes': args.frame_bytes, 'haves': args.haves}
+    sha = None
+    if args.check and args.baseline is None and args.ref is None:
+        forked = default_ref()
+        if forked is not None:
+            args.ref = f'merge-base of HEAD and {forked[0]}'
+            sha = forked[1]
+        elif DEFAULT_BASELINE.exists():
+            args.baseline = DEFAULT_BASELINE
+        else:
+            raise SystemExit('HEAD is on the main branch and there is no stored baseline; pass --ref or --baseline')
+    if args.check and args.baseline is None:
+        sha = sha or git('rev-parse', '--verify', f'{args.ref}^{{commit}}')
+        if sha is None:
+            raise SystemExit(f'unknown revision {args.ref!r}')
+        print(f'comparing against {args.ref} ({sha[:12]})', file=sys.stderr)
+        report = {'params': params, 'ref': args.ref, 'ref_sha': sha}
+        args.ref = sha
+        results, reference = run_against_ref(args)
+        report['results_s'] = results
+    else:
+        results = run(args)
+        report = {'params': params, 'results_s': results}
+        reference = None
+
+    if args.check:
+        if reference is None:
+            print(f'comparing against {args.baseline}', file=sys.stderr)
+            report['baseline'] = str(args.baseline)
+            baseline = json.loads(args.baseline.read_text(encoding='utf-8'))
+            if baseline['params'] != params:
+                raise SystemExit(f'baseline was recorded with {baseline["params"]}, not {params}')
+            if baseline.get('host') != host_info():
+                print(f'warning: baseline was recorded on {baseline.get("host")}, timings are not comparable',
+                      file=sys.stderr)
+            reference = baseline['results_s']
+        regressions = {}
+        for name, t in results.items():
+            base = reference.get(name)
+            if base is None:
+                continue
+            ratio = t / base
+            report.setdefault('ratio_to_reference', {})[name] = ratio
+            if ratio > args.threshold:
+                regressions[name] = ratio
+        report['regressions'] = regressions
+
+    print(json.dumps(report, indent=2))
+
+    if args.save:
+        path = args.baseline or DEFAULT_BASELINE
+        path.write_text(json.dumps({'params': params, 'host': host_info(), 'results_s': results}, indent=2) + '\n',
+                        encoding='utf-8')
+    if args.check and report['regressions']:
+        names = ', '.join(f'{k} ({v:.2f}x)' for k, v in report['regressions'].items())
+        raise SystemExit(f'performance regression past {args.threshold:.2f}x: {names}')
+
+
+if __name__ == '__main__':
+    main()
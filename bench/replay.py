@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Replays a trace recorded with `peerProcess.py <id> --trace` against a fresh
+PeerNode, without sockets or disk. Inbound events are fed to PeerLogic in
+order; choking rounds fire at the recorded times of the trace clock. Reports
+how the replayed node's decisions compare with the recorded ones and how fast
+the decision code ran.
+
+    python -m bench.replay trace_peer_1002.ndjson --seed 1 --repeat 5
+"""
+import argparse
+import json
+import logging
+import random
+import time
+from collections import Counter as Tally
+from typing import Optional
+
+from logic.callbacks import WireCommands
+from logic.peer_logic import PeerLogic
+from logic.peer_node import PeerNode
+from logic.piece_store import MemoryPieceStore
+from net.trace import read_trace
+
+
+class RecordingWire(WireCommands):
+    def __init__(self, peer_id: int, sent: Tally):
+        self.peer_id = peer_id
+        self.sent = sent
+
+    def send_handshake(self, peer_id: int) -> None:
+        self.sent['handshake'] += 1
+
+    def send_choke(self) -> None:
+        self.sent['choke'] += 1
+
+    def send_unchoke(self) -> None:
+        self.sent['unchoke'] += 1
+
+    def send_interested(self) -> None:
+        self.sent['interested'] += 1
+
+    def send_not_interested(self) -> None:
+        self.sent['not_interested'] += 1
+
+    def send_have(self, index: int) -> None:
+        self.sent['have'] += 1
+
+    def send_bitfield(self, bits: bytes) -> None:
+        self.sent['bitfield'] += 1
+
+    def send_have_all(self) -> None:
+        self.sent['have_all'] += 1
+
+    def send_have_none(self) -> None:
+        self.sent['have_none'] += 1
+
+    def send_request(self, index: int) -> None:
+        self.sent['request'] += 1
+
+    def send_piece(self, index: int, data: bytes) -> None:
+        self.sent['piece'] += 1
+
+    def send_piece_ref(self, index: int, path: str) -> None:
+        self.sent['piece'] += 1
+
+    def send_peer_exchange(self, entries: list[tuple[bool, int, str, int]]) -> None:
+        self.sent['peer_exchange'] += 1
+
+    def close(self) -> None:
+        pass
+
+
+def build_node(meta: dict) -> PeerNode:
+    store = MemoryPieceStore(meta['total_pieces'], meta['piece_size'], meta['last_piece_size'],
+                             start_full=meta['start_full'])
+    return PeerNode(
+        total_pieces=meta['total_pieces'],
+        piece_size=meta['piece_size'],
+        last_piece_size=meta['last_piece_size'],
+        data_dir='',
+        start_with_full_file=meta['start_full'],
+        k_preferred=meta['k'],
+        preferred_interval_sec=meta['preferred_interval'],
+        optimistic_interval_sec=meta['optimistic_interval'],
+        self_id=meta['self_id'],
+        all_peer_ids=set(meta['all_peers']),
+        file_name=meta['file_name'],
+        store=store,
+    )
+
+
+def replay(events: list[dict], meta: dict) -> dict:
+    node = build_node(meta)
+    sent: Tally = Tally()
+    recorded: Tally = Tally()
+    logics: dict[int, PeerLogic] = {}
+    next_pref = float(meta['preferred_interval'])
+    next_opt = float(meta['optimistic_interval'])
+    rounds = 0
+
+    def feed(logic: PeerLogic, ev: dict) -> None:
+        match ev['ev']:
+            case 'choke':
+                logic.on_choke()
+            case 'unchoke':
+                logic.on_unchoke()
+            case 'interested':
+                logic.on_interested()
+            case 'not_interested':
+                logic.on_not_interested()
+            case 'have':
+                logic.on_have(ev['index'])
+            case 'bitfield':
+                logic.on_bitfield(bytes.fromhex(ev['bits']))
+            case 'have_all':
+                logic.on_have_all()
+            case 'have_none':
+                logic.on_have_none()
+            case 'request':
+                logic.on_request(ev['index'])
+            case 'piece':
+                # the recorded peer answered the recorded request; the replayed node may have asked for another
+                # piece, so release that slot or the neighbor would look busy for the rest of the replay
+                node.requests.clear_inflight_for_peer(logic.peer_id)
+                logic.on_piece(ev['index'], bytes(ev['size']))
+            case 'piece_ref':
+                node.requests.clear_inflight_for_peer(logic.peer_id)
+                logic.on_piece(ev['index'], bytes(node.store.expected_size(ev['index'])))
+            case 'peer_exchange':
+                logic.on_peer_exchange([tuple(e) for e in ev['entries']])
+            case 'disconnect':
+                logic.on_disconnect()
+
+    t0 = time.perf_counter()
+    for ev in events:
+        t = ev['t']
+        while min(next_pref, next_opt) <= t:
+            if next_pref <= next_opt:
+                node.run_preferred_round()
+                next_pref += meta['preferred_interval']
+            else:
+                node.run_optimistic_round()
+                next_opt += meta['optimistic_interval']
+            rounds += 1
+
+        if ev['dir'] == 'out':
+            recorded[ev['ev']] += 1
+            continue
+        peer = ev['peer']
+        if ev['ev'] == 'handshake':
+            logic = node.make_callbacks()
+            logic.set_wire(RecordingWire(peer, sent))
+            logics[peer] = logic
+            logic.on_handshake(peer)
+            continue
+        logic: Optional[PeerLogic] = logics.get(peer)
+        if logic is not None:
+            feed(logic, ev)
+    elapsed = time.perf_counter() - t0
+
+    return {
+        'events': len(events),
+        'choking_rounds': rounds,
+        'replay_s': elapsed,
+        'events_per_s': len(events) / elapsed if elapsed > 0 else None,
+        'pieces_at_end': node.local_bits.count(),
+        'sent_by_replay': dict(sent),
+        'sent_in_trace': dict(recorded),
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('trace')
+    ap.add_argument('--seed', type=int, default=None, help='seed random piece/peer selection')
+    ap.add_argument('--repeat', type=int, default=1, help='replay this many times and report the fastest')
+    ap.add_argument('--verbose', action='store_true', help='keep the node INFO log output')
+    args = ap.parse_args()
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    it = read_trace(args.trace)
+    meta = next(it)
+    if meta.get('ev') != 'meta':
+        raise SystemExit(f'{args.trace}: first line is not a meta record')
+    events = list(it)
+
+    best = None
+    for _ in range(max(1, args.repeat)):
+        if args.seed is not None:
+            random.seed(args.seed)
+        res = replay(events, meta)
+        if best is None or res['replay_s'] < best['replay_s']:
+            best = res
+    print(json.dumps(best, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Runs unmodified PeerNode/PeerLogic instances over net/sim.py: in-memory
+connections with latency, per-host upload bandwidth and loss, on a virtual
+clock. Choking rounds fire on the virtual clock, so a swarm that would take
+minutes of wall time finishes in seconds.
+
+    python -m bench.simulate --peers 1000 --degree 20 --pieces 64 --runs 3
+"""
+import argparse
+import json
+import logging
+import random
+import statistics
+import time
+
+from logic.choking_manager import Proximity
+from logic.peer_node import PeerNode
+from logic.piece_store import MemoryPieceStore
+from net.sim import VirtualClock, SimHost, connect_pair
+
+
+def percentile(sorted_vals: list[float], q: float) -> float:
+    if not sorted_vals:
+        return float('nan')
+    return sorted_vals[min(len(sorted_vals) - 1, int(q * len(sorted_vals)))]
+
+
+def site_of(peer_id: int, args: argparse.Namespace) -> str:
+    return f'site{peer_id % args.sites}'
+
+
+def build_node(peer_id: int, all_ids: set[int], seed: bool, args: argparse.Namespace) -> PeerNode:
+    last = args.piece_size
+    proximity = None
+    if args.prefer_nearby:
+        proximity = Proximity(site_of(peer_id, args), {pid: site_of(pid, args) for pid in all_ids})
+    store = MemoryPieceStore(args.pieces, args.piece_size, last, start_full=seed)
+    return PeerNode(
+        total_pieces=args.pieces,
+        piece_size=args.piece_size,
+        last_piece_size=last,
+        data_dir='',
+        start_with_full_file=seed,
+        k_preferred=args.k,
+        preferred_interval_sec=args.preferred_interval,
+        optimistic_interval_sec=args.optimistic_interval,
+        self_id=peer_id,
+        all_peer_ids=all_ids,
+        file_name='sim.dat',
+        store=store,
+        super_seed=seed and args.super_seed,
+        proximity=proximity,
+        exploration=args.explore,
+        allowed_fast=args.allowed_fast,
+        stream_window=args.stream_window,
+        batch_interval=args.batch_interval,
+        upload_buffer=args.upload_buffer,
+    )
+
+
+def run_once(args: argparse.Namespace, seed: int) -> dict:
+    # PeerNode's piece and neighbor choices use the module-level random; seed it for reproducible runs
+    random.seed(seed)
+    rng = random.Random(seed)
+    clock = VirtualClock()
+
+    ids = list(range(1, args.peers + 1))
+    all_ids = set(ids)
+    nodes = {pid: build_node(pid, all_ids, i < args.seeds, args) for i, pid in enumerate(ids)}
+    for node in nodes.values():
+        # request latencies feed the batch scheduler and proximity ranking; measure them in virtual time
+        node.requests.clock = lambda: clock.now
+        if node.super_seed is not None:
+            node.super_seed.clock = lambda: clock.now
+        if node.uploads is not None:
+            node.uploads.call_later = clock.call_later
+    hosts = {pid: SimHost(clock, args.bandwidth) for pid in ids}
+
+    # every peer dials up to `degree` earlier peers, like peerProcess dials the earlier PeerInfo rows
+    wires = []
+    for i, pid in enumerate(ids):
+        earlier = ids[:i]
+        targets = earlier if args.degree <= 0 or len(earlier) <= args.degree else rng.sample(earlier, args.degree)
+        for other in targets:
+            latency = max(0.0, rng.gauss(args.latency, args.jitter))
+            cross = site_of(pid, args) != site_of(other, args)
+            if cross:
+                latency += args.site_latency
+            clock.call_at(i * args.stagger, lambda *a, cross=cross: wires.append((cross, connect_pair(*a))), clock,
+                          hosts[pid], nodes[pid].make_callbacks(), pid,
+                          hosts[other], nodes[other].make_callbacks(), other,
+                          latency, args.loss, rng)
+
+    for i, node in enumerate(nodes.values()):
+        start = i * args.stagger
+        clock.call_every(args.preferred_interval, node.run_preferred_round, start + args.preferred_interval)
+        clock.call_every(args.optimistic_interval, node.run_optimistic_round, start + args.optimistic_interval)
+        if args.batch_interval > 0:
+            clock.call_every(args.batch_interval, node.run_batch_round, start + args.batch_interval)
+
+    pending = {pid for pid in ids[args.seeds:]}
+    done_at: dict[int, float] = {}
+    first_at: dict[int, float] = {}
+    # when the first tenth of the file is readable in order, i.e. when a streaming consumer could start
+    prefix = max(1, args.pieces // 10)
+    prefix_at: dict[int, float] = {}
+
+    def check_completion() -> None:
+        for pid in list(pending):
+            if pid not in first_at and nodes[pid].local_bits.count() > 0:
+                first_at[pid] = clock.now
+            if pid not in prefix_at and all(nodes[pid].local_bits.get(i) for i in range(prefix)):
+                prefix_at[pid] = clock.now
+            if nodes[pid].local_bits.count() == args.pieces:
+                done_at[pid] = clock.now
+                pending.discard(pid)
+
+    clock.call_every(args.sample_interval, check_completion, 0.0)
+
+    t0 = time.perf_counter()
+    clock.run(until=args.max_time, stop=lambda: not pending)
+    wall = time.perf_counter() - t0
+
+    times = sorted(done_at.values())
+    firsts = sorted(first_at.values())
+    prefixes = sorted(prefix_at.values())
+    seed_upload = sum(hosts[pid].bytes_sent for pid in ids[:args.seeds])
+    total_bytes = sum(w.bytes_sent for _, pair in wires for w in pair)
+    cross_bytes = sum(w.bytes_sent for cross, pair in wires if cross for w in pair)
+    return {
+        'seed': seed,
+        'completed': len(times),
+        'incomplete': len(pending),
+        'virtual_s': clock.now,
+        'wall_s': wall,
+        'events': clock.events_run,
+        'completion_s': {
+            'min': times[0] if times else None,
+            'p50': percentile(times, 0.5) if times else None,
+            'p90': percentile(times, 0.9) if times else None,
+            'p99': percentile(times, 0.99) if times else None,
+            'max': times[-1] if times else None,
+            'mean': statistics.fmean(times) if times else None,
+        },
+        'first_piece_s': {
+            'p50': percentile(firsts, 0.5) if firsts else None,
+            'max': firsts[-1] if firsts else None,
+        },
+        'prefix_s': {
+            'p50': percentile(prefixes, 0.5) if prefixes else None,
+            'max': prefixes[-1] if prefixes else None,
+        },
+        'seed_upload_bytes': seed_upload,
+        'seed_upload_file_copies': seed_upload / (args.pieces * args.piece_size),
+        'cross_site_byte_fraction': cross_bytes / total_bytes if total_bytes else 0.0,
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--peers', type=int, default=100)
+    ap.add_argument('--seeds', type=int, default=1)
+    ap.add_argument('--pieces', type=int, default=64)
+    ap.add_argument('--piece-size', type=int, default=256 * 1024)
+    ap.add_argument('--k', type=int, default=4)
+    ap.add_argument('--preferred-interval', type=float, default=5.0)
+    ap.add_argument('--optimistic-interval', type=float, default=15.0)
+    ap.add_argument('--degree', type=int, default=20, help='connections dialed per peer; 0 = full mesh')
+    ap.add_argument('--latency', type=float, default=0.02, help='one-way latency in seconds')
+    ap.add_argument('--jitter', type=float, default=0.005, help='std-dev of per-link latency')
+    ap.add_argument('--bandwidth', type=float, default=10e6, help='upload bytes/s per peer')
+    ap.add_argument('--loss', type=float, default=0.0, help='per-frame loss probability (costs one RTO)')
+    ap.add_argument('--stagger', type=float, default=0.0, help='virtual seconds between peer start-ups')
+    ap.add_argument('--sample-interval', type=float, default=0.1, help='completion check period')
+    ap.add_argument('--max-time', type=float, default=3600.0, help='virtual seconds before giving up')
+    ap.add_argument('--sites', type=int, default=1, help='spread peers round-robin over this many sites')
+    ap.add_argument('--site-latency', type=float, default=0.0, help='extra one-way latency between sites')
+    ap.add_argument('--prefer-nearby', action='store_true', help='favor same-site, low-RTT peers when unchoking')
+    ap.add_argument('--explore', type=float, default=0.25, help='fraction of unchoke choices left random')
+    ap.add_argument('--allowed-fast', type=int, default=0, help='pieces a choked peer may still request')
+    ap.add_argument('--stream-window', type=int, default=0, help='pieces fetched in file order ahead of others')
+    ap.add_argument('--batch-interval', type=float, default=0.0,
+                    help='plan requests across neighbors this often (logic/batch_scheduler.py); 0 = greedy random')
+    ap.add_argument('--upload-buffer', type=int, default=0,
+                    help='serve requests by fair queuing with this many bytes in flight (logic/upload_scheduler.py)')
+    ap.add_argument('--super-seed', action='store_true', help='seeds advertise pieces one at a time (super-seeding)')
+    ap.add_argument('--runs', type=int, default=1)
+    ap.add_argument('--seed', type=int, default=1)
+    args = ap.parse_args()
+    logging.disable(logging.INFO)
+
+    runs = [run_once(args, args.seed + i) for i in range(args.runs)]
+    params = {k: v for k, v in vars(args).items()}
+    print(json.dumps({'params': params, 'runs': runs}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
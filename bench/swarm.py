@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Local swarm benchmark: writes Common.cfg/PeerInfo.cfg for N peers on localhost,
+runs them either as peerProcess.py subprocesses or as PeerNodes sharing one
+event loop, and reports completion time, throughput, CPU and peak RSS as JSON.
+
+    python -m bench.swarm --peers 8 --file-size 20000000 --piece-size 65536
+    python -m bench.swarm --mode inprocess --peers 4 --output swarm.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+FILE_NAME = 'payload.dat'
+
+
+def pick_ports(n: int) -> list[int]:
+    socks = []
+    try:
+        for _ in range(n):
+            s = socket.socket()
+            s.bind(('127.0.0.1', 0))
+            socks.append(s)
+        return [s.getsockname()[1] for s in socks]
+    finally:
+        for s in socks:
+            s.close()
+
+
+def write_swarm(work: Path, args: argparse.Namespace) -> list[dict]:
+    (work / 'Common.cfg').write_text(
+        f'NumberOfPreferredNeighbors {args.k}\n'
+        f'UnchokingInterval {args.unchoking_interval}\n'
+        f'OptimisticUnchokingInterval {args.optimistic_interval}\n'
+        f'FileName {FILE_NAME}\n'
+        f'FileSize {args.file_size}\n'
+        f'PieceSize {args.piece_size}\n',
+        encoding='utf-8')
+
+    if args.content == 'text':
+        line = b'2024-01-01T00:00:00Z,host-%04d,GET,/api/v1/items,200,%d\n'
+        rows = b''.join(line % (i % 1000, i * 7 % 10007) for i in range(args.file_size // 40 + 1))
+        payload = rows[:args.file_size]
+    else:
+        payload = os.urandom(args.file_size)
+    peers = []
+    for i, port in enumerate(pick_ports(args.peers)):
+        peer_id = 1001 + i
+        has_file = 1 if i < args.seeds else 0
+        if has_file:
+            (work / f'peer_{peer_id}').mkdir()
+            (work / f'peer_{peer_id}' / FILE_NAME).write_bytes(payload)
+        peers.append({'peer_id': peer_id, 'port': port, 'has_file': has_file})
+    (work / 'PeerInfo.cfg').write_text(
+        ''.join(f"{p['peer_id']} 127.0.0.1 {p['port']} {p['has_file']}\n" for p in peers), encoding='utf-8')
+    return peers
+
+
+def poll_completion(work: Path, peers: list[dict], file_size: int, t0: float, done: dict[int, float]) -> None:
+    for p in peers:
+        if p['peer_id'] in done or p['has_file']:
+            continue
+        out = work / f"peer_{p['peer_id']}" / FILE_NAME
+        if out.exists() and out.stat().st_size == file_size:
+            done[p['peer_id']] = time.perf_counter() - t0
+
+
+def run_subprocesses(work: Path, peers: list[dict], args: argparse.Namespace) -> tuple[float, dict, dict]:
+    env = dict(os.environ, PYTHONPATH=str(REPO_ROOT) + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    procs: dict[int, subprocess.Popen] = {}
+    usage: dict[int, dict] = {}
+    done: dict[int, float] = {}
+    t0 = time.perf_counter()
+    try:
+        for p in peers:
+            procs[p['peer_id']] = subprocess.Popen(
+                [sys.executable, str(REPO_ROOT / 'peerProcess.py'), str(p['peer_id']), *args.peer_args],
+                cwd=work, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                start_new_session=True)
+            time.sleep(args.stagger)
+
+        while len(usage) < len(procs):
+            if time.perf_counter() - t0 > args.timeout:
+                raise TimeoutError(f'swarm did not complete within {args.timeout}s')
+            poll_completion(work, peers, args.file_size, t0, done)
+            for peer_id, proc in procs.items():
+                if peer_id in usage:
+                    continue
+                pid, status, ru = os.wait4(proc.pid, os.WNOHANG)
+                if pid == 0:
+                    continue
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                usage[peer_id] = {'exit_code': proc.returncode, 'cpu_s': ru.ru_utime + ru.ru_stime,
+                                  'max_rss_kb': ru.ru_maxrss}
+            time.sleep(0.05)
+    finally:
+        # each peer leads its own process group, so --workers children go with it
+        for proc in procs.values():
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(proc.pid, signal.SIGKILL)
+            if proc.returncode is None:
+                proc.wait()
+    poll_completion(work, peers, args.file_size, t0, done)
+    return time.perf_counter() - t0, done, usage
+
+
+def run_inprocess(work: Path, peers: list[dict], args: argparse.Namespace) -> tuple[float, dict, dict]:
+    sys.path.insert(0, str(REPO_ROOT))
+    import peerProcess
+
+    async def run_peer(peer_id: int) -> None:
+        common, table, me = peerProcess.load_configs(peer_id)
+        _, data_dir, start_full = await peerProcess.prepare_directories(peer_id, common, me)
+        node = peerProcess.build_node(common, table, data_dir, start_full, peer_id)
+        connector = peerProcess.build_connector(me, peer_id, node)
+        await peerProcess.run_network(node, connector, table)
+
+    async def run_all() -> tuple[float, dict]:
+        done: dict[int, float] = {}
+        t0 = time.perf_counter()
+        tasks = []
+        for p in peers:
+            tasks.append(asyncio.create_task(run_peer(p['peer_id'])))
+            await asyncio.sleep(args.stagger)
+        swarm = asyncio.gather(*tasks)
+        while not swarm.done():
+            if time.perf_counter() - t0 > args.timeout:
+                swarm.cancel()
+                raise TimeoutError(f'swarm did not complete within {args.timeout}s')
+            poll_completion(work, peers, args.file_size, t0, done)
+            await asyncio.sleep(0.05)
+        await swarm
+        poll_completion(work, peers, args.file_size, t0, done)
+        return time.perf_counter() - t0, done
+
+    cwd = os.getcwd()
+    cpu0 = time.process_time()
+    os.chdir(work)
+    try:
+        elapsed, done = asyncio.run(run_all())
+    finally:
+        os.chdir(cwd)
+    cpu = time.process_time() - cpu0
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    # one process: CPU and RSS cannot be attributed to individual peers
+    usage = {'cpu_s': cpu, 'max_rss_kb': ru.ru_maxrss}
+    return elapsed, done, usage
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--peers', type=int, default=4)
+    ap.add_argument('--seeds', type=int, default=1)
+    ap.add_argument('--file-size', type=int, default=4 * 1024 * 1024)
+    ap.add_argument('--piece-size', type=int, default=64 * 1024)
+    ap.add_argument('--content', choices=('random', 'text'), default='random',
+                    help="payload: incompressible random bytes or CSV-like log lines")
+    ap.add_argument('--k', type=int, default=2, help='NumberOfPreferredNeighbors')
+    ap.add_argument('--unchoking-interval', type=int, default=1)
+    ap.add_argument('--optimistic-interval', type=int, default=2)
+    ap.add_argument('--mode', choices=('subprocess', 'inprocess'), default='subprocess')
+    ap.add_argument('--stagger', type=float, default=0.2, help='seconds between peer start-ups')
+    ap.add_argument('--timeout', type=float, default=600.0)
+    ap.add_argument('--keep', action='store_true', help='keep the working directory')
+    ap.add_argument('--output', type=str, default=None, help='write JSON here instead of stdout')
+    ap.add_argument('peer_args', nargs=argparse.REMAINDER,
+                    help='extra peerProcess.py arguments (subprocess mode), after --')
+    args = ap.parse_args()
+    args.peer_args = [a for a in args.peer_args if a != '--']
+
+    work = Path(tempfile.mkdtemp(prefix='swarm_bench_'))
+    try:
+        peers = write_swarm(work, args)
+        if args.mode == 'subprocess':
+            elapsed, done, usage = run_subprocesses(work, peers, args)
+        else:
+            elapsed, done, usage = run_inprocess(work, peers, args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+    per_peer = []
+    for p in peers:
+        t = done.get(p['peer_id'])
+        row = {'peer_id': p['peer_id'], 'seed': bool(p['has_file']), 'completion_s': t,
+               'throughput_bytes_s': args.file_size / t if t else None}
+        if args.mode == 'subprocess':
+            row.update(usage.get(p['peer_id'], {}))
+        per_peer.append(row)
+
+    result = {
+        'params': {k: getattr(args, k) for k in ('mode', 'peers', 'seeds', 'file_size', 'piece_size', 'content', 'k',
+                                                  'unchoking_interval', 'optimistic_interval', 'peer_args')},
+        'swarm_completion_s': elapsed,
+        'last_leecher_completion_s': max((t for t in done.values()), default=None),
+        'peers': per_peer,
+    }
+    if args.mode == 'subprocess':
+        result['total_cpu_s'] = sum(u['cpu_s'] for u in usage.values())
+        result['peak_rss_kb'] = max((u['max_rss_kb'] for u in usage.values()), default=None)
+    else:
+        result.update(total_cpu_s=usage['cpu_s'], peak_rss_kb=usage['max_rss_kb'])
+    if args.keep:
+        result['work_dir'] = str(work)
+
+    text = json.dumps(result, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + '\n', encoding='utf-8')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+import hashlib
+import struct
+
+
+def allowed_fast_set(peer_id: int, total_pieces: int, count: int, salt: bytes = b'') -> frozenset[int]:
+    """
+    Pieces `peer_id` may request while choked, derived like BEP 6 by repeatedly
+    hashing the peer id and a per-file salt. Both ends compute the same set, so
+    no message has to carry it.
+    """
+    count = min(count, total_pieces)
+    out: set[int] = set()
+    x = struct.pack('>I', peer_id) + salt
+    while len(out) < count:
+        x = hashlib.sha1(x).digest()
+        for i in range(0, 20, 4):
+            if len(out) >= count:
+                break
+            out.add(struct.unpack_from('>I', x, i)[0] % total_pieces)
+    return frozenset(out)
@@ -0,0 +1,160 @@
+import random
+from typing import Callable
+
+from .bitfield import Bitfield
+from .choking_manager import LatencyTracker
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# a bitfield holding at most one piece in this many is counted from its indices rather than scanned
+_FEW = 512
+# dense rows whose bits are counted together; bounds the temporary arrays to this many packed rows
+_BLOCK = 64
+
+
+class BatchScheduler:
+    """
+    Plans requests for all neighbors at once instead of letting each idle
+    neighbor pick a random piece on its own. Every round it counts how many
+    neighbors have each piece, walks the pieces we still need from
+    rarest to most common, and gives each to the unchoking neighbor that has it
+    and would finish it soonest at its measured rate, up to `horizon` seconds of
+    work per neighbor. The resulting queues feed RequestManager, and a neighbor
+    given several pieces may have up to `max_outstanding` of them requested at
+    once, so fast neighbors are not left idle for a round trip per piece. Once a
+    queue runs dry choose_for_neighbor picks at random as before. Bitfields stay
+    packed: a neighbor with every piece only adds to a constant, one with few
+    pieces is counted from its indices, and the rest are counted eight bits at
+    a time as packed NumPy rows when NumPy is installed, from their indices
+    otherwise.
+    """
+
+    def __init__(self, node: "PeerNode", horizon: float = 2.0, max_outstanding: int = 4):
+        self.node = node
+        self.horizon = horizon
+        self.max_outstanding = max_outstanding
+        self.piece_time = LatencyTracker()  # seconds from REQUEST to PIECE, per neighbor
+
+    def on_piece(self, peer_id: int, seconds: float) -> None:
+        self.piece_time.add_sample(peer_id, seconds)
+
+    def forget(self, peer_id: int) -> None:
+        self.piece_time.forget(peer_id)
+
+    def plan(self) -> tuple[dict[int, list[int]], dict[int, int]]:
+        """Per-neighbor piece queues and outstanding-request limits."""
+        node = self.node
+        n = node.total_pieces
+        neighbors = [ns for ns in node.neighbors() if ns.logic.wire is not None]
+        uploaders = [ns.peer_id for ns in neighbors if not ns.logic.they_choke_us]
+        if not uploaders:
+            return {}, {}
+        requests = node.requests
+        need = [j for j in range(n) if not node.local_bits.get(j) and j not in requests.inflight_peer_by_piece]
+        if not need:
+            return {}, {}
+
+        counts = (_counts_numpy if np is not None else _counts_python)([ns.logic.their_bits for ns in neighbors], n)
+        holders = (_holders_numpy if np is not None else _holders_python)(
+            [ns.logic.their_bits for ns in neighbors if not ns.logic.they_choke_us], n)
+
+        known = sorted(t for t in (self.piece_time.get(p) for p in uploaders) if t is not None)
+        default = known[len(known) // 2] if known else 1.0
+        cost = [self.piece_time.get(p) or default for p in uploaders]
+        depth = [max(1, int(self.horizon / c)) for c in cost]
+        # outstanding requests come first
+        load = [len(requests.inflight_by_peer.get(p, ())) for p in uploaders]
+
+        content = requests.content
+        planned_content: set[int] = set()
+        plan: dict[int, list[int]] = {}
+        need.sort(key=lambda j: (counts[j], random.random()))
+        for j in need:
+            if content is not None and content[j] in planned_content:
+                continue
+            best, best_finish = -1, 0.0
+            for k in holders(j):
+                if load[k] >= depth[k]:
+                    continue
+                finish = (load[k] + 1) * cost[k]
+                if best < 0 or finish < best_finish:
+                    best, best_finish = k, finish
+            if best < 0:
+                continue
+            load[best] += 1
+            plan.setdefault(uploaders[best], []).append(j)
+            if content is not None:
+                planned_content.add(content[j])
+        depth = {p: min(self.max_outstanding, load[k]) for k, p in enumerate(uploaders) if load[k] > 1}
+        return plan, depth
+
+
+def _counts_numpy(bitfields: list[Bitfield], n: int) -> list[int]:
+    n_bytes = (n + 7) // 8
+    counts = np.zeros(n_bytes * 8, dtype=np.int64)
+    full, few, dense = _split(bitfields, n)
+    if few:
+        counts[:n] += np.bincount(np.fromiter(few, dtype=np.int64, count=len(few)), minlength=n)
+    for start in range(0, len(dense), _BLOCK):
+        rows = np.frombuffer(b''.join(b.to_bytes() for b in dense[start:start + _BLOCK]), dtype=np.uint8)
+        rows = rows.reshape(-1, n_bytes)
+        for off in range(8):
+            counts[off::8] += ((rows >> (7 - off)) & 1).sum(axis=0, dtype=np.int64)
+    return (counts[:n] + full).tolist()
+
+
+def _counts_python(bitfields: list[Bitfield], n: int) -> list[int]:
+    counts = [0] * n
+    full = 0
+    for bits in bitfields:
+        if bits.count() == n:
+            full += 1
+            continue
+        for j in bits.indices():
+            counts[j] += 1
+    return [c + full for c in counts] if full else counts
+
+
+def _split(bitfields: list[Bitfield], n: int) -> tuple[int, list[int], list[Bitfield]]:
+    """How many bitfields are full, the indices held by nearly empty ones, and the rest."""
+    full, few, dense = 0, [], []
+    for bits in bitfields:
+        have = bits.count()
+        if have == n:
+            full += 1
+        elif have * _FEW <= n:
+            few.extend(bits.indices())
+        else:
+            dense.append(bits)
+    return full, few, dense
+
+
+def _holders_numpy(uploaders: list[Bitfield], n: int) -> Callable[[int], list[int]]:
+    full = [k for k, bits in enumerate(uploaders) if bits.count() == n]
+    part = [k for k, bits in enumerate(uploaders) if bits.count() != n]
+    if not part:
+        return lambda j: full
+    # pieces' bytes x uploaders, so each piece's holders are found in one contiguous row
+    rows = np.frombuffer(b''.join(uploaders[k].to_bytes() for k in part), dtype=np.uint8).reshape(len(part), -1)
+    packed = np.ascontiguousarray(rows.T)
+    part_k = np.array(part)
+
+    def holders(j: int) -> list[int]:
+        hit = part_k[np.flatnonzero(packed[j >> 3] & (0x80 >> (j & 7)))].tolist()
+        return sorted(full + hit) if full else hit
+    return holders
+
+
+def _holders_python(uploaders: list[Bitfield], n: int) -> Callable[[int], list[int]]:
+    full = [k for k, bits in enumerate(uploaders) if bits.count() == n]
+    held: dict[int, list[int]] = {}
+    for k, bits in enumerate(uploaders):
+        if bits.count() != n:
+            for j in bits.indices():
+                held.setdefault(j, []).append(k)
+    if not full:
+        return lambda j: held.get(j, [])
+    return lambda j: sorted(full + held.get(j, []))
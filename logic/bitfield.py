@@ -1,4 +1,29 @@
+from typing import Iterable
+
+
+def _sparse_limit(total_pieces: int) -> int:
+    # a set entry costs roughly what 512 dense bits do
+    return total_pieces >> 9
+
+
+def _full_bytes(total_pieces: int) -> bytearray:
+    n_bytes = (total_pieces + 7) // 8
+    bits = bytearray(b'\xff' * n_bytes)
+    spare = n_bytes * 8 - total_pieces
+    if spare:
+        bits[-1] = (0xFF << spare) & 0xFF
+    return bits
+
+
 class Bitfield:
+    """
+    Piece bitmap, one bit per piece. `empty`, `full` and `from_bytes` hand out
+    compact forms where they fit: a sentinel without storage for a peer that
+    has everything, and a set of indices for a peer that has almost nothing.
+    Both keep this API and turn themselves into the dense form in place once a
+    change no longer fits them, so holders of the object never notice.
+    """
+
     def __init__(self, total_pieces: int, bits: bytes | None = None):
         self.n = int(total_pieces)
         n_bytes = (self.n + 7) // 8
@@ -7,22 +32,27 @@ class Bitfield:
             raise ValueError('bitfield length mismatch')
 
     def __str__(self) -> str:
-        bits = ''.join(f'{b:08b}' for b in self._b)
+        bits = ''.join(f'{b:08b}' for b in self.to_bytes())
         return bits[:self.n]
 
     @classmethod
     def empty(cls, total_pieces: int) -> 'Bitfield':
-        return cls(total_pieces)
+        return _SparseBitfield(total_pieces)
 
     @classmethod
     def full(cls, total_pieces: int) -> 'Bitfield':
-        bf = cls(total_pieces)
-        for i in range(total_pieces):
-            bf.set(i, True)
-        return bf
+        return _FullBitfield(total_pieces)
 
     @classmethod
     def from_bytes(cls, total_pieces: int, b: bytes) -> 'Bitfield':
+        if len(b) != (total_pieces + 7) // 8:
+            raise ValueError('bitfield length mismatch')
+        value = int.from_bytes(b, 'big')
+        have = value.bit_count()
+        if have == total_pieces and b == _full_bytes(total_pieces):
+            return _FullBitfield(total_pieces)
+        if have <= _sparse_limit(total_pieces):
+            return _SparseBitfield(total_pieces, _indices(b))
         return cls(total_pieces, b)
 
     def to_bytes(self) -> bytes:
@@ -47,9 +77,15 @@ class Bitfield:
             self._b[byte] &= ~mask
 
     def count(self) -> int:
-        return sum(bin(b).count('1') for b in self._b)
+        return int.from_bytes(self._b, 'big').bit_count()
+
+    def indices(self) -> Iterable[int]:
+        """The pieces held, in no particular order."""
+        return _indices(self._b)
 
     def missing_from(self, other: 'Bitfield') -> list[int]:
+        if isinstance(other, _SparseBitfield):
+            return sorted(i for i in other._set if not self.get(i))
         out = []
         for i in range(self.n):
             if not self.get(i) and other.get(i):
@@ -59,3 +95,77 @@ class Bitfield:
     def summary(self) -> str:
         have = self.count()
         return f'{have}/{self.n} pieces'
+
+
+def _indices(b: bytes) -> list[int]:
+    out = []
+    for byte_i, v in enumerate(b):
+        if v:
+            base = byte_i * 8
+            out.extend(base + off for off in range(8) if v & (0x80 >> off))
+    return out
+
+
+class _FullBitfield(Bitfield):
+    """A peer that has every piece; stores nothing until a piece is cleared."""
+
+    def __init__(self, total_pieces: int):
+        self.n = int(total_pieces)
+
+    def to_bytes(self) -> bytes:
+        return bytes(_full_bytes(self.n))
+
+    def get(self, idx: int) -> bool:
+        return 0 <= idx < self.n
+
+    def set(self, idx: int, val: bool) -> None:
+        if val or not (0 <= idx < self.n):
+            return
+        self._b = _full_bytes(self.n)
+        self.__class__ = Bitfield
+        self.set(idx, val)
+
+    def count(self) -> int:
+        return self.n
+
+    def indices(self) -> Iterable[int]:
+        return range(self.n)
+
+    def missing_from(self, other: 'Bitfield') -> list[int]:
+        return []
+
+
+class _SparseBitfield(Bitfield):
+    """A peer with few pieces, kept as a set of indices until it holds more than _sparse_limit."""
+
+    def __init__(self, total_pieces: int, indices=()):
+        self.n = int(total_pieces)
+        self._set: set[int] = set(indices)
+
+    def to_bytes(self) -> bytes:
+        bits = bytearray((self.n + 7) // 8)
+        for i in self._set:
+            bits[i >> 3] |= 0x80 >> (i & 7)
+        return bytes(bits)
+
+    def get(self, idx: int) -> bool:
+        return idx in self._set
+
+    def set(self, idx: int, val: bool) -> None:
+        if not (0 <= idx < self.n):
+            return
+        if not val:
+            self._set.discard(idx)
+            return
+        self._set.add(idx)
+        if len(self._set) > _sparse_limit(self.n):
+            bits = bytearray(self.to_bytes())
+            del self._set
+            self._b = bits
+            self.__class__ = Bitfield
+
+    def count(self) -> int:
+        return len(self._set)
+
+    def indices(self) -> Iterable[int]:
+        return self._set
@@ -2,6 +2,8 @@ from typing import Protocol
 
 
 class LogicCallbacks(Protocol):
+    __slots__ = ()
+
     def on_handshake(self, peer_id: int) -> None: ...
 
     def on_disconnect(self) -> None: ...
@@ -18,12 +20,22 @@ class LogicCallbacks(Protocol):
 
     def on_bitfield(self, bits: bytes) -> None: ...
 
+    def on_have_all(self) -> None: ...
+
+    def on_have_none(self) -> None: ...
+
     def on_request(self, index: int) -> None: ...
 
     def on_piece(self, index: int, data: bytes) -> None: ...
 
+    def on_piece_ref(self, index: int, path: str) -> None: ...
+
+    def on_peer_exchange(self, entries: list[tuple[bool, int, str, int]]) -> None: ...
+
 
 class WireCommands(Protocol):
+    __slots__ = ()
+
     def send_handshake(self, peer_id: int) -> None: ...
 
     def send_choke(self) -> None: ...
@@ -38,8 +50,16 @@ class WireCommands(Protocol):
 
     def send_bitfield(self, bits: bytes) -> None: ...
 
+    def send_have_all(self) -> None: ...
+
+    def send_have_none(self) -> None: ...
+
     def send_request(self, index: int) -> None: ...
 
     def send_piece(self, index: int, data: bytes) -> None: ...
 
+    def send_piece_ref(self, index: int, path: str) -> None: ...
+
+    def send_peer_exchange(self, entries: list[tuple[bool, int, str, int]]) -> None: ...
+
     def close(self) -> None: ...
@@ -1,4 +1,5 @@
 import random
+from typing import Optional
 
 
 class RateTracker:
@@ -14,14 +15,73 @@ class RateTracker:
         return snap
 
 
+class LatencyTracker:
+    """Smoothed latency per peer, an EWMA like TCP's SRTT."""
+
+    def __init__(self, alpha: float = 0.125):
+        self.alpha = alpha
+        self._est: dict[int, float] = {}
+
+    def add_sample(self, peer_id: int, seconds: float) -> None:
+        prev = self._est.get(peer_id)
+        self._est[peer_id] = seconds if prev is None else prev + self.alpha * (seconds - prev)
+
+    def get(self, peer_id: int) -> Optional[float]:
+        return self._est.get(peer_id)
+
+    def forget(self, peer_id: int) -> None:
+        self._est.pop(peer_id, None)
+
+
+class Proximity:
+    """
+    How close each neighbor is: whether its PeerInfo.cfg locality hint matches
+    ours, then its round-trip time (from the socket or the handshake), falling
+    back to request-to-piece latency for peers with no RTT sample.
+    """
+
+    def __init__(self, locality: Optional[str] = None, localities: Optional[dict[int, str]] = None,
+                 remote_weight: float = 0.5):
+        self.locality = locality
+        self.localities = localities if localities is not None else {}
+        self.remote_weight = remote_weight
+        self.rtt = LatencyTracker()
+        self.piece_latency = LatencyTracker()
+
+    def same_site(self, peer_id: int) -> bool:
+        return self.locality is not None and self.localities.get(peer_id) == self.locality
+
+    def latency(self, peer_id: int) -> float:
+        rtt = self.rtt.get(peer_id)
+        if rtt is None:
+            rtt = self.piece_latency.get(peer_id)
+        return rtt if rtt is not None else float('inf')
+
+    def weight(self, peer_id: int) -> float:
+        """Discount applied to a remote-site peer's download rate when ranking."""
+        return 1.0 if self.locality is None or self.same_site(peer_id) else self.remote_weight
+
+    def key(self, peer_id: int) -> tuple[bool, float]:
+        return not self.same_site(peer_id), self.latency(peer_id)
+
+    def forget(self, peer_id: int) -> None:
+        self.rtt.forget(peer_id)
+        self.piece_latency.forget(peer_id)
+
+
 class ChokingManager:
-    def __init__(self, k_preferred: int):
+    def __init__(self, k_preferred: int, proximity: Optional[Proximity] = None, exploration: float = 0.0):
         self.k = k_preferred
         self.rates = RateTracker()
+        # with proximity set, nearby peers are favored and `exploration` of the slots stay random
+        self.proximity = proximity
+        self.exploration = exploration
 
     def select_preferred(self, interested_peer_ids: list[int], have_complete_file: bool) -> list[int]:
         if not interested_peer_ids:
             return []
+        if self.proximity is not None:
+            return self._select_nearby(interested_peer_ids, have_complete_file)
         if have_complete_file:
             random.shuffle(interested_peer_ids)
             return interested_peer_ids[: self.k]
@@ -38,6 +98,24 @@ class ChokingManager:
             i = j
         return ordered[: self.k]
 
-    @staticmethod
-    def pick_optimistic(choked_interested_ids: list[int]) -> int | None:
-        return random.choice(choked_interested_ids) if choked_interested_ids else None
+    def _select_nearby(self, ids: list[int], have_complete_file: bool) -> list[int]:
+        prox = self.proximity
+        explore = min(self.k, round(self.k * self.exploration))
+        if have_complete_file:
+            ranked = sorted(ids, key=lambda pid: (*prox.key(pid), random.random()))
+        else:
+            snap = self.rates.snapshot_and_reset()
+            ranked = sorted(ids, key=lambda pid: (-snap.get(pid, 0) * prox.weight(pid), *prox.key(pid),
+                                                  random.random()))
+        chosen = ranked[:self.k - explore]
+        rest = ranked[self.k - explore:]
+        return chosen + random.sample(rest, min(explore, len(rest)))
+
+    def pick_optimistic(self, choked_interested_ids: list[int]) -> int | None:
+        if not choked_interested_ids:
+            return None
+        if self.proximity is None or random.random() < self.exploration:
+            return random.choice(choked_interested_ids)
+        # otherwise a random one from the nearer half
+        ranked = sorted(choked_interested_ids, key=lambda pid: (*self.proximity.key(pid), random.random()))
+        return random.choice(ranked[:(len(ranked) + 1) // 2])
@@ -0,0 +1,32 @@
+import logging
+from pathlib import Path
+
+from .piece_store import PieceStore
+from util.manifest import Manifest, iter_pieces, piece_hash
+
+logger = logging.getLogger(__name__)
+
+
+def reuse_previous(store: PieceStore, manifest: Manifest, old_path: str | Path) -> int:
+    """
+    Fills `store` with the pieces of the new version that an older local copy
+    already holds, so only changed pieces are downloaded. The old file is cut
+    at the same piece boundaries and matched by hash, which finds pieces that
+    stayed in place or moved by whole pieces. Returns how many were reused.
+    """
+    wanted: dict[bytes, list[int]] = {}
+    for i, h in enumerate(manifest.hashes):
+        if not store.have(i):
+            wanted.setdefault(h, []).append(i)
+    reused = 0
+    for chunk in iter_pieces(old_path, manifest.piece_size):
+        indices = wanted.pop(piece_hash(chunk), None)
+        if indices is None:
+            continue
+        for i in indices:
+            if store.write_piece(i, chunk):
+                reused += 1
+        if not wanted:
+            break
+    logger.info(f'reuses {reused} of {len(manifest.hashes)} pieces from {old_path}')
+    return reused
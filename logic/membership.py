@@ -0,0 +1,111 @@
+import logging
+import time
+from typing import Callable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Member:
+    __slots__ = ('peer_id', 'host', 'port', 'connected', 'departed', 'last_seen')
+
+    def __init__(self, peer_id: int, host: Optional[str], port: Optional[int], now: float):
+        self.peer_id = peer_id
+        self.host = host
+        self.port = port
+        self.connected = False
+        self.departed = False
+        self.last_seen = now
+
+
+class Membership:
+    """
+    Who is in the swarm. Starts from the PeerInfo.cfg rows and changes at
+    runtime: peers join when they connect or are announced by peer exchange,
+    and leave when they announce that they are leaving or when we have not
+    been connected to them for `timeout` seconds; with no timeout a member
+    that just goes quiet is waited for forever. Swarm completion is judged
+    over the live members only.
+    """
+
+    def __init__(self, self_id: int, bootstrap: Iterable[tuple[int, Optional[str], Optional[int]]] = (),
+                 host: Optional[str] = None, port: Optional[int] = None, timeout: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.self_id = self_id
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._clock = clock
+        now = clock()
+        self._members: dict[int, Member] = {}
+        for peer_id, h, p in bootstrap:
+            if peer_id != self_id:
+                self._members[peer_id] = Member(peer_id, h, p, now)
+
+    @classmethod
+    def static(cls, self_id: int, peer_ids: Iterable[int]) -> 'Membership':
+        return cls(self_id, ((pid, None, None) for pid in peer_ids))
+
+    def live_ids(self) -> set[int]:
+        return {self.self_id} | {m.peer_id for m in self._members.values() if not m.departed}
+
+    def address(self, peer_id: int) -> Optional[tuple[str, int]]:
+        m = self._members.get(peer_id)
+        return (m.host, m.port) if m is not None and m.host is not None else None
+
+    def announcements(self) -> list[tuple[bool, int, str, int]]:
+        """Peer-exchange entries for ourselves and every live member with a known address."""
+        out = [(True, self.self_id, self.host, self.port)] if self.host is not None else []
+        out.extend((True, m.peer_id, m.host, m.port) for m in self._members.values()
+                   if not m.departed and m.host is not None)
+        return out
+
+    def join(self, peer_id: int, host: Optional[str] = None, port: Optional[int] = None) -> bool:
+        """Returns True when the peer is news: it was not live, or its address was unknown."""
+        if peer_id == self.self_id:
+            return False
+        m = self._members.get(peer_id)
+        if m is None:
+            m = self._members[peer_id] = Member(peer_id, host, port, self._clock())
+            return True
+        learned = host is not None and m.host is None
+        if host is not None:
+            m.host, m.port = host, port
+        if m.departed:
+            m.departed = False
+            m.last_seen = self._clock()
+            return True
+        return learned
+
+    def leave(self, peer_id: int) -> bool:
+        """Marks a peer gone unless we are connected to it; returns True when it was live."""
+        m = self._members.get(peer_id)
+        if m is None or m.departed or m.connected:
+            return False
+        m.departed = True
+        return True
+
+    def connected(self, peer_id: int) -> bool:
+        joined = self.join(peer_id)
+        m = self._members.get(peer_id)
+        if m is not None:
+            m.connected = True
+            m.last_seen = self._clock()
+        return joined
+
+    def disconnected(self, peer_id: int) -> None:
+        # not a departure by itself: the peer may reconnect before expire() drops it
+        m = self._members.get(peer_id)
+        if m is not None:
+            m.connected = False
+            m.last_seen = self._clock()
+
+    def expire(self) -> list[int]:
+        """Drops members that have not been connected within `timeout` seconds."""
+        if self.timeout is None:
+            return []
+        cutoff = self._clock() - self.timeout
+        gone = [m.peer_id for m in self._members.values()
+                if not m.departed and not m.connected and m.last_seen < cutoff]
+        for peer_id in gone:
+            self._members[peer_id].departed = True
+        return gone
@@ -1,3 +1,4 @@
+import os
 from typing import Optional
 import logging
 from logic.callbacks import LogicCallbacks, WireCommands
@@ -8,6 +9,9 @@ logger = logging.getLogger(__name__)
 
 
 class PeerLogic(LogicCallbacks):
+    __slots__ = ('node', 'wire', 'peer_id', '_outbound', 'their_bits', 'they_choke_us',
+                 'they_interested_in_us', '_sent_bitfield')
+
     def __init__(self, node: "PeerNode"):
         self.node = node
         self.wire: Optional[WireCommands] = None
@@ -36,10 +40,6 @@ class PeerLogic(LogicCallbacks):
 
         self.node.register_neighbor(self)
 
-        if not self._sent_bitfield and self.node.local_bits.count() > 0 and self.wire:
-            self.wire.send_bitfield(self.node.local_bits.to_bytes())
-            self._sent_bitfield = True
-
     def on_disconnect(self) -> None:
         self.node.on_disconnect(self)
 
@@ -48,6 +48,7 @@ class PeerLogic(LogicCallbacks):
         if self.peer_id is not None:
             logger.info(f'is choked by Peer [{self.peer_id}].')
             self.node.requests.clear_inflight_for_peer(self.peer_id)
+            self.node.maybe_request_next(self)  # allowed-fast pieces stay available
 
     def on_unchoke(self) -> None:
         self.they_choke_us = False
@@ -66,7 +67,10 @@ class PeerLogic(LogicCallbacks):
             logger.info(f"received the 'not interested' message from Peer [{self.peer_id}].")
 
     def on_have(self, index: int) -> None:
+        fresh = not self.their_bits.get(index)
         self.their_bits.set(index, True)
+        if fresh and self.node.super_seed is not None:
+            self.node.super_seed.on_have(self, index)
         if self.peer_id is not None:
             logger.info(f"received the 'have' message from Peer [{self.peer_id}] for the piece [{index}].")
         logger.info(f"now has the following bitfield for [{self.peer_id}]: {self.their_bits}")
@@ -74,23 +78,58 @@ class PeerLogic(LogicCallbacks):
             logger.info(f"believes that [{self.peer_id}] is finished.")
             self.node.mark_peer_complete(self.peer_id)
         self.node.recompute_interest(self)
+        # an unchoked neighbor we had nothing to ask of may now have something
+        self.node.maybe_request_next(self)
 
     def on_bitfield(self, bits: bytes) -> None:
-        self.their_bits = Bitfield.from_bytes(self.node.total_pieces, bits)
+        self._replace_bits(Bitfield.from_bytes(self.node.total_pieces, bits))
         if self.peer_id is not None:
             logger.info(f"received the 'bitfield' message from Peer [{self.peer_id}].")
         if self.their_bits.count() == self.node.total_pieces and self.peer_id is not None:
             self.node.mark_peer_complete(self.peer_id)
         self.node.recompute_interest(self)
+        self.node.maybe_request_next(self)
+
+    def on_have_all(self) -> None:
+        self._replace_bits(Bitfield.full(self.node.total_pieces))
+        if self.peer_id is not None:
+            logger.info(f"received the 'have all' message from Peer [{self.peer_id}].")
+            self.node.mark_peer_complete(self.peer_id)
+        self.node.recompute_interest(self)
+        self.node.maybe_request_next(self)
+
+    def on_have_none(self) -> None:
+        self._replace_bits(Bitfield.empty(self.node.total_pieces))
+        if self.peer_id is not None:
+            logger.info(f"received the 'have none' message from Peer [{self.peer_id}].")
+        self.node.recompute_interest(self)
 
     def on_request(self, index: int) -> None:
-        if self.peer_id is None or self.wire is None or self.node.we_choke_them(self.peer_id):
+        if self.peer_id is None or self.wire is None:
+            return
+        if self.node.we_choke_them(self.peer_id) and index not in self.node.allowed_fast_for(self):
+            return
+        if self.node.super_seed is not None and not self.node.super_seed.may_serve(self.peer_id, index):
             return
         if self.peer_id is not None:
             logger.info(f"received the 'request' message from Peer [{self.peer_id}] for the piece [{index}].")
-        if self.node.store.have(index):
-            data = self.node.store.read_piece(index)
-            self.wire.send_piece(index, data)
+        # same-host peers read pieces from our disk, so they do not compete for the uplink
+        if self.node.uploads is not None and not getattr(self.wire, 'local_pieces', False):
+            self.node.uploads.enqueue(self, index)
+            return
+        self.serve(index)
+
+    def serve(self, index: int) -> int:
+        """Sends a piece we have to this peer; returns the bytes handed to the wire."""
+        if self.wire is None or not self.node.store.have(index):
+            return 0
+        path = self.node.store.piece_path(index) if getattr(self.wire, 'local_pieces', False) else None
+        if path is not None:
+            self.wire.send_piece_ref(index, os.path.abspath(path))
+            return 0
+        data = self.node.store.read_piece(index)
+        self.wire.send_piece(index, data)
+        return len(data)
 
     def on_piece(self, index: int, data: bytes) -> None:
         if self.peer_id is not None:
@@ -98,6 +137,21 @@ class PeerLogic(LogicCallbacks):
             self.node.choking.rates.add_download(self.peer_id, len(data))
         self.node.handle_piece(self, index, data)
 
+    def on_piece_ref(self, index: int, path: str) -> None:
+        if self.peer_id is not None:
+            logger.info(f"received the 'piece ref' message from Peer [{self.peer_id}] for the piece [{index}].")
+            self.node.choking.rates.add_download(self.peer_id, self.node.store.expected_size(index))
+        self.node.handle_piece_ref(self, index, path)
+
+    def on_peer_exchange(self, entries: list[tuple[bool, int, str, int]]) -> None:
+        if self.peer_id is not None:
+            self.node.handle_peer_exchange(self, entries)
+
+    def _replace_bits(self, bits: Bitfield) -> None:
+        if self.node.super_seed is not None:
+            self.node.super_seed.on_bitfield(self, bits)
+        self.their_bits = bits
+
     @property
     def sent_bitfield(self) -> bool:
         return self._sent_bitfield
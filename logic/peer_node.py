@@ -1,18 +1,29 @@
 import asyncio
 import errno
-from typing import Optional, Iterable
+import os
+from typing import Callable, Optional, Iterable
 from .bitfield import Bitfield
 from .piece_store import PieceStore
 from .request_manager import RequestManager
-from .choking_manager import ChokingManager
+from .choking_manager import ChokingManager, Proximity
 from .peer_logic import PeerLogic
-import errno
+from .shared_state import SharedSwarmState
+from .membership import Membership
+from .allowed_fast import allowed_fast_set
+from .super_seed import SuperSeeder
+from .streaming import PiecePriority
+from .batch_scheduler import BatchScheduler
+from .upload_scheduler import UploadScheduler
+from util.manifest import Manifest
+from util.metrics import CHOKE_CHANGES, PREFERRED_NEIGHBORS, PIECES_HAVE
 import logging
 
 logger = logging.getLogger(__name__)
 
 
 class NeighborState:
+    __slots__ = ('peer_id', 'logic', 'we_choke_them')
+
     def __init__(self, peer_id: int, logic: PeerLogic):
         self.peer_id = peer_id
         self.logic = logic
@@ -23,42 +34,93 @@ class PeerNode:
 
     def __init__(self, total_pieces: int, piece_size: int, last_piece_size: int, data_dir: str,
                  start_with_full_file: bool, k_preferred: int, preferred_interval_sec: int,
-                 optimistic_interval_sec: int, self_id: int, all_peer_ids: set[int], file_name: str):
+                 optimistic_interval_sec: int, self_id: int, all_peer_ids: set[int], file_name: str,
+                 shared: Optional[SharedSwarmState] = None, worker_index: int = 0,
+                 store: Optional[PieceStore] = None, membership: Optional[Membership] = None,
+                 super_seed: bool = False, proximity: Optional[Proximity] = None, exploration: float = 0.0,
+                 allowed_fast: int = 0, stream_window: int = 0, manifest: Optional[Manifest] = None,
+                 dedup: bool = False, batch_interval: float = 0.0, upload_buffer: int = 0,
+                 upload_queue: int = 0):
 
         logger.info(f"starts process with k={k_preferred}, p={preferred_interval_sec}, m={optimistic_interval_sec}")
 
         self.total_pieces = total_pieces
-        self.store = PieceStore(total_pieces, piece_size, last_piece_size, data_dir, start_full=start_with_full_file)
+        self.shared = shared
+        self.worker_index = worker_index
+        if store is None:
+            store = PieceStore(total_pieces, piece_size, last_piece_size, data_dir, start_full=start_with_full_file,
+                               bits=shared.pieces if shared is not None else None)
+        self.store = store
         self.local_bits: Bitfield = self.store.bitfield()
+        # pieces this process has already sent HAVE for; differs from local_bits when sharded
+        self._announced = Bitfield.from_bytes(total_pieces, self.local_bits.to_bytes())
 
         logger.info(f"has bitfield {self.local_bits}")
-
-        self.requests = RequestManager(total_pieces)
-        self.choking = ChokingManager(k_preferred)
+        PIECES_HAVE.set_function(self.local_bits.count)
+
+        self.requests = RequestManager(total_pieces, shared, worker_index)
+        if stream_window > 0:
+            self.requests.priority = PiecePriority(total_pieces, piece_size, stream_window)
+        self._piece_waiters: dict[int, list[asyncio.Future]] = {}
+        # queues are planned two rounds deep so they do not run dry before the next round
+        self.batch_interval = batch_interval
+        self.batch: Optional[BatchScheduler] = BatchScheduler(self, 2 * batch_interval) if batch_interval > 0 else None
+        self.choking = ChokingManager(k_preferred, proximity, exploration)
         self.preferred_interval = preferred_interval_sec
         self.optimistic_interval = optimistic_interval_sec
         self.self_id = self_id
         self._registry: dict[int, NeighborState] = {}
+        self.optimistic: Optional[int] = None
+        # with an upload buffer, requests are queued per neighbor and served fairly instead of at once
+        self.uploads: Optional[UploadScheduler] = None
+        if upload_buffer > 0:
+            self.uploads = UploadScheduler(self, upload_buffer, upload_queue or 8 * piece_size)
 
         self.all_peers = all_peer_ids
+        self.membership = membership if membership is not None else Membership.static(self_id, all_peer_ids)
+        # set by the runner to open a connection to a peer learned through peer exchange
+        self.dial: Optional[Callable[[str, int], None]] = None
         self.file_name = file_name
+        self.allowed_fast = allowed_fast
+        self.manifest = manifest
+        # piece -> the other pieces with identical content; filled locally once one of them arrives
+        self._duplicates: dict[int, list[int]] = {}
+        if dedup and manifest is not None:
+            self._index_duplicates(manifest)
+        self._fast_sets: dict[int, frozenset[int]] = {}
 
         self._complete_peers = set()
         if self.local_bits.count() == self.total_pieces:
-            self._complete_peers.add(self_id)
+            self._add_complete(self_id)
         self._all_done = asyncio.Event()
         self._check_global_completion()
+        self.super_seed: Optional[SuperSeeder] = SuperSeeder(self) if super_seed and self.is_complete() else None
 
     async def wait_until_all_complete(self) -> None:
         await self._all_done.wait()
         logger.info("is closing...")
 
     def mark_peer_complete(self, peer_id: int) -> None:
-        self._complete_peers.add(peer_id)
+        self._add_complete(peer_id)
         self._check_global_completion()
 
+    def _add_complete(self, peer_id: int) -> None:
+        self._complete_peers.add(peer_id)
+        if self.shared is not None:
+            self.shared.mark_peer_complete(peer_id)
+
     def _check_global_completion(self) -> None:
-        if self._complete_peers == self.all_peers:
+        if self._all_done.is_set():
+            return
+        live = self.membership.live_ids()
+        if self.shared is not None:
+            done = all(p in self._complete_peers or self.shared.peer_complete(p) for p in live)
+            if done:
+                # pieces a sibling worker fetched must reach our neighbors before this worker closes its connections
+                self.sync_shard()
+        else:
+            done = self._complete_peers >= live
+        if done:
             self._all_done.set()
             logger.info("believes all peers are complete.")
 
@@ -68,21 +130,108 @@ class PeerNode:
     def register_neighbor(self, logic: PeerLogic) -> None:
         assert logic.peer_id is not None
         self._registry[logic.peer_id] = NeighborState(logic.peer_id, logic)
+        self._sample_rtt(logic)
+        if self.membership.connected(logic.peer_id):
+            logger.info(f'sees Peer [{logic.peer_id}] join the swarm.')
+        if getattr(logic.wire, 'peer_exchange', False):
+            logic.wire.send_peer_exchange([e for e in self.membership.announcements() if e[1] != logic.peer_id])
 
         if logic.their_bits.count() == self.total_pieces:
-            self._complete_peers.add(logic.peer_id)
+            self._add_complete(logic.peer_id)
             self._check_global_completion()
 
-        if not logic.sent_bitfield and self.local_bits.count() > 0 and logic.wire:
-            logic.wire.send_bitfield(self.local_bits.to_bytes())
+        if not logic.sent_bitfield and logic.wire:
+            self.send_bitfield(logic)
+
+    def send_bitfield(self, logic: PeerLogic) -> None:
+        if self.super_seed is not None:
+            self.super_seed.introduce(logic)
             logic._sent_bitfield = True
+            return
+        have = self.local_bits.count()
+        if getattr(logic.wire, 'compact_bitfield', False):
+            # one-byte frames for the common seed / fresh-leecher cases
+            if have == self.total_pieces:
+                logic.wire.send_have_all()
+            elif have == 0:
+                logic.wire.send_have_none()
+            else:
+                logic.wire.send_bitfield(self.local_bits.to_bytes())
+        elif have > 0:
+            logic.wire.send_bitfield(self.local_bits.to_bytes())
+        else:
+            return
+        logic._sent_bitfield = True
 
     def on_disconnect(self, logic: PeerLogic) -> None:
         if logic.peer_id is None:
             return
 
         self.requests.clear_inflight_for_peer(logic.peer_id)
-        self._registry.pop(logic.peer_id, None)
+        if self._registry.get(logic.peer_id) is not None and self._registry[logic.peer_id].logic is not logic:
+            return  # a newer connection to the same peer replaced this one
+        if self.super_seed is not None:
+            self.super_seed.forget(logic)
+        if self.choking.proximity is not None:
+            self.choking.proximity.forget(logic.peer_id)
+        if self.batch is not None:
+            self.batch.forget(logic.peer_id)
+        self.requests.planned.pop(logic.peer_id, None)
+        self.requests.depth.pop(logic.peer_id, None)
+        if self.uploads is not None:
+            self.uploads.forget(logic.peer_id)
+        ns = self._registry.pop(logic.peer_id, None)
+        # a dropped connection is not a departure; the member expires after membership.timeout without a reconnect
+        self.membership.disconnected(logic.peer_id)
+        # don't let a dead peer's slot and request sit idle until the next choking round
+        if ns is not None and not ns.we_choke_them:
+            self.run_optimistic_round()
+        for other in self.neighbors():
+            self.maybe_request_next(other.logic)
+
+    def handle_peer_exchange(self, logic: PeerLogic, entries: list[tuple[bool, int, str, int]]) -> None:
+        relay = []
+        for joined, peer_id, host, port in entries:
+            if joined:
+                if not self.membership.join(peer_id, host, port):
+                    continue
+                logger.info(f'learns from Peer [{logic.peer_id}] that Peer [{peer_id}] at {host}:{port} joined.')
+                # the higher id dials, like the PeerInfo.cfg order, so two members open one connection
+                if self.dial is not None and peer_id not in self._registry and self.self_id > peer_id:
+                    self.dial(host, port)
+            else:
+                if not self.membership.leave(peer_id):
+                    continue
+                logger.info(f'learns from Peer [{logic.peer_id}] that Peer [{peer_id}] left.')
+            relay.append((joined, peer_id, host, port))
+        if relay:
+            self._gossip(relay, exclude=logic.peer_id)
+            self._check_global_completion()
+
+    def leave_swarm(self) -> None:
+        """Tells peer-exchange neighbors we are going, so they need not wait for a timeout."""
+        if self.membership.host is not None:
+            self._gossip([(False, self.self_id, self.membership.host, self.membership.port)])
+
+    def _gossip(self, entries: list[tuple[bool, int, str, int]], exclude: Optional[int] = None) -> None:
+        for ns in self.neighbors():
+            if ns.peer_id != exclude and getattr(ns.logic.wire, 'peer_exchange', False):
+                ns.logic.wire.send_peer_exchange(entries)
+
+    async def run_membership_loop(self, interval: float = 1.0) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            for peer_id in self.membership.expire():
+                logger.info(f'has not been connected to Peer [{peer_id}] for {self.membership.timeout}s; '
+                            f'drops it from the swarm.')
+            self._check_global_completion()
+
+    def _sample_rtt(self, logic: PeerLogic) -> None:
+        if self.choking.proximity is None:
+            return
+        rtt = getattr(logic.wire, 'rtt', None)
+        if rtt is not None:
+            self.choking.proximity.rtt.add_sample(logic.peer_id, rtt)
 
     def we_choke_them(self, peer_id: int) -> bool:
         ns = self._registry.get(peer_id)
@@ -91,6 +240,10 @@ class PeerNode:
     def neighbors(self) -> Iterable[NeighborState]:
         return list(self._registry.values())
 
+    def neighbor_logic(self, peer_id: int) -> Optional[PeerLogic]:
+        ns = self._registry.get(peer_id)
+        return None if ns is None else ns.logic
+
     def recompute_interest(self, logic: PeerLogic) -> None:
         if logic.wire is None or logic.peer_id is None:
             return
@@ -101,30 +254,149 @@ class PeerNode:
         else:
             logic.wire.send_not_interested()
 
+    def allowed_fast_for(self, logic: PeerLogic) -> frozenset[int]:
+        """Pieces `logic`'s peer may request from us while we choke it; both sides must use the same count."""
+        if not self.allowed_fast or not getattr(logic.wire, 'allowed_fast', False):
+            return frozenset()
+        return self.fast_set(logic.peer_id)
+
+    def fast_set(self, peer_id: int) -> frozenset[int]:
+        s = self._fast_sets.get(peer_id)
+        if s is None:
+            salt = f'{self.file_name}:{self.total_pieces}'.encode('utf-8')
+            s = self._fast_sets[peer_id] = allowed_fast_set(peer_id, self.total_pieces, self.allowed_fast, salt)
+        return s
+
     def maybe_request_next(self, logic: PeerLogic) -> None:
         if logic.wire is None or logic.peer_id is None:
             return
+        only = None
         if logic.they_choke_us:
-            return
-        idx = self.requests.choose_for_neighbor(logic.peer_id, logic.their_bits, self.local_bits)
-        if idx is not None:
+            if not self.allowed_fast or not getattr(logic.wire, 'allowed_fast', False):
+                return
+            only = self.fast_set(self.self_id)
+        # one request unless the batch scheduler allowed this neighbor a deeper pipeline
+        while (idx := self.requests.choose_for_neighbor(logic.peer_id, logic.their_bits, self.local_bits,
+                                                        only)) is not None:
             logic.wire.send_request(idx)
             self.requests.mark_inflight(logic.peer_id, idx)
 
+    def stream_priority(self) -> PiecePriority:
+        if self.requests.priority is None:
+            self.requests.priority = PiecePriority(self.total_pieces, self.store.piece_size)
+        return self.requests.priority
+
+    def request_range(self, offset: int, length: int) -> range:
+        """Fetches the pieces covering a byte range ahead of everything else; returns their indices."""
+        pieces = self.stream_priority().request_range(offset, length)
+        for ns in self.neighbors():
+            self.maybe_request_next(ns.logic)
+        return pieces
+
+    async def wait_for_piece(self, index: int) -> None:
+        if self.local_bits.get(index):
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._piece_waiters.setdefault(index, []).append(fut)
+        try:
+            await fut
+        finally:
+            waiters = self._piece_waiters.get(index)
+            if waiters is not None and fut in waiters:
+                waiters.remove(fut)
+                if not waiters:
+                    del self._piece_waiters[index]
+
+    def _wake_piece_waiters(self, index: int) -> None:
+        for fut in self._piece_waiters.pop(index, ()):
+            if not fut.done():
+                fut.set_result(None)
+
     def handle_piece(self, logic: PeerLogic, index: int, data: bytes) -> None:
+        if self.manifest is not None and not self.manifest.matches(index, data):
+            logger.warning(f'drops piece [{index}] from Peer [{logic.peer_id}]: it does not match the manifest')
+            self.requests.clear_inflight_for_peer(logic.peer_id)
+            return
         if not self.store.write_piece(index, data):
             return
-        self.requests.complete(index)
-        self.local_bits.set(index, True)
+        self._piece_stored(logic, index)
+
+    def handle_piece_ref(self, logic: PeerLogic, index: int, path: str) -> None:
+        if os.path.basename(path) != f'piece_{index:06d}.bin' or not self._ref_matches(index, path):
+            logger.warning(f'drops piece [{index}] from Peer [{logic.peer_id}]: {path} is not that piece')
+            self._refetch(logic)
+            return
+        if not self.store.link_piece(index, path):
+            logger.warning(f'could not take piece [{index}] from {path}')
+            self._refetch(logic)
+            return
+        self._piece_stored(logic, index)
+
+    def _ref_matches(self, index: int, path: str) -> bool:
+        """Checks a PIECE_REF's file against the manifest before it is linked into our store."""
+        if self.manifest is None:
+            return True
+        size = self.store.expected_size(index)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read(size + 1)
+        except OSError:
+            return False
+        return len(data) == size and self.manifest.matches(index, data)
+
+    def _refetch(self, logic: PeerLogic) -> None:
+        """Forgets what was asked of `logic`'s peer and asks the other neighbors, which answer with PIECEs."""
+        self.requests.clear_inflight_for_peer(logic.peer_id)
+        for ns in self.neighbors():
+            if ns.logic is not logic:
+                self.maybe_request_next(ns.logic)
+
+    def _index_duplicates(self, manifest: Manifest) -> None:
+        groups: dict[bytes, list[int]] = {}
+        for i, h in enumerate(manifest.hashes):
+            groups.setdefault(h, []).append(i)
+        content = list(range(self.total_pieces))
+        for members in groups.values():
+            if len(members) < 2:
+                continue
+            for i in members:
+                content[i] = members[0]
+                self._duplicates[i] = [j for j in members if j != i]
+        self.requests.content = content
+        logger.info(f'has {len(groups)} distinct pieces among {self.total_pieces}')
+
+    def _fill_duplicates(self, index: int) -> list[int]:
+        filled = []
+        for j in self._duplicates.get(index, ()):
+            if not self.local_bits.get(j) and self.store.copy_piece(j, index):
+                self.requests.complete(j)
+                filled.append(j)
+        return filled
+
+    def _piece_stored(self, logic: PeerLogic, index: int) -> None:
+        asked = self.requests.complete(index)
+        if asked is not None and asked[0] == logic.peer_id:
+            if self.choking.proximity is not None:
+                self.choking.proximity.piece_latency.add_sample(logic.peer_id, asked[1])
+            if self.batch is not None:
+                self.batch.on_piece(logic.peer_id, asked[1])
+        fresh = [index] + self._fill_duplicates(index)
+        for i in fresh:
+            self.local_bits.set(i, True)
+            self._announced.set(i, True)
+            self._wake_piece_waiters(i)
 
         have_cnt = self.local_bits.count()
         if logic.peer_id is not None:
             logger.info(f"has downloaded the piece [{index}] from Peer [{logic.peer_id}]. "
                         f"Now the number of pieces it has is [{have_cnt}].")
+            if len(fresh) > 1:
+                logger.info(f"fills the pieces [{', '.join(str(i) for i in fresh[1:])}] from the same content.")
 
         for ns in self.neighbors():
             if ns.logic.wire:
-                ns.logic.wire.send_have(index)
+                for i in fresh:
+                    ns.logic.wire.send_have(i)
 
         for ns in self.neighbors():
             self.recompute_interest(ns.logic)
@@ -132,7 +404,7 @@ class PeerNode:
 
         if have_cnt == self.total_pieces:
             logger.info(f'has downloaded the complete file')
-            self._complete_peers.add(self.self_id)
+            self._add_complete(self.self_id)
             try:
                 self.store.reconstruct_full_file(self.file_name)
             except FileExistsError:
@@ -144,37 +416,107 @@ class PeerNode:
 
             self._check_global_completion()
 
+    def is_complete(self) -> bool:
+        return self.local_bits.count() == self.total_pieces
+
+    def run_batch_round(self) -> None:
+        if self.batch is None or self.is_complete():
+            return
+        self.requests.planned, self.requests.depth = self.batch.plan()
+        for ns in self.neighbors():
+            self.maybe_request_next(ns.logic)
+
+    def before_preferred_round(self) -> None:
+        """Per-round upkeep that does not depend on who gets unchoked; a Session calls it for every file."""
+        if self.super_seed is not None:
+            self.super_seed.tick()
+        for ns in self.neighbors():
+            self._sample_rtt(ns.logic)
+
+    def run_preferred_round(self) -> list[int]:
+        self.before_preferred_round()
+        interested = [ns.peer_id for ns in self.neighbors() if ns.logic.they_interested_in_us]
+        selected = self.choking.select_preferred(interested, self.is_complete())
+        PREFERRED_NEIGHBORS.set(len(selected))
+        self.apply_preferred(selected)
+        return selected
+
+    def apply_preferred(self, selected: list[int]) -> None:
+        """Unchoke exactly `selected` among the neighbors, choking the rest."""
+        logger.info(f'has the preferred neighbors [{", ".join(str(p) for p in selected) if selected else ""}]')
+        selected_set = set(selected)
+
+        for ns in self.neighbors():
+            if ns.logic.wire is None:
+                continue
+            if ns.peer_id in selected_set and ns.we_choke_them:
+                ns.logic.wire.send_unchoke()
+                ns.we_choke_them = False
+                CHOKE_CHANGES.labels('unchoke').inc()
+            elif ns.peer_id not in selected_set and not ns.we_choke_them:
+                ns.logic.wire.send_choke()
+                ns.we_choke_them = True
+                CHOKE_CHANGES.labels('choke').inc()
+                if self.uploads is not None:
+                    self.uploads.on_choke(ns.peer_id, self.allowed_fast_for(ns.logic))
+
+    def choked_interested(self) -> list[int]:
+        return [ns.peer_id for ns in self.neighbors() if ns.logic.they_interested_in_us and ns.we_choke_them]
+
+    def run_optimistic_round(self) -> Optional[int]:
+        pick = self.choking.pick_optimistic(self.choked_interested())
+        if pick is not None:
+            self.apply_optimistic(pick)
+        return pick
+
+    def apply_optimistic(self, pick: int) -> None:
+        logger.info(f'has the optimistically unchoked neighbor [{pick}]')
+        self.optimistic = pick
+        ns = self._registry.get(pick)
+        if ns and ns.logic.wire and ns.we_choke_them:
+            ns.logic.wire.send_unchoke()
+            ns.we_choke_them = False
+            CHOKE_CHANGES.labels('optimistic_unchoke').inc()
+
     async def run_choking_loops(self) -> None:
         async def preferred_loop() -> None:
             while True:
                 await asyncio.sleep(self.preferred_interval)
-                interested = [ns.peer_id for ns in self.neighbors() if ns.logic.they_interested_in_us]
-                selected = self.choking.select_preferred(interested, self.local_bits.count() == self.total_pieces)
-                logger.info(f'has the preferred neighbors [{", ".join(str(p) for p in selected) if selected else ""}]')
-                selected_set = set(selected)
-
-                for ns in self.neighbors():
-                    if ns.logic.wire is None:
-                        continue
-                    if ns.peer_id in selected_set and ns.we_choke_them:
-                        ns.logic.wire.send_unchoke()
-                        ns.we_choke_them = False
-                    elif ns.peer_id not in selected_set and not ns.we_choke_them:
-                        ns.logic.wire.send_choke()
-                        ns.we_choke_them = True
+                self.run_preferred_round()
 
         async def optimistic_loop() -> None:
             while True:
                 await asyncio.sleep(self.optimistic_interval)
-                choked_interested = [ns.peer_id for ns in self.neighbors()
-                                     if ns.logic.they_interested_in_us and ns.we_choke_them]
-                pick = self.choking.pick_optimistic(choked_interested)
-                if pick is None:
-                    continue
-                logger.info(f'has the optimistically unchoked neighbor [{pick}]')
-                ns = self._registry.get(pick)
-                if ns and ns.logic.wire and ns.we_choke_them:
-                    ns.logic.wire.send_unchoke()
-                    ns.we_choke_them = False
-
-        await asyncio.gather(preferred_loop(), optimistic_loop())
+                self.run_optimistic_round()
+
+        async def batch_loop() -> None:
+            while not self.is_complete():
+                await asyncio.sleep(self.batch_interval)
+                self.run_batch_round()
+
+        loops = [preferred_loop(), optimistic_loop()]
+        if self.batch is not None:
+            loops.append(batch_loop())
+        await asyncio.gather(*loops)
+
+    def sync_shard(self) -> None:
+        # Pieces fetched by sibling workers show up in the shared bitfield; announce them to our neighbors.
+        fresh = self._announced.missing_from(self.local_bits)
+        for index in fresh:
+            self._announced.set(index, True)
+            self._wake_piece_waiters(index)
+            if self.requests.priority is not None:
+                self.requests.priority.piece_done(index)
+            for ns in self.neighbors():
+                if ns.logic.wire:
+                    ns.logic.wire.send_have(index)
+        if fresh:
+            for ns in self.neighbors():
+                self.recompute_interest(ns.logic)
+                self.maybe_request_next(ns.logic)
+
+    async def run_shard_sync(self, interval: float = 0.5) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            self.sync_shard()
+            self._check_global_completion()
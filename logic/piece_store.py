@@ -1,18 +1,30 @@
+import contextlib
 import os
+from typing import Optional
 from .bitfield import Bitfield
 from pathlib import Path
+from util.metrics import STORE_OP_SECONDS, STORE_BYTES
+
+_WRITE_TIME = STORE_OP_SECONDS.labels('write')
+_READ_TIME = STORE_OP_SECONDS.labels('read')
+_WRITE_BYTES = STORE_BYTES.labels('write')
+_READ_BYTES = STORE_BYTES.labels('read')
+_LINK_BYTES = STORE_BYTES.labels('link')
 
 
 class PieceStore:
 
     def __init__(self, total_pieces: int, piece_size: int, last_piece_size: int,
-                 data_dir: str, start_full: bool = False):
+                 data_dir: str, start_full: bool = False, bits: Optional[Bitfield] = None):
         os.makedirs(data_dir, exist_ok=True)
         self.total = total_pieces
         self.piece_size = piece_size
         self.last_piece_size = last_piece_size
         self.dir = data_dir
-        self._bits = Bitfield.full(total_pieces) if start_full else Bitfield.empty(total_pieces)
+        if bits is not None:
+            self._bits = bits
+        else:
+            self._bits = Bitfield.full(total_pieces) if start_full else Bitfield.empty(total_pieces)
 
     def bitfield(self) -> Bitfield:
         return self._bits
@@ -29,16 +41,59 @@ class PieceStore:
         exp = self.expected_size(index)
         if len(data) != exp: 
             return False
-        path = os.path.join(self.dir, f'piece_{index:06d}.bin')
-        with open(path, 'wb') as f:
-            f.write(data)
+        path = self.piece_path(index)
+        # write beside and rename: the old file may be hard-linked into another peer's store
+        tmp = path + '.part'
+        with _WRITE_TIME.time():
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        _WRITE_BYTES.inc(len(data))
         self._bits.set(index, True)
         return True
 
+    def piece_path(self, index: int) -> Optional[str]:
+        return os.path.join(self.dir, f'piece_{index:06d}.bin')
+
+    def link_piece(self, index: int, src: str) -> bool:
+        """Takes a piece from another store on this host: a hard link when possible, else a copy."""
+        if index < 0 or index >= self.total:
+            return False
+        exp = self.expected_size(index)
+        try:
+            if os.path.getsize(src) != exp:
+                return False
+        except OSError:
+            return False
+        path = self.piece_path(index)
+        tmp = path + '.part'
+        try:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp)
+            os.link(src, tmp)
+            os.replace(tmp, path)
+        except OSError:
+            # another filesystem, or links not permitted
+            try:
+                with open(src, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                return False
+            return self.write_piece(index, data)
+        _LINK_BYTES.inc(exp)
+        self._bits.set(index, True)
+        return True
+
+    def copy_piece(self, index: int, src_index: int) -> bool:
+        """Stores piece `index` with the same content as `src_index`, sharing its file where possible."""
+        return self.link_piece(index, self.piece_path(src_index))
+
     def read_piece(self, index: int) -> bytes:
-        path = os.path.join(self.dir, f'piece_{index:06d}.bin')
-        with open(path, 'rb') as f:
-            return f.read()
+        path = self.piece_path(index)
+        with _READ_TIME.time(), open(path, 'rb') as f:
+            data = f.read()
+        _READ_BYTES.inc(len(data))
+        return data
 
     def reconstruct_full_file(self, file_name: str) -> Path:
         if self._bits.count() != self.total:
@@ -66,3 +121,47 @@ class PieceStore:
             os.rmdir(self.dir)
         except FileNotFoundError:
             pass
+
+
+class MemoryPieceStore(PieceStore):
+    """PieceStore that keeps only the bitfield; piece contents are zero-filled. For replay and simulation."""
+
+    def __init__(self, total_pieces: int, piece_size: int, last_piece_size: int, start_full: bool = False,
+                 bits: Optional[Bitfield] = None):
+        self.total = total_pieces
+        self.piece_size = piece_size
+        self.last_piece_size = last_piece_size
+        self.dir = ''
+        if bits is not None:
+            self._bits = bits
+        else:
+            self._bits = Bitfield.full(total_pieces) if start_full else Bitfield.empty(total_pieces)
+
+    def write_piece(self, index: int, data: bytes) -> bool:
+        if index < 0 or index >= self.total or len(data) != self.expected_size(index):
+            return False
+        self._bits.set(index, True)
+        return True
+
+    def read_piece(self, index: int) -> bytes:
+        return bytes(self.expected_size(index))
+
+    def piece_path(self, index: int) -> Optional[str]:
+        return None
+
+    def link_piece(self, index: int, src: str) -> bool:
+        return False
+
+    def copy_piece(self, index: int, src_index: int) -> bool:
+        if index < 0 or index >= self.total or self.expected_size(index) != self.expected_size(src_index):
+            return False
+        self._bits.set(index, True)
+        return True
+
+    def reconstruct_full_file(self, file_name: str) -> Path:
+        if self._bits.count() != self.total:
+            raise RuntimeError('Cannot reconstruct full file - full file not present')
+        return Path(file_name)
+
+    def cleanup_pieces(self) -> None:
+        pass
@@ -1,39 +1,110 @@
 import random
-from typing import Optional
+import time
+from typing import Callable, Iterable, Optional
 from .bitfield import Bitfield
+from .shared_state import SharedSwarmState
+from .streaming import PiecePriority
+from util.metrics import REQUESTS_INFLIGHT, REQUEST_LATENCY, REQUESTS_ABANDONED
 
 
 class RequestManager:
 
-    def __init__(self, total_pieces: int):
+    def __init__(self, total_pieces: int, shared: Optional[SharedSwarmState] = None, worker_index: int = 0,
+                 clock: Callable[[], float] = time.monotonic):
         self.total = total_pieces
-        self.inflight_piece_by_peer: dict[int, int] = {}  # peer_id -> piece
+        self.shared = shared
+        self.worker_index = worker_index
+        self.inflight_by_peer: dict[int, set[int]] = {}  # peer_id -> pieces requested from it
         self.inflight_peer_by_piece: dict[int, int] = {}  # piece -> peer_id
+        # outstanding requests allowed per peer; 1 unless the batch scheduler pipelines more
+        self.depth: dict[int, int] = {}
         self.completed: set[int] = set()
+        self._sent_at: dict[int, float] = {}  # piece -> clock() when the REQUEST went out
+        self.clock = clock
+        # per-peer queues from the batch scheduler, tried before the random pick
+        self.planned: dict[int, list[int]] = {}
+        self.priority: Optional[PiecePriority] = None  # streaming order; random when None
+        # with deduplication, content[i] is the lowest index holding the same bytes as piece i
+        self.content: Optional[list[int]] = None
 
-    def choose_for_neighbor(self, peer_id: int, neighbor_bits: Bitfield, local_bits: Bitfield) -> Optional[int]:
-        # Don't assign if this neighbor already has an outstanding request
-        if peer_id in self.inflight_piece_by_peer:
+    def choose_for_neighbor(self, peer_id: int, neighbor_bits: Bitfield, local_bits: Bitfield,
+                            only: Optional[Iterable[int]] = None) -> Optional[int]:
+        # Don't assign if this neighbor already has as many outstanding requests as it may
+        if len(self.inflight_by_peer.get(peer_id, ())) >= self.depth.get(peer_id, 1):
             return None
-        candidates = [i for i in range(self.total)
+        queue = self.planned.get(peer_id) if only is None else None
+        while queue:
+            idx = queue.pop(0)
+            if (not local_bits.get(idx) and neighbor_bits.get(idx) and idx not in self.inflight_peer_by_piece
+                    and not self._content_busy(idx)
+                    and (self.shared is None or self.shared.try_claim(idx, self.worker_index))):
+                return idx
+        candidates = [i for i in (range(self.total) if only is None else only)
                       if not local_bits.get(i)
                       and neighbor_bits.get(i)
                       and i not in self.inflight_peer_by_piece]
+        if self.content is not None and candidates and self.inflight_peer_by_piece:
+            # one request per distinct content; the other indices are filled from it when it arrives
+            busy = {self.content[i] for i in self.inflight_peer_by_piece}
+            candidates = [i for i in candidates if self.content[i] not in busy]
         if not candidates:
             return None
-        return random.choice(candidates)
+        if self.priority is not None:
+            candidates = self.priority.order(candidates, local_bits)
+            if self.shared is None:
+                return candidates[0]
+        elif self.shared is None:
+            return random.choice(candidates)
+        else:
+            random.shuffle(candidates)
+
+        # Another worker process may already be fetching a candidate from one of its neighbors
+        for idx in candidates:
+            if self.shared.try_claim(idx, self.worker_index):
+                return idx
+        return None
+
+    def _content_busy(self, index: int) -> bool:
+        if self.content is None:
+            return False
+        c = self.content[index]
+        return any(self.content[i] == c for i in self.inflight_peer_by_piece)
 
     def mark_inflight(self, peer_id: int, index: int) -> None:
-        self.inflight_piece_by_peer[peer_id] = index
+        self.inflight_by_peer.setdefault(peer_id, set()).add(index)
         self.inflight_peer_by_piece[index] = peer_id
+        self._sent_at[index] = self.clock()
+        REQUESTS_INFLIGHT.set(len(self.inflight_peer_by_piece))
 
     def clear_inflight_for_peer(self, peer_id: int) -> None:
-        idx = self.inflight_piece_by_peer.pop(peer_id, None)
-        if idx is not None:
+        pieces = self.inflight_by_peer.pop(peer_id, ())
+        for idx in pieces:
             self.inflight_peer_by_piece.pop(idx, None)
+            self._sent_at.pop(idx, None)
+            REQUESTS_ABANDONED.inc()
+            if self.shared is not None:
+                self.shared.release(idx, self.worker_index)
+        if pieces:
+            REQUESTS_INFLIGHT.set(len(self.inflight_peer_by_piece))
 
-    def complete(self, index: int) -> None:
+    def complete(self, index: int) -> Optional[tuple[int, float]]:
+        """Returns (peer asked, seconds since the request) when the piece was in flight."""
         peer = self.inflight_peer_by_piece.pop(index, None)
         if peer is not None:
-            self.inflight_piece_by_peer.pop(peer, None)
+            pieces = self.inflight_by_peer.get(peer)
+            if pieces is not None:
+                pieces.discard(index)
+                if not pieces:
+                    del self.inflight_by_peer[peer]
+            REQUESTS_INFLIGHT.set(len(self.inflight_peer_by_piece))
+        sent_at = self._sent_at.pop(index, None)
+        elapsed = None
+        if sent_at is not None:
+            elapsed = self.clock() - sent_at
+            REQUEST_LATENCY.observe(elapsed)
+        if self.shared is not None:
+            self.shared.release(index, self.worker_index)
         self.completed.add(index)
+        if self.priority is not None:
+            self.priority.piece_done(index)
+        return (peer, elapsed) if peer is not None and elapsed is not None else None
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import random
+from typing import Optional
+
+from .peer_logic import PeerLogic
+from .peer_node import PeerNode
+from util.metrics import PREFERRED_NEIGHBORS
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    """
+    Several files served by one process over one listener. Each file keeps its
+    own PeerNode (bitfield, store, requests); connections are routed to it by the
+    content id in the handshake. Unchoke slots are shared: every round the
+    `slots` best (file, peer) pairs over all files are unchoked, ranked by what
+    that peer uploaded to us across all files, so a peer's contribution to one
+    file earns it upload on another. With an upload buffer, every file's upload
+    scheduler measures the unsent bytes of the whole session, so one
+    --upload-buffer bounds the process's uplink backlog rather than each file's.
+    Within that budget the uplink is split between files by the shared slots
+    and each file's own fair queuing; there is no separate per-file rate.
+    """
+
+    def __init__(self, slots: int, preferred_interval: float, optimistic_interval: float):
+        self.slots = slots
+        self.preferred_interval = preferred_interval
+        self.optimistic_interval = optimistic_interval
+        self.nodes: dict[bytes, PeerNode] = {}
+
+    def add(self, content_id: bytes, node: PeerNode) -> None:
+        if content_id in self.nodes:
+            raise ValueError(f'content id {content_id.hex()} is already in the session')
+        self.nodes[content_id] = node
+        if node.uploads is not None:
+            node.uploads.buffered = self.upload_backlog
+
+    def upload_backlog(self) -> int:
+        """Unsent bytes in the transports of every file's neighbors."""
+        return sum(getattr(ns.logic.wire, 'write_buffer_size', 0)
+                   for node in self.nodes.values() for ns in node.neighbors())
+
+    def route(self, content_id: bytes, outbound: bool) -> Optional[PeerLogic]:
+        node = self.nodes.get(content_id)
+        if node is None:
+            logger.warning(f'has no file with content id {content_id.hex()}')
+            return None
+        logic = node.make_callbacks()
+        logic.mark_outbound(outbound)
+        return logic
+
+    def run_preferred_round(self) -> list[tuple[bytes, int]]:
+        uploaded: dict[int, int] = {}
+        for node in self.nodes.values():
+            node.before_preferred_round()
+            for pid, n in node.choking.rates.snapshot_and_reset().items():
+                uploaded[pid] = uploaded.get(pid, 0) + n
+
+        candidates = [(cid, ns.peer_id) for cid, node in self.nodes.items()
+                      for ns in node.neighbors() if ns.logic.they_interested_in_us]
+        # random key breaks ties, which also rotates slots among peers that gave us nothing
+        candidates.sort(key=lambda c: (-uploaded.get(c[1], 0), random.random()))
+        chosen = candidates[:self.slots]
+
+        per_node: dict[bytes, list[int]] = {cid: [] for cid in self.nodes}
+        for cid, pid in chosen:
+            per_node[cid].append(pid)
+        for cid, node in self.nodes.items():
+            node.apply_preferred(per_node[cid])
+        PREFERRED_NEIGHBORS.set(len(chosen))
+        return chosen
+
+    def run_optimistic_round(self) -> Optional[tuple[bytes, int]]:
+        candidates = [(cid, pid) for cid, node in self.nodes.items() for pid in node.choked_interested()]
+        if not candidates:
+            return None
+        cid, pid = random.choice(candidates)
+        self.nodes[cid].apply_optimistic(pid)
+        return cid, pid
+
+    async def run_choking_loops(self) -> None:
+        async def preferred_loop() -> None:
+            while True:
+                await asyncio.sleep(self.preferred_interval)
+                self.run_preferred_round()
+
+        async def optimistic_loop() -> None:
+            while True:
+                await asyncio.sleep(self.optimistic_interval)
+                self.run_optimistic_round()
+
+        await asyncio.gather(preferred_loop(), optimistic_loop())
+
+    async def wait_until_all_complete(self) -> None:
+        await asyncio.gather(*(node.wait_until_all_complete() for node in self.nodes.values()))
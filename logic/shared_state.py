@@ -0,0 +1,113 @@
+import multiprocessing
+import struct
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional
+from .bitfield import Bitfield
+
+
+class SharedBitfield(Bitfield):
+    """Bitfield whose bytes live in a shared memory segment owned by SharedSwarmState."""
+
+    def __init__(self, total_pieces: int, buf: memoryview, lock):
+        self.n = int(total_pieces)
+        n_bytes = (self.n + 7) // 8
+        if len(buf) != n_bytes:
+            raise ValueError('bitfield length mismatch')
+        self._b = buf
+        self._lock = lock
+
+    def set(self, idx: int, val: bool) -> None:
+        with self._lock:
+            super().set(idx, val)
+
+
+class SharedSwarmState:
+    """
+    State shared by the worker processes of one sharded peer: the piece bitfield,
+    which worker has claimed each missing piece, and which peers are complete.
+    Picklable, so it can be handed to multiprocessing.Process as an argument.
+    """
+
+    _CLAIM = struct.Struct('i')
+
+    def __init__(self, total_pieces: int, peer_ids: list[int], lock, names: Optional[tuple[str, str, str]] = None):
+        self.total = int(total_pieces)
+        self.peer_ids = sorted(peer_ids)
+        self._lock = lock
+        self._owner = names is None
+        bits_len = max(1, (self.total + 7) // 8)
+        claims_len = max(1, self.total * self._CLAIM.size)
+        peers_len = max(1, (len(self.peer_ids) + 7) // 8)
+        if names is None:
+            self._bits_shm = SharedMemory(create=True, size=bits_len)
+            self._claims_shm = SharedMemory(create=True, size=claims_len)
+            self._peers_shm = SharedMemory(create=True, size=peers_len)
+            for shm in (self._bits_shm, self._claims_shm, self._peers_shm):
+                shm.buf[:] = b'\x00' * len(shm.buf)
+        else:
+            self._bits_shm = SharedMemory(name=names[0])
+            self._claims_shm = SharedMemory(name=names[1])
+            self._peers_shm = SharedMemory(name=names[2])
+        self._claims = self._claims_shm.buf[:self.total * self._CLAIM.size].cast('i')
+        self._peer_index = {pid: i for i, pid in enumerate(self.peer_ids)}
+        self.pieces = SharedBitfield(self.total, self._bits_shm.buf[:(self.total + 7) // 8], lock)
+        self.complete_peers = SharedBitfield(len(self.peer_ids),
+                                             self._peers_shm.buf[:(len(self.peer_ids) + 7) // 8], lock)
+
+    @classmethod
+    def create(cls, total_pieces: int, peer_ids: list[int], start_full: bool = False) -> 'SharedSwarmState':
+        state = cls(total_pieces, peer_ids, multiprocessing.Lock())
+        if start_full:
+            for i in range(total_pieces):
+                state.pieces.set(i, True)
+        return state
+
+    def __getstate__(self):
+        names = (self._bits_shm.name, self._claims_shm.name, self._peers_shm.name)
+        return self.total, self.peer_ids, self._lock, names
+
+    def __setstate__(self, state) -> None:
+        total, peer_ids, lock, names = state
+        self.__init__(total, peer_ids, lock, names)
+
+    # ---- request assignment ----
+
+    def claimed_by(self, index: int) -> Optional[int]:
+        owner = self._claims[index]
+        return owner - 1 if owner else None
+
+    def try_claim(self, index: int, worker: int) -> bool:
+        with self._lock:
+            owner = self._claims[index]
+            if owner and owner != worker + 1:
+                return False
+            self._claims[index] = worker + 1
+            return True
+
+    def release(self, index: int, worker: int) -> None:
+        with self._lock:
+            if self._claims[index] == worker + 1:
+                self._claims[index] = 0
+
+    # ---- swarm completion ----
+
+    def mark_peer_complete(self, peer_id: int) -> None:
+        idx = self._peer_index.get(peer_id)
+        if idx is not None:
+            self.complete_peers.set(idx, True)
+
+    def peer_complete(self, peer_id: int) -> bool:
+        idx = self._peer_index.get(peer_id)
+        return idx is not None and self.complete_peers.get(idx)
+
+    def all_peers_complete(self) -> bool:
+        return self.complete_peers.count() == len(self.peer_ids)
+
+    def close(self) -> None:
+        self._claims.release()
+        self.pieces._b.release()
+        self.complete_peers._b.release()
+        for shm in (self._bits_shm, self._claims_shm, self._peers_shm):
+            shm.close()
+            if self._owner:
+                shm.unlink()
@@ -0,0 +1,119 @@
+import random
+from typing import Optional
+from .bitfield import Bitfield
+
+
+class PiecePriority:
+    """
+    Piece order for streaming consumers. Byte ranges asked for through
+    `request_range` come first, then a window of `window` pieces starting at the
+    first missing piece at or after the read cursor, both lowest index first. Everything else is picked at random as
+    before, so a streaming peer still fetches and offers pieces the swarm lacks.
+    """
+
+    def __init__(self, total_pieces: int, piece_size: int, window: int = 0):
+        self.total = total_pieces
+        self.piece_size = piece_size
+        self.window = window
+        self.cursor = 0
+        self._head = 0  # first piece at or after the cursor we do not have yet
+        self._urgent: set[int] = set()
+
+    def pieces_for(self, offset: int, length: int) -> range:
+        if offset < 0 or length < 0:
+            raise ValueError(f'bad byte range offset={offset} length={length}')
+        if length == 0:
+            return range(0)
+        first = offset // self.piece_size
+        last = (offset + length - 1) // self.piece_size
+        return range(min(first, self.total), min(last + 1, self.total))
+
+    def request_range(self, offset: int, length: int) -> range:
+        pieces = self.pieces_for(offset, length)
+        self._urgent.update(pieces)
+        return pieces
+
+    def seek(self, offset: int) -> None:
+        self.cursor = self._head = min(offset // self.piece_size, self.total)
+
+    def piece_done(self, index: int) -> None:
+        self._urgent.discard(index)
+
+    def order(self, candidates: list[int], local_bits: Bitfield) -> list[int]:
+        """`candidates` with urgent pieces first, then the window, then the rest shuffled."""
+        while self._head < self.total and local_bits.get(self._head):
+            self._head += 1
+        end = self._head + self.window
+        urgent, ahead, rest = [], [], []
+        for i in candidates:
+            if i in self._urgent:
+                urgent.append(i)
+            elif self._head <= i < end:
+                ahead.append(i)
+            else:
+                rest.append(i)
+        urgent.sort()
+        ahead.sort()
+        random.shuffle(rest)
+        return urgent + ahead + rest
+
+
+class StreamReader:
+    """
+    Reads the file in order from a PeerNode's piece store while it downloads,
+    waiting for pieces that have not arrived yet. Moves the node's streaming
+    window along as it reads.
+    """
+
+    def __init__(self, node: "PeerNode", offset: int = 0):
+        self.node = node
+        self.size = (node.total_pieces - 1) * node.store.piece_size + node.store.last_piece_size
+        self.pos = 0
+        self.seek(offset)
+
+    def seek(self, offset: int) -> None:
+        self.pos = max(0, min(offset, self.size))
+        self.node.stream_priority().seek(self.pos)
+
+    async def read(self, n: int = -1) -> bytes:
+        """Up to `n` bytes (to the end when negative); waits only for the first piece, returns b'' at the end."""
+        if self.pos >= self.size or n == 0:
+            return b''
+        end = self.size if n < 0 else min(self.size, self.pos + n)
+        piece_size = self.node.store.piece_size
+        index = self.pos // piece_size
+        await self.node.wait_for_piece(index)
+        out = []
+        while self.pos < end and index < self.node.total_pieces and self.node.local_bits.get(index):
+            start = index * piece_size
+            data = self.node.store.read_piece(index)
+            chunk = data[self.pos - start:end - start]
+            out.append(chunk)
+            self.pos += len(chunk)
+            index += 1
+        self.node.stream_priority().seek(self.pos)
+        return b''.join(out)
+
+    async def read_range(self, offset: int, length: int) -> bytes:
+        """Exactly the bytes in [offset, offset+length) clipped to the file, fetched at high priority."""
+        length = max(0, min(length, self.size - offset))
+        pieces = self.node.request_range(offset, length)
+        for index in pieces:
+            await self.node.wait_for_piece(index)
+        piece_size = self.node.store.piece_size
+        out = []
+        for index in pieces:
+            start = index * piece_size
+            data = self.node.store.read_piece(index)
+            out.append(data[max(0, offset - start):offset + length - start])
+        return b''.join(out)
+
+    def contiguous(self) -> Optional[int]:
+        """Bytes readable from the current position without waiting, or None at the end."""
+        if self.pos >= self.size:
+            return None
+        piece_size = self.node.store.piece_size
+        index = self.pos // piece_size
+        while index < self.node.total_pieces and self.node.local_bits.get(index):
+            index += 1
+        return max(0, min(self.size, index * piece_size) - self.pos)
@@ -0,0 +1,121 @@
+import logging
+import random
+import time
+from typing import Callable
+
+from .bitfield import Bitfield
+from .peer_logic import PeerLogic
+
+logger = logging.getLogger(__name__)
+
+
+class SuperSeeder:
+    """
+    Super-seeding for a node that starts with the whole file. Neighbors get no
+    bitfield; each is offered one piece at a time through HAVE, picking the
+    piece seen on the fewest neighbors, and is offered the next one only once a
+    different neighbor announces the offered piece (it was passed on), or after
+    `reoffer_after` seconds of holding it without passing it on. Requests for
+    pieces never offered to the asker are ignored. Once every piece has a copy
+    in the swarm the node falls back to normal seeding and sends its bitfield.
+    """
+
+    def __init__(self, node: "PeerNode", reoffer_after: float = 10.0, clock: Callable[[], float] = time.monotonic):
+        self.node = node
+        self.reoffer_after = reoffer_after
+        self.clock = clock
+        n = node.total_pieces
+        self._copies = [0] * n       # neighbors known to hold each piece
+        self._offers = [0] * n       # outstanding offers of each piece
+        self._uncovered = n          # pieces with no copy outside this node
+        self._offered: dict[int, tuple[int, float]] = {}  # peer -> (piece, offered at)
+        self._granted: dict[int, set[int]] = {}
+
+    def introduce(self, logic: PeerLogic) -> None:
+        self._granted.setdefault(logic.peer_id, set())
+        self._offer_next(logic)
+
+    def may_serve(self, peer_id: int, index: int) -> bool:
+        return index in self._granted.get(peer_id, ())
+
+    def on_have(self, logic: PeerLogic, index: int) -> None:
+        """Called once `logic.their_bits` has recorded a piece new to that neighbor."""
+        self._add_copy(index, 1)
+        for peer_id, (offered, _) in list(self._offered.items()):
+            if offered == index and peer_id != logic.peer_id:
+                ns = self.node._registry.get(peer_id)
+                if ns is not None:
+                    self._offer_next(ns.logic)
+        mine = self._offered.get(logic.peer_id)
+        if mine is not None and mine[0] == index and not self._anyone_lacks(index, logic.peer_id):
+            self._offer_next(logic)  # nobody to pass it on to, so waiting would only stall
+        self._check_done()
+
+    def on_bitfield(self, logic: PeerLogic, bits: Bitfield) -> None:
+        """Called before `logic.their_bits` is replaced by `bits`."""
+        for i in range(self.node.total_pieces):
+            was, now = logic.their_bits.get(i), bits.get(i)
+            if was != now:
+                self._add_copy(i, 1 if now else -1)
+        self._check_done()
+
+    def forget(self, logic: PeerLogic) -> None:
+        for i in range(self.node.total_pieces):
+            if logic.their_bits.get(i):
+                self._add_copy(i, -1)
+        prev = self._offered.pop(logic.peer_id, None)
+        if prev is not None:
+            self._offers[prev[0]] -= 1
+        self._granted.pop(logic.peer_id, None)
+
+    def tick(self) -> None:
+        """Moves on for neighbors that got their piece but did not pass it on in time."""
+        now = self.clock()
+        for peer_id, (index, when) in list(self._offered.items()):
+            ns = self.node._registry.get(peer_id)
+            if ns is not None and ns.logic.their_bits.get(index) and now - when >= self.reoffer_after:
+                self._offer_next(ns.logic)
+
+    def _anyone_lacks(self, index: int, holder: int) -> bool:
+        return any(ns.peer_id != holder and not ns.logic.their_bits.get(index) for ns in self.node.neighbors())
+
+    def _add_copy(self, index: int, delta: int) -> None:
+        before = self._copies[index]
+        self._copies[index] = before + delta
+        if before == 0 and delta > 0:
+            self._uncovered -= 1
+        elif before + delta == 0 and delta < 0:
+            self._uncovered += 1
+
+    def _offer_next(self, logic: PeerLogic) -> None:
+        peer_id = logic.peer_id
+        prev = self._offered.pop(peer_id, None)
+        if prev is not None:
+            self._offers[prev[0]] -= 1
+        best: list[int] = []
+        best_key = None
+        for i in range(self.node.total_pieces):
+            if logic.their_bits.get(i):
+                continue
+            key = (self._copies[i], self._offers[i])
+            if best_key is None or key < best_key:
+                best, best_key = [i], key
+            elif key == best_key:
+                best.append(i)
+        if not best or logic.wire is None:
+            return
+        index = random.choice(best)
+        self._offered[peer_id] = (index, self.clock())
+        self._offers[index] += 1
+        self._granted.setdefault(peer_id, set()).add(index)
+        logger.info(f'super-seeds piece [{index}] to Peer [{peer_id}].')
+        logic.wire.send_have(index)
+
+    def _check_done(self) -> None:
+        if self._uncovered > 0 or self.node.super_seed is not self:
+            return
+        logger.info('sees every piece in the swarm; stops super-seeding.')
+        self.node.super_seed = None
+        for ns in self.node.neighbors():
+            if ns.logic.wire is not None:
+                self.node.send_bitfield(ns.logic)
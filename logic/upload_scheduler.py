@@ -0,0 +1,165 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Callable, Optional
+
+from util import memory
+
+logger = logging.getLogger(__name__)
+
+
+class UploadScheduler:
+    """
+    Serves REQUESTs from per-neighbor queues by deficit round-robin instead of
+    the moment they arrive. Each turn a neighbor's deficit grows by one piece
+    times its weight: the optimistic unchoke weighs `optimistic_weight` and
+    joins the ring at the front, other unchoked neighbors weigh 1, and choked
+    neighbors asking for allowed-fast pieces `choked_weight`. Pieces are only
+    written while the transports hold fewer than `max_buffered` unsent bytes,
+    so the uplink is shared by these weights rather than by whoever asks
+    fastest, and nothing is served while the process memory budget is tight.
+    A neighbor may have at most `max_queued` bytes of requests waiting. A
+    request past that is refused with a CHOKE, which makes the requester
+    forget everything in flight with us; the neighbor is unchoked again once
+    its queue has drained and re-sends what it still needs.
+    """
+
+    def __init__(self, node: "PeerNode", max_buffered: int, max_queued: int,
+                 optimistic_weight: float = 2.0, choked_weight: float = 0.25, poll: float = 0.01):
+        self.node = node
+        self.max_buffered = max_buffered
+        self.max_queued = max_queued
+        self.optimistic_weight = optimistic_weight
+        self.choked_weight = choked_weight
+        self.poll = poll  # how soon to look again while the transports are full
+        self.quantum = node.store.piece_size
+        self._queues: dict[int, deque[int]] = {}
+        self._queued_bytes: dict[int, int] = {}
+        self._deficit: dict[int, float] = {}  # keys are the neighbors in the ring
+        self._ring: deque[int] = deque()
+        self._throttled: set[int] = set()  # choked for asking too much; unchoked once served
+        self._credited = False  # the ring's head already got its quantum for this turn
+        self._scheduled = False
+        # replaced by the simulator with its virtual clock's call_later
+        self.call_later: Optional[Callable[..., object]] = None
+        # replaced by a Session so that all its files share one upload buffer
+        self.buffered: Callable[[], int] = self._buffered
+
+    def queued_bytes(self, peer_id: Optional[int] = None) -> int:
+        if peer_id is None:
+            return sum(self._queued_bytes.values())
+        return self._queued_bytes.get(peer_id, 0)
+
+    def enqueue(self, logic: "PeerLogic", index: int) -> bool:
+        peer_id = logic.peer_id
+        q = self._queues.setdefault(peer_id, deque())
+        if index in q:
+            return True
+        size = self.node.store.expected_size(index)
+        queued = self._queued_bytes.get(peer_id, 0)
+        # allowed-fast requests are few and may come from a choked neighbor, so they always fit
+        if queued and queued + size > self.max_queued and index not in self.node.allowed_fast_for(logic):
+            # requests arriving while throttled were sent before our CHOKE, which cleared them
+            if peer_id not in self._throttled:
+                logger.info(f'chokes Peer [{peer_id}] until its queue drains: {queued} bytes already '
+                            f'queued, refusing the request for piece [{index}]')
+                self._throttled.add(peer_id)
+                logic.wire.send_choke()
+            return False
+        q.append(index)
+        self._queued_bytes[peer_id] = queued + size
+        if peer_id not in self._deficit:
+            self._deficit[peer_id] = 0.0
+            if peer_id == self.node.optimistic:
+                self._ring.appendleft(peer_id)
+                self._credited = False
+            else:
+                self._ring.append(peer_id)
+        self._schedule(0)
+        return True
+
+    def on_choke(self, peer_id: int, keep: frozenset[int]) -> None:
+        """Drops what a neighbor we just choked has queued, except pieces in `keep` (its allowed-fast set)."""
+        self._throttled.discard(peer_id)  # the choke is for real now, so it must not be lifted when served
+        q = self._queues.get(peer_id)
+        if not q:
+            return
+        kept = deque(i for i in q if i in keep)
+        self._queues[peer_id] = kept
+        self._queued_bytes[peer_id] = sum(self.node.store.expected_size(i) for i in kept)
+        if not kept:
+            self._retire(peer_id)
+
+    def forget(self, peer_id: int) -> None:
+        if peer_id in self._queues:
+            self._retire(peer_id)
+
+    def _weight(self, peer_id: int) -> float:
+        if self.node.we_choke_them(peer_id):
+            return self.choked_weight
+        if peer_id == self.node.optimistic:
+            return self.optimistic_weight
+        return 1.0
+
+    def _buffered(self) -> int:
+        return sum(getattr(ns.logic.wire, 'write_buffer_size', 0) for ns in self.node.neighbors())
+
+    def _schedule(self, delay: float) -> None:
+        if self._scheduled:
+            return
+        self._scheduled = True
+        call_later = self.call_later or asyncio.get_running_loop().call_later
+        call_later(delay, self._serve)
+
+    def _release(self, peer_id: int, logic: "PeerLogic") -> None:
+        """Unchokes a throttled neighbor whose queue has drained, unless the choking rounds choked it since."""
+        self._throttled.discard(peer_id)
+        if logic.wire is not None and not self.node.we_choke_them(peer_id):
+            logger.info(f'unchokes Peer [{peer_id}]: its upload queue has drained')
+            logic.wire.send_unchoke()
+
+    def _retire(self, peer_id: int) -> None:
+        if self._ring and self._ring[0] == peer_id:
+            self._ring.popleft()
+            self._credited = False
+        elif peer_id in self._deficit:
+            self._ring.remove(peer_id)
+        self._deficit.pop(peer_id, None)
+        self._queues.pop(peer_id, None)
+        self._queued_bytes.pop(peer_id, None)
+        self._throttled.discard(peer_id)
+
+    def _serve(self) -> None:
+        self._scheduled = False
+        if memory.BUDGET is not None and memory.BUDGET.tight:
+            self._schedule(self.poll)
+            return
+        room = self.max_buffered - self.buffered()
+        while self._ring and room > 0:
+            peer_id = self._ring[0]
+            q = self._queues[peer_id]
+            logic = self.node.neighbor_logic(peer_id)
+            if logic is None:
+                self._retire(peer_id)
+                continue
+            if not self._credited:
+                self._deficit[peer_id] += self.quantum * self._weight(peer_id)
+                self._credited = True
+            while q and room > 0:
+                size = self.node.store.expected_size(q[0])
+                if size > self._deficit[peer_id]:
+                    break
+                index = q.popleft()
+                self._queued_bytes[peer_id] -= size
+                self._deficit[peer_id] -= size
+                room -= logic.serve(index)
+            if not q:
+                if peer_id in self._throttled:
+                    self._release(peer_id, logic)
+                self._retire(peer_id)
+            elif room > 0:
+                # out of deficit: next neighbor's turn
+                self._ring.rotate(-1)
+                self._credited = False
+        if self._ring:
+            self._schedule(self.poll)
@@ -1,16 +1,24 @@
 import struct
 from typing import Optional
-from .constants import MessageType, MAX_FRAME
+from .constants import MessageType, BitfieldEncoding, MAX_FRAME, KEEPALIVE_FRAME
+from util.metrics import FRAMES_ENCODED, FRAMES_DECODED
+
+_ENCODED = {t: FRAMES_ENCODED.labels(t.name) for t in MessageType}
+_DECODED = {t: FRAMES_DECODED.labels(t.name) for t in MessageType}
 
 
 def encode_frame(msg_type: MessageType, payload: bytes = b'') -> bytes:
     if not isinstance(payload, (bytes, bytearray)):
         raise TypeError("Payload isn't bytes-like")
     length = 1 + len(payload)
+    _ENCODED[msg_type].inc()
     return struct.pack('>I', length) + struct.pack('>B', int(msg_type)) + payload
 
 
 def decode_one(buffer: bytearray) -> Optional[tuple[MessageType, bytes]]:
+    # keepalives carry nothing beyond resetting the idle timer, which any received byte does
+    while buffer.startswith(KEEPALIVE_FRAME):
+        del buffer[:4]
     if len(buffer) < 4:
         return None
 
@@ -25,6 +33,7 @@ def decode_one(buffer: bytearray) -> Optional[tuple[MessageType, bytes]]:
     payload = bytes(buffer[5:4 + length])
 
     del buffer[:4 + length]
+    _DECODED[mtype].inc()
     return mtype, payload
 
 
@@ -55,3 +64,171 @@ def enc_piece(index: int, data: bytes) -> bytes:
 def dec_piece(payload: bytes) -> tuple[int, bytes]:
     index = struct.unpack('>I', payload[:4])[0]
     return index, payload[4:]
+
+
+def enc_compressed_piece(index: int, codec_id: int, data: bytes) -> bytes:
+    return struct.pack('>IB', index, codec_id) + data
+
+
+def dec_compressed_piece(payload: bytes) -> tuple[int, int, bytes]:
+    if len(payload) < 5:
+        raise ValueError('COMPRESSED_PIECE message too short')
+    index, codec_id = struct.unpack('>IB', payload[:5])
+    return index, codec_id, payload[5:]
+
+
+def enc_piece_ref(index: int, path: str) -> bytes:
+    return struct.pack('>I', index) + path.encode('utf-8')
+
+
+def dec_piece_ref(payload: bytes) -> tuple[int, str]:
+    if len(payload) < 5:
+        raise ValueError('PIECE_REF message too short')
+    return struct.unpack('>I', payload[:4])[0], bytes(payload[4:]).decode('utf-8')
+
+
+def enc_peer_exchange(entries: list[tuple[bool, int, str, int]]) -> bytes:
+    """Each entry: joined flag, peer id, port, then the host as a length-prefixed UTF-8 string."""
+    out = bytearray()
+    for joined, peer_id, host, port in entries:
+        raw = host.encode('utf-8')
+        if len(raw) > 255:
+            raise ValueError(f'host name too long: {host[:32]}...')
+        out += struct.pack('>BIHB', 1 if joined else 0, peer_id, port, len(raw))
+        out += raw
+    return bytes(out)
+
+
+def dec_peer_exchange(payload: bytes) -> list[tuple[bool, int, str, int]]:
+    entries = []
+    pos = 0
+    while pos < len(payload):
+        if len(payload) - pos < 8:
+            raise ValueError('PEER_EXCHANGE entry truncated')
+        joined, peer_id, port, n = struct.unpack('>BIHB', payload[pos:pos + 8])
+        pos += 8
+        if len(payload) - pos < n:
+            raise ValueError('PEER_EXCHANGE host truncated')
+        entries.append((bool(joined), peer_id, bytes(payload[pos:pos + n]).decode('utf-8'), port))
+        pos += n
+    return entries
+
+
+def enc_varint(value: int, out: bytearray) -> None:
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def dec_varint(buf: bytes, pos: int) -> tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise ValueError('Truncated varint')
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7F) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _index_list(bits: bytes, want_set: bool, limit: int) -> Optional[bytearray]:
+    # delta-coded positions of set (or unset) bits; None as soon as it would exceed `limit` bytes
+    out = bytearray()
+    skip = 0x00 if want_set else 0xFF
+    prev = -1
+    for byte_idx, b in enumerate(bits):
+        if b == skip:
+            continue
+        if not want_set:
+            b ^= 0xFF
+        base = byte_idx * 8
+        for off in range(8):
+            if b & (0x80 >> off):
+                idx = base + off
+                enc_varint(idx - prev - 1, out)
+                prev = idx
+        if len(out) > limit:
+            return None
+    return out
+
+
+def _runs(bits: bytes, limit: int) -> Optional[bytearray]:
+    # lengths of alternating runs of equal bits, starting with a run of zeros (possibly empty)
+    out = bytearray()
+    current = 0
+    run = 0
+    for b in bits:
+        if b == (0xFF if current else 0x00):
+            run += 8
+            continue
+        for off in range(8):
+            bit = 1 if b & (0x80 >> off) else 0
+            if bit == current:
+                run += 1
+            else:
+                enc_varint(run, out)
+                current = bit
+                run = 1
+        if len(out) > limit:
+            return None
+    enc_varint(run, out)
+    return out if len(out) <= limit else None
+
+
+def enc_compact_bitfield(bits: bytes) -> bytes:
+    """Encode a dense bitfield with whichever of dense/runs/set-list/unset-list is smallest."""
+    best_kind, best = BitfieldEncoding.DENSE, bytes(bits)
+    for kind, encode in ((BitfieldEncoding.SET_LIST, lambda lim: _index_list(bits, True, lim)),
+                         (BitfieldEncoding.UNSET_LIST, lambda lim: _index_list(bits, False, lim)),
+                         (BitfieldEncoding.RUNS, lambda lim: _runs(bits, lim))):
+        body = encode(len(best) - 1)
+        if body is not None and len(body) < len(best):
+            best_kind, best = kind, body
+    out = bytearray((best_kind,))
+    enc_varint(len(bits), out)
+    out += best
+    return bytes(out)
+
+
+def dec_compact_bitfield(payload: bytes) -> bytes:
+    if not payload:
+        raise ValueError('Empty COMPACT_BITFIELD message')
+    kind = BitfieldEncoding(payload[0])
+    n_bytes, pos = dec_varint(payload, 1)
+    if n_bytes > MAX_FRAME:
+        raise ValueError(f'COMPACT_BITFIELD too large: {n_bytes}B')
+    if kind == BitfieldEncoding.DENSE:
+        if len(payload) - pos != n_bytes:
+            raise ValueError('COMPACT_BITFIELD dense length mismatch')
+        return bytes(payload[pos:])
+
+    n_bits = n_bytes * 8
+    if kind == BitfieldEncoding.RUNS:
+        value = 0
+        current = 0
+        idx = 0
+        while pos < len(payload):
+            run, pos = dec_varint(payload, pos)
+            if run > n_bits - idx:
+                raise ValueError('COMPACT_BITFIELD run past the end of the bitfield')
+            if current:
+                value |= ((1 << run) - 1) << (n_bits - idx - run)
+            idx += run
+            current ^= 1
+        if idx != n_bits:
+            raise ValueError('COMPACT_BITFIELD runs do not cover the bitfield')
+        return value.to_bytes(n_bytes, 'big')
+
+    out = bytearray(n_bytes) if kind == BitfieldEncoding.SET_LIST else bytearray(b'\xff' * n_bytes)
+    idx = -1
+    while pos < len(payload):
+        delta, pos = dec_varint(payload, pos)
+        idx += delta + 1
+        if idx >= n_bits:
+            raise ValueError('COMPACT_BITFIELD index out of range')
+        out[idx // 8] ^= 0x80 >> (idx % 8)
+    return bytes(out)
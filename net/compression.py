@@ -0,0 +1,107 @@
+import zlib
+from dataclasses import dataclass
+from typing import Callable, Optional
+from .constants import MAX_FRAME, EXT_ZLIB, EXT_LZ4, EXT_ZSTD
+
+
+@dataclass(frozen=True)
+class Codec:
+    codec_id: int
+    name: str
+    flag: int
+    compress: Callable[[bytes], bytes]
+    decompress: Callable[[bytes, int], bytes]
+
+
+def _zlib_decompress(data: bytes, max_size: int) -> bytes:
+    d = zlib.decompressobj()
+    out = d.decompress(data, max_size)
+    if d.unconsumed_tail or not d.eof:
+        raise ValueError(f'zlib payload is truncated or inflates past {max_size}B')
+    return out
+
+
+CODECS: dict[int, Codec] = {
+    1: Codec(1, 'zlib', EXT_ZLIB, lambda b: zlib.compress(b, 6), _zlib_decompress),
+}
+
+try:
+    import lz4.block as _lz4
+except ImportError:
+    _lz4 = None
+else:
+    CODECS[2] = Codec(2, 'lz4', EXT_LZ4,
+                      lambda b: _lz4.compress(b, store_size=False),
+                      lambda b, limit: _lz4.decompress(b, uncompressed_size=limit))
+
+try:
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+else:
+    CODECS[3] = Codec(3, 'zstd', EXT_ZSTD,
+                      lambda b: _zstd.ZstdCompressor(level=3).compress(b),
+                      lambda b, limit: _zstd.ZstdDecompressor().decompress(b, max_output_size=limit))
+
+# preferred first when several are negotiated
+_PREFERENCE = ('zstd', 'lz4', 'zlib')
+
+
+def codec_flags(names: Optional[list[str]] = None) -> int:
+    """Extension flags advertising the given codecs (all installed ones when names is None)."""
+    flags = 0
+    for c in CODECS.values():
+        if names is None or c.name in names:
+            flags |= c.flag
+    return flags
+
+
+def codec_names() -> list[str]:
+    return [c.name for c in CODECS.values()]
+
+
+def negotiate(extensions: int) -> Optional[Codec]:
+    by_name = {c.name: c for c in CODECS.values() if extensions & c.flag}
+    for name in _PREFERENCE:
+        if name in by_name:
+            return by_name[name]
+    return None
+
+
+def decompress(codec_id: int, data: bytes, max_size: int = MAX_FRAME) -> bytes:
+    codec = CODECS.get(codec_id)
+    if codec is None:
+        raise ValueError(f'Unknown compression codec {codec_id}')
+    return codec.decompress(data, max_size)
+
+
+class PieceCompressor:
+    """
+    Per-connection compression policy. Pieces that do not shrink below
+    `max_ratio` are sent raw, and each miss doubles the number of following
+    pieces that skip compression (up to `max_skip`); a hit resets it.
+    """
+
+    def __init__(self, codec: Codec, min_size: int = 512, max_ratio: float = 0.9, max_skip: int = 64):
+        self.codec = codec
+        self.min_size = min_size
+        self.max_ratio = max_ratio
+        self.max_skip = max_skip
+        self._skip = 0
+        self._backoff = 1
+
+    def should_try(self, size: int) -> bool:
+        if size < self.min_size:
+            return False
+        if self._skip > 0:
+            self._skip -= 1
+            return False
+        return True
+
+    def accept(self, raw_size: int, compressed_size: int) -> bool:
+        if compressed_size <= raw_size * self.max_ratio:
+            self._backoff = 1
+            return True
+        self._skip = self._backoff
+        self._backoff = min(self.max_skip, self._backoff * 2)
+        return False
@@ -1,9 +1,15 @@
 import asyncio
+import contextlib
+import ipaddress
 import logging
+import os
+import socket
 from typing import Callable, Optional, Set
 
 from logic.callbacks import LogicCallbacks
+from .constants import DEFAULT_CONTENT_ID, EXT_LOCAL_PIECES
 from .peer_connection import PeerConnection
+from .socket_options import SocketOptions
 
 logger = logging.getLogger(__name__)
 
@@ -15,14 +21,32 @@ class Connector:
         listen_port: int,
         *,
         local_peer_id: int,
-        logic_factory: Callable[[], LogicCallbacks],
+        logic_factory: Optional[Callable[[], LogicCallbacks]] = None,
+        router: Optional[Callable[[bytes, bool], Optional[LogicCallbacks]]] = None,
         handshake_timeout: float = 5.0,
+        idle_timeout: Optional[float] = None,
+        reuse_port: bool = False,
+        socket_options: Optional[SocketOptions] = None,
+        extensions: int = 0,
+        unix_dir: Optional[str] = None,
     ):
         self._listen_host = listen_host
         self._listen_port = int(listen_port)
         self._local_peer_id = int(local_peer_id)
+        if (logic_factory is None) == (router is None):
+            raise ValueError('pass exactly one of logic_factory and router')
         self._logic_factory = logic_factory
+        # router(content_id, outbound) serves several files on one listener; see logic/session.py
+        self._router = router
         self._handshake_to = float(handshake_timeout)
+        self._idle_to = idle_timeout
+        self._reuse_port = bool(reuse_port)
+        self._sock_opts = socket_options if socket_options is not None else SocketOptions()
+        self._extensions = int(extensions)
+        # peers on this host listen on <unix_dir>/p2p-<port>.sock as well; connections over it skip
+        # TCP loopback and hand pieces over as file references (EXT_LOCAL_PIECES)
+        self._unix_dir = unix_dir
+        self._unix_server: Optional[asyncio.base_events.Server] = None
 
         self._server: Optional[asyncio.base_events.Server] = None
         self._tasks: Set[asyncio.Task] = set()
@@ -32,16 +56,28 @@ class Connector:
     async def serve(self) -> None:
         bind_host = "0.0.0.0"
         logger.info(f"Listening on {self._listen_host}:{self._listen_port}")
-        self._server = await asyncio.start_server(self._on_client, bind_host, self._listen_port)
+        self._server = await asyncio.start_server(self._on_client, bind_host, self._listen_port,
+                                                  reuse_port=self._reuse_port or None)
+        if self._unix_dir is not None:
+            path = unix_socket_path(self._unix_dir, self._listen_port)
+            os.makedirs(self._unix_dir, exist_ok=True)
+            self._unix_server = await asyncio.start_unix_server(self._on_local_client, path)
+            logger.info(f"Listening on {path}")
         async with self._server:
             await self._server.serve_forever()
 
-    async def connect(self, host: str, port: int) -> None:
+    async def connect(self, host: str, port: int, content_id: bytes = DEFAULT_CONTENT_ID) -> None:
+        if self._unix_dir is not None and self._is_local(host):
+            path = unix_socket_path(self._unix_dir, port)
+            try:
+                reader, writer = await asyncio.open_unix_connection(path)
+            except OSError as e:
+                logger.debug(f'No local socket at {path} ({e}); using TCP')
+            else:
+                await self._start_connection(reader, writer, outbound=True, content_id=content_id, local=True)
+                return
         reader, writer = await asyncio.open_connection(host, port)
-        logic = self._logic_factory()
-        if hasattr(logic, 'mark_outbound'):
-            logic.mark_outbound(True)
-        await self._start_connection(reader, writer)
+        await self._start_connection(reader, writer, outbound=True, content_id=content_id)
 
     async def connect_with_retry(
         self,
@@ -51,11 +87,12 @@ class Connector:
         attempts: int = 5,
         initial_backoff: float = 1.0,
         max_backoff: float = 10.0,
+        content_id: bytes = DEFAULT_CONTENT_ID,
     ) -> None:
         backoff = float(initial_backoff)
         for _ in range(max(1, attempts)):
             try:
-                await self.connect(host, port)
+                await self.connect(host, port, content_id)
                 return
             except (ConnectionError, asyncio.TimeoutError, OSError) as e:
                 logger.warning(f'Connection attempt to {host}:{port} failed: {e}')
@@ -74,12 +111,18 @@ class Connector:
             except OSError as e:
                 logger.warning(f'Error while closing socket: {e}')
             self._server = None
-
-        for conn in list(self._connections):
-            try:
-                conn.close()
-            except OSError as e:
-                logger.warning(f'Error while closing connection {conn}: {e}')
+        if self._unix_server is not None:
+            self._unix_server.close()
+            with contextlib.suppress(OSError):
+                await self._unix_server.wait_closed()
+                os.unlink(unix_socket_path(self._unix_dir, self._listen_port))
+            self._unix_server = None
+
+        conns = list(self._connections)
+        results = await asyncio.gather(*(conn.close_gracefully() for conn in conns), return_exceptions=True)
+        for conn, res in zip(conns, results):
+            if isinstance(res, OSError):
+                logger.warning(f'Error while closing connection {conn}: {res}')
 
         for t in list(self._tasks):
             if not t.done():
@@ -87,19 +130,54 @@ class Connector:
         await asyncio.sleep(0)
 
     async def _on_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
-        logic = self._logic_factory()
-        if hasattr(logic, 'mark_outbound'):
-            logic.mark_outbound(False)
-        await self._start_connection(reader, writer)
+        await self._start_connection(reader, writer, outbound=False)
+
+    async def _on_local_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        await self._start_connection(reader, writer, outbound=False, local=True)
+
+    def _is_local(self, host: str) -> bool:
+        if host in ('localhost', self._listen_host, socket.gethostname()):
+            return True
+        try:
+            return ipaddress.ip_address(host).is_loopback
+        except ValueError:
+            return False
 
-    async def _start_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    def _make_logic(self, outbound: bool) -> LogicCallbacks:
         logic = self._logic_factory()
+        if hasattr(logic, 'mark_outbound'):
+            logic.mark_outbound(outbound)
+        return logic
+
+    def _route_inbound(self, content_id: bytes) -> Optional[LogicCallbacks]:
+        return self._router(content_id, False)
+
+    async def _start_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                                *, outbound: bool, content_id: bytes = DEFAULT_CONTENT_ID,
+                                local: bool = False) -> None:
+        self._sock_opts.apply(writer.get_extra_info('socket'))
+        router = None
+        if self._router is None:
+            logic = self._make_logic(outbound)
+        elif outbound:
+            logic = self._router(content_id, True)
+            if logic is None:
+                writer.close()
+                raise ValueError(f'no file with content id {content_id.hex()}')
+        else:
+            # the logic is picked once the remote handshake names the file
+            logic, router = None, self._route_inbound
         conn = PeerConnection(
             reader,
             writer,
             callbacks=logic,
             local_peer_id=self._local_peer_id,
             handshake_timeout=self._handshake_to,
+            idle_timeout=self._idle_to,
+            extensions=self._extensions | (EXT_LOCAL_PIECES if local else 0),
+            content_id=content_id,
+            router=router,
+            outbound=outbound,
         )
         if hasattr(logic, 'set_wire'):
             logic.set_wire(conn)
@@ -127,3 +205,7 @@ class Connector:
     def _track_task(self, task: asyncio.Task) -> None:
         self._tasks.add(task)
         task.add_done_callback(self._tasks.discard)
+
+
+def unix_socket_path(unix_dir: str, port: int) -> str:
+    return os.path.join(unix_dir, f'p2p-{port}.sock')
@@ -4,6 +4,25 @@ HEADER = b'P2PFILESHARINGPROJ'
 ZEROS = b'\x00' * 10
 MAX_FRAME = 10 * 1024 * 1024
 
+# Extension flags, carried in the last two bytes of the handshake padding and enabled when both sides set them
+EXT_COMPACT_BITFIELD = 0x0001
+# PIECE payload compression; one flag per codec, the best codec both sides offer is used
+EXT_ZLIB = 0x0002
+EXT_LZ4 = 0x0004
+EXT_ZSTD = 0x0008
+# the 8 remaining padding bytes carry a content id, so one listener can serve several files
+EXT_CONTENT_ID = 0x0010
+DEFAULT_CONTENT_ID = b'\x00' * 8
+# PEER_EXCHANGE gossip of swarm members joining and leaving
+EXT_PEER_EXCHANGE = 0x0020
+# zero-length keepalive frames; the idle timeout is only enforced on connections that negotiated them
+EXT_KEEPALIVE = 0x0040
+KEEPALIVE_FRAME = b'\x00\x00\x00\x00'
+# both ends derive the same allowed-fast piece set (logic/allowed_fast.py); no message carries it
+EXT_ALLOWED_FAST = 0x0080
+# PIECE_REF hands over a piece by naming its file; only offered on Unix-socket connections (same host)
+EXT_LOCAL_PIECES = 0x0100
+
 
 class MessageType(IntEnum):
     CHOKE = 0
@@ -14,4 +33,18 @@ class MessageType(IntEnum):
     BITFIELD = 5
     REQUEST = 6
     PIECE = 7
+    # extensions
+    HAVE_ALL = 8
+    HAVE_NONE = 9
+    COMPACT_BITFIELD = 10
+    COMPRESSED_PIECE = 11
+    PEER_EXCHANGE = 12
+    PIECE_REF = 13
+
+
+class BitfieldEncoding(IntEnum):
+    DENSE = 0
+    RUNS = 1
+    SET_LIST = 2
+    UNSET_LIST = 3
 
@@ -1,15 +1,19 @@
 import struct
-from .constants import HEADER, ZEROS
+from .constants import HEADER, DEFAULT_CONTENT_ID, EXT_CONTENT_ID
 
 
 class Handshake:
-    __slots__ = ('peer_id',)
+    __slots__ = ('peer_id', 'extensions', 'content_id')
 
-    def __init__(self, peer_id: int):
+    def __init__(self, peer_id: int, extensions: int = 0, content_id: bytes = DEFAULT_CONTENT_ID):
+        if len(content_id) != 8:
+            raise ValueError('content id must be 8 bytes')
         self.peer_id = int(peer_id)
+        self.extensions = int(extensions)
+        self.content_id = bytes(content_id)
 
     def encode(self) -> bytes:
-        return HEADER + ZEROS + struct.pack('>I', self.peer_id)
+        return HEADER + self.content_id + struct.pack('>HI', self.extensions, self.peer_id)
 
     @staticmethod
     def decode(buf: bytes) -> 'Handshake':
@@ -17,8 +21,8 @@ class Handshake:
             raise ValueError('Handshake too small')
         if buf[:18] != HEADER:
             raise ValueError('Handshake header not valid')
-        if buf[18:28] != ZEROS:
+        extensions, peer_id = struct.unpack('>HI', buf[26:32])
+        content_id = bytes(buf[18:26])
+        if content_id != DEFAULT_CONTENT_ID and not extensions & EXT_CONTENT_ID:
             raise ValueError('Handshake padding not valid')
-
-        (peer_id,) = struct.unpack('>I', buf[28:])
-        return Handshake(peer_id)
+        return Handshake(peer_id, extensions, content_id)
@@ -1,29 +1,57 @@
 import asyncio
-from typing import Optional
+import contextlib
+import time
+from typing import Callable, Optional
 import logging
-from .constants import MessageType
+from .constants import (MessageType, EXT_COMPACT_BITFIELD, EXT_CONTENT_ID, EXT_PEER_EXCHANGE, EXT_KEEPALIVE,
+                        KEEPALIVE_FRAME, EXT_ALLOWED_FAST, EXT_LOCAL_PIECES, MAX_FRAME, DEFAULT_CONTENT_ID)
+from .compression import PieceCompressor, negotiate, decompress
 from .handshake import Handshake
+from .socket_options import tcp_rtt
+from . import trace
 from .codec import (
     encode_frame, decode_one,
     enc_have, dec_have,
     enc_request, dec_request,
-    enc_piece, dec_piece
+    enc_piece, dec_piece,
+    enc_compact_bitfield, dec_compact_bitfield,
+    enc_compressed_piece, dec_compressed_piece,
+    enc_peer_exchange, dec_peer_exchange,
+    enc_piece_ref, dec_piece_ref
 )
 
 from logic.callbacks import WireCommands, LogicCallbacks
+from util import memory, profiling
+from util.metrics import (
+    CONNECTIONS, PEER_BYTES_SENT, PEER_BYTES_RECEIVED,
+    PEER_WRITE_BUFFER, PEER_READ_BUFFER, COMPRESSION_BYTES, COMPRESSION_SKIPPED, Counter
+)
 
 logger = logging.getLogger(__name__)
 
+_PEER_METRICS = (PEER_BYTES_SENT, PEER_BYTES_RECEIVED, PEER_WRITE_BUFFER, PEER_READ_BUFFER)
+# the connection whose transport backs each peer's series; after a reconnect the newer one
+_metrics_owner: dict[int, 'PeerConnection'] = {}
+
 
 class PeerConnection(WireCommands):
+    __slots__ = ('_r', '_w', '_cb', '_local_id', 'connected_peer_id', '_handshake_to', '_idle_to',
+                 '_read_task', '_buf', '_closed', '_m_sent', '_m_recv', '_local_ext', 'extensions',
+                 '_compressor', '_pending', 'content_id', '_router', '_handshake_rtt', '_outbound',
+                 '_last_rx', '_last_tx', '_draining', '_paused')
+
     def __init__(
             self,
             reader: asyncio.StreamReader,
             writer: asyncio.StreamWriter,
-            callbacks: LogicCallbacks,
+            callbacks: Optional[LogicCallbacks],
             local_peer_id: int,
             handshake_timeout: float = 5.0,
             idle_timeout: Optional[float] = None,
+            extensions: int = 0,
+            content_id: bytes = DEFAULT_CONTENT_ID,
+            router: Optional[Callable[[bytes], Optional[LogicCallbacks]]] = None,
+            outbound: bool = False,
     ):
         self._r = reader
         self._w = writer
@@ -35,9 +63,61 @@ class PeerConnection(WireCommands):
         self._read_task: Optional[asyncio.Task] = None
         self._buf = bytearray()
         self._closed = False
+        self._draining = False  # we sent EOF and only read until the peer closes too
+        self._paused = False  # not reading while the memory budget is tight; silence is then ours
+        # per-peer byte counters; bound once the remote id is known
+        self._m_sent: Optional[Counter] = None
+        self._m_recv: Optional[Counter] = None
+        self._local_ext = int(extensions)
+        # extensions both sides advertised; known after the handshake
+        self.extensions = 0
+        self._compressor: Optional[PieceCompressor] = None
+        self._pending: set[asyncio.Task] = set()
+        # with no callbacks the connection is an inbound session connection: the remote
+        # handshake's content id picks the logic through `router` before we answer
+        self.content_id = bytes(content_id)
+        self._router = router
+        self._handshake_rtt: Optional[float] = None
+        self._outbound = outbound
+        self._last_rx = self._last_tx = time.monotonic()
+        if content_id != DEFAULT_CONTENT_ID or router is not None:
+            self._local_ext |= EXT_CONTENT_ID
+
+    @property
+    def compact_bitfield(self) -> bool:
+        return bool(self.extensions & EXT_COMPACT_BITFIELD)
+
+    @property
+    def rtt(self) -> Optional[float]:
+        """Kernel-smoothed RTT when available, else the time our handshake took to be answered."""
+        rtt = tcp_rtt(self._w.get_extra_info('socket'))
+        return rtt if rtt is not None else self._handshake_rtt
+
+    @property
+    def allowed_fast(self) -> bool:
+        return bool(self.extensions & EXT_ALLOWED_FAST)
+
+    @property
+    def local_pieces(self) -> bool:
+        return bool(self.extensions & EXT_LOCAL_PIECES)
+
+    @property
+    def keepalive(self) -> bool:
+        return bool(self.extensions & EXT_KEEPALIVE)
+
+    @property
+    def peer_exchange(self) -> bool:
+        return bool(self.extensions & EXT_PEER_EXCHANGE)
+
+    @property
+    def write_buffer_size(self) -> int:
+        return 0 if self._closed else self._w.transport.get_write_buffer_size()
 
     async def start(self) -> None:
-        self.send_handshake(self._local_id)
+        routed = self._cb is None
+        if not routed:
+            self.send_handshake(self._local_id)
+        t0 = time.perf_counter()
 
         try:
             remote = await asyncio.wait_for(self._r.readexactly(32), timeout=self._handshake_to)
@@ -48,8 +128,28 @@ class PeerConnection(WireCommands):
 
         try:
             hs = Handshake.decode(remote)
+            if routed:
+                self._cb = self._router(hs.content_id) if self._router is not None else None
+                if self._cb is None:
+                    raise ValueError(f'no file with content id {hs.content_id.hex()}')
+                self.content_id = hs.content_id
+                if hasattr(self._cb, 'set_wire'):
+                    self._cb.set_wire(self)
+                self.send_handshake(self._local_id)
+            elif hs.content_id != self.content_id:
+                raise ValueError(f'content id {hs.content_id.hex()} does not match {self.content_id.hex()}')
             self.connected_peer_id = hs.peer_id
+            if self._outbound:
+                # the remote sends its handshake as soon as it accepts, about one RTT after ours left
+                self._handshake_rtt = time.perf_counter() - t0
+            self.extensions = self._local_ext & hs.extensions
+            codec = negotiate(self.extensions)
+            if codec is not None:
+                self._compressor = PieceCompressor(codec)
             logger.info(f"receives handshake from peer [{self.connected_peer_id}]")
+            self._bind_metrics(hs.peer_id)
+            if trace.TRACE is not None:
+                trace.TRACE.record(hs.peer_id, 'in', 'handshake')
         except (ValueError, OSError) as e:
             logger.warning(f'Failed to decode handshake: {e}')
             self._safe_disconnect()
@@ -60,10 +160,23 @@ class PeerConnection(WireCommands):
         except (AttributeError, RuntimeError, TypeError) as e:
             logger.error(f'Error running handshake callback for peer {hs.peer_id}: {e}')
         self._read_task = asyncio.create_task(self._read_loop())
+        if self.keepalive and self._idle_to:
+            task = asyncio.create_task(self._keepalive_loop())
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
 
     async def _read_loop(self) -> None:
         try:
             while not self._closed:
+                budget = memory.BUDGET
+                if budget is not None and budget.tight and not self._buf:
+                    # paused only between frames, so a half-received frame can still complete and free its bytes
+                    self._paused = True
+                    try:
+                        await budget.wait()
+                    finally:
+                        self._paused = False
+                    self._last_rx = time.monotonic()
                 chunk = None
                 try:
                     chunk = await self._r.read(4096)
@@ -72,7 +185,9 @@ class PeerConnection(WireCommands):
 
                 if not chunk:
                     break
+                self._last_rx = time.monotonic()
                 self._buf.extend(chunk)
+                self._m_recv.inc(len(chunk))
 
                 while True:
                     res = None
@@ -83,16 +198,57 @@ class PeerConnection(WireCommands):
                     if res is None:
                         break
                     mtype, payload = res
+                    if mtype == MessageType.COMPRESSED_PIECE:
+                        try:
+                            payload = await self._inflate(payload)
+                        except ValueError as e:
+                            logger.warning(f'Failed to decompress piece: {e}')
+                            continue
+                        mtype = MessageType.PIECE
                     try:
                         self._dispatch(mtype, payload)
                     except (ValueError, RuntimeError, TypeError) as e:
                         logger.warning(f'Error dispatching message: {e}')
+                if budget is not None:
+                    budget.update('recv_buffer', self, len(self._buf))
         except asyncio.CancelledError as e:
             logger.debug(f'Read loop cancelled: {e}')
         finally:
             self._safe_disconnect()
 
+    async def _keepalive_loop(self) -> None:
+        # a timer rather than a timeout on every read keeps the read path free of per-chunk wait_for overhead
+        interval = self._idle_to / 3
+        while not self._closed:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            # while reads are paused the peer's keepalives sit unread in the socket, so silence says nothing
+            if not self._paused and now - self._last_rx > self._idle_to:
+                logger.warning(f'closes the connection to peer [{self.connected_peer_id}] after '
+                               f'{now - self._last_rx:.0f}s without data')
+                self._safe_disconnect()
+                return
+            if now - self._last_tx >= interval and not self._draining:
+                try:
+                    self._w.write(KEEPALIVE_FRAME)
+                except (ConnectionError, OSError) as e:
+                    logger.warning(f'Write error for keepalive: {e}')
+                    self._safe_disconnect()
+                    return
+                self._last_tx = now
+                if self._m_sent is not None:
+                    self._m_sent.inc(len(KEEPALIVE_FRAME))
+
+    async def _inflate(self, payload: bytes) -> bytes:
+        index, codec_id, data = dec_compressed_piece(payload)
+        raw = await asyncio.get_running_loop().run_in_executor(None, decompress, codec_id, data, MAX_FRAME - 5)
+        return enc_piece(index, raw)
+
     def _dispatch(self, mtype: MessageType, payload: bytes) -> None:
+        stats = profiling.HANDLER_STATS
+        t0 = time.perf_counter() if stats is not None else 0.0
+        if trace.TRACE is not None:
+            trace.TRACE.record_frame(self.connected_peer_id, 'in', mtype, payload)
         try:
             match mtype:
                 case MessageType.CHOKE:
@@ -107,21 +263,35 @@ class PeerConnection(WireCommands):
                     self._cb.on_have(dec_have(payload))
                 case MessageType.BITFIELD:
                     self._cb.on_bitfield(payload)
+                case MessageType.COMPACT_BITFIELD:
+                    self._cb.on_bitfield(dec_compact_bitfield(payload))
+                case MessageType.HAVE_ALL:
+                    self._cb.on_have_all()
+                case MessageType.HAVE_NONE:
+                    self._cb.on_have_none()
                 case MessageType.REQUEST:
                     self._cb.on_request(dec_request(payload))
                 case MessageType.PIECE:
                     idx, data = dec_piece(payload)
                     self._cb.on_piece(idx, data)
+                case MessageType.PIECE_REF:
+                    idx, path = dec_piece_ref(payload)
+                    self._cb.on_piece_ref(idx, path)
+                case MessageType.PEER_EXCHANGE:
+                    self._cb.on_peer_exchange(dec_peer_exchange(payload))
                 case _:
                     logger.warning(f'Unknown message type: {mtype}')
         except (ValueError, AttributeError, RuntimeError, TypeError) as e:
             logger.warning(f'Error dispatching message {mtype.name}: {e}')
+        finally:
+            if stats is not None:
+                stats.record(mtype.name, time.perf_counter() - t0)
 
     def send_handshake(self, peer_id: int) -> None:
         if self._closed:
             return
         try:
-            self._w.write(Handshake(peer_id).encode())
+            self._w.write(Handshake(peer_id, self._local_ext, self.content_id).encode())
             logger.info(f"sends handshake to peer [{self.connected_peer_id}]")
         except (OSError, ConnectionError, ValueError) as e:
             logger.warning(f'Failed to send handshake to peer {peer_id}: {e}')
@@ -151,7 +321,18 @@ class PeerConnection(WireCommands):
         logger.info(f"sends 'bitfield' to peer [{self.connected_peer_id}]")
         if not isinstance(bits, (bytes, bytearray)):
             raise TypeError('bitfield must be bytes')
-        self._send_tp(MessageType.BITFIELD, bytes(bits))
+        if self.compact_bitfield:
+            self._send_tp(MessageType.COMPACT_BITFIELD, enc_compact_bitfield(bits))
+        else:
+            self._send_tp(MessageType.BITFIELD, bits)
+
+    def send_have_all(self) -> None:
+        logger.info(f"sends 'have all' to peer [{self.connected_peer_id}]")
+        self._send_t(MessageType.HAVE_ALL)
+
+    def send_have_none(self) -> None:
+        logger.info(f"sends 'have none' to peer [{self.connected_peer_id}]")
+        self._send_t(MessageType.HAVE_NONE)
 
     def send_request(self, index: int) -> None:
         logger.info(f"sends 'request' for piece {index} to peer [{self.connected_peer_id}]")
@@ -161,16 +342,105 @@ class PeerConnection(WireCommands):
         logger.info(f"sends 'piece' with number {index} to peer [{self.connected_peer_id}]")
         if not isinstance(data, (bytes, bytearray)):
             raise TypeError('piece data must be bytes')
+        if self._compressor is not None:
+            if self._compressor.should_try(len(data)):
+                task = asyncio.create_task(self._send_compressed(index, data))
+                self._pending.add(task)
+                task.add_done_callback(self._pending.discard)
+                task.add_done_callback(self._count_compressed)
+                return
+            COMPRESSION_SKIPPED.labels('backoff').inc()
+        self._send_tp(MessageType.PIECE, enc_piece(index, bytes(data)))
+
+    def send_piece_ref(self, index: int, path: str) -> None:
+        logger.info(f"sends 'piece ref' with number {index} to peer [{self.connected_peer_id}]")
+        self._send_tp(MessageType.PIECE_REF, enc_piece_ref(index, path))
+
+    def send_peer_exchange(self, entries: list[tuple[bool, int, str, int]]) -> None:
+        logger.info(f"sends 'peer exchange' with {len(entries)} entries to peer [{self.connected_peer_id}]")
+        self._send_tp(MessageType.PEER_EXCHANGE, enc_peer_exchange(entries))
+
+    async def _send_compressed(self, index: int, data: bytes) -> Optional[tuple[int, int]]:
+        """Returns the raw and compressed sizes when the piece was written compressed."""
+        codec = self._compressor.codec
+        body = await asyncio.get_running_loop().run_in_executor(None, codec.compress, bytes(data))
+        if self._compressor.accept(len(data), len(body)):
+            if self._send_tp(MessageType.COMPRESSED_PIECE, enc_compressed_piece(index, codec.codec_id, body)):
+                return len(data), len(body)
+            return None
+        COMPRESSION_SKIPPED.labels('incompressible').inc()
         self._send_tp(MessageType.PIECE, enc_piece(index, bytes(data)))
+        return None
+
+    def _count_compressed(self, task: asyncio.Task) -> None:
+        # counted once the frame is on the transport, so cancelled or failed sends are not
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logger.error(f'Failed to send a compressed piece to peer [{self.connected_peer_id}]: {task.exception()}')
+            return
+        sizes = task.result()
+        if sizes is not None:
+            COMPRESSION_BYTES.labels('raw').inc(sizes[0])
+            COMPRESSION_BYTES.labels('compressed').inc(sizes[1])
 
     def close(self) -> None:
         self._safe_disconnect()
 
-    def _send_t(self, t: MessageType) -> None:
+    async def close_gracefully(self, timeout: float = 2.0) -> None:
+        """
+        Half-closes and keeps reading until the peer closes as well. Closing a
+        socket with unread input makes the kernel send RST, and the peer then
+        loses frames we wrote that it had not read yet (the last HAVEs).
+        """
         if self._closed:
             return
+        if self._read_task is None or not self._w.can_write_eof():
+            self._safe_disconnect()
+            return
+        self._draining = True
+        try:
+            self._w.write_eof()
+        except (ConnectionError, OSError, RuntimeError):
+            self._safe_disconnect()
+            return
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(asyncio.shield(self._read_task), timeout)
+        self._safe_disconnect()
+
+    def _bind_metrics(self, peer_id: int) -> None:
+        self._m_sent = PEER_BYTES_SENT.labels(peer_id)
+        self._m_recv = PEER_BYTES_RECEIVED.labels(peer_id)
+        transport = self._w.transport
+        _metrics_owner[peer_id] = self
+        PEER_WRITE_BUFFER.labels(peer_id).set_function(transport.get_write_buffer_size)
+        PEER_READ_BUFFER.labels(peer_id).set_function(self._buf.__len__)
+        CONNECTIONS.inc()
+        if memory.BUDGET is not None:
+            memory.BUDGET.watch('send_buffer', self, transport.get_write_buffer_size)
+
+    def _unbind_metrics(self) -> None:
+        if self._m_sent is None:
+            return
+        CONNECTIONS.dec()
+        peer_id = self.connected_peer_id
+        if _metrics_owner.get(peer_id) is not self:
+            return
+        del _metrics_owner[peer_id]
+        for metric in _PEER_METRICS:
+            metric.remove(peer_id)
+
+    def _send_t(self, t: MessageType) -> None:
+        if self._closed or self._draining:
+            return
         try:
-            self._w.write(encode_frame(t))
+            frame = encode_frame(t)
+            self._w.write(frame)
+            self._last_tx = time.monotonic()
+            if trace.TRACE is not None:
+                trace.TRACE.record_frame(self.connected_peer_id, 'out', t, b'')
+            if self._m_sent is not None:
+                self._m_sent.inc(len(frame))
         except ValueError as e:
             logger.error(f'Failed to encode frame for {t.name}: {e}')
             self._safe_disconnect()
@@ -178,27 +448,48 @@ class PeerConnection(WireCommands):
             logger.warning(f'Write error for {t.name}: {e}')
             self._safe_disconnect()
 
-    def _send_tp(self, t: MessageType, p: bytes) -> None:
-        if self._closed:
-            return
+    def _send_tp(self, t: MessageType, p: bytes) -> bool:
+        """Writes one frame; returns whether it reached the transport."""
+        if self._closed or self._draining:
+            return False
         try:
-            self._w.write(encode_frame(t, p))
+            frame = encode_frame(t, p)
+            self._w.write(frame)
+            self._last_tx = time.monotonic()
+            if memory.BUDGET is not None:
+                memory.BUDGET.update('send_buffer', self, self._w.transport.get_write_buffer_size())
+            if trace.TRACE is not None:
+                trace.TRACE.record_frame(self.connected_peer_id, 'out', t, p)
+            if self._m_sent is not None:
+                self._m_sent.inc(len(frame))
         except ValueError as e:
             logger.error(f'Failed to encode frame for {t.name} with payload ({len(p)}B): {e}')
             self._safe_disconnect()
+            return False
         except (ConnectionError, OSError) as e:
             logger.warning(f'Write error for {t.name} with payload ({len(p)}B): {e}')
             self._safe_disconnect()
+            return False
+        return True
 
     def _safe_disconnect(self) -> None:
         if self._closed:
             return
         self._closed = True
+        for task in list(self._pending):
+            task.cancel()
+        self._unbind_metrics()
+        if memory.BUDGET is not None:
+            memory.BUDGET.drop(self)
+        if trace.TRACE is not None and self.connected_peer_id is not None:
+            trace.TRACE.record(self.connected_peer_id, 'in', 'disconnect')
         try:
             self._w.close()
             logger.info(f"has closed the connection to peer [{self.connected_peer_id}]")
         except OSError as e:
             logger.warning(f'Error while closing writer: {e}')
+        if self._cb is None:
+            return
         try:
             self._cb.on_disconnect()
         except (AttributeError, RuntimeError, TypeError) as e:
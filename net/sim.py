@@ -0,0 +1,185 @@
+import heapq
+import random
+from collections import deque
+from typing import Callable, Optional
+
+from logic.callbacks import LogicCallbacks, WireCommands
+from net.codec import enc_peer_exchange, enc_piece_ref
+
+# Wire sizes of each frame (4B length + 1B type + payload) so simulated links see real byte counts
+_CTRL = 5
+_INDEXED = 9
+
+
+class VirtualClock:
+    """Discrete-event scheduler. Events at equal times run in scheduling order, so runs are deterministic."""
+
+    def __init__(self):
+        self.now = 0.0
+        self._heap: list[tuple[float, int, Callable, tuple]] = []
+        self._seq = 0
+        self.events_run = 0
+
+    def call_at(self, when: float, fn: Callable, *args) -> None:
+        self._seq += 1
+        heapq.heappush(self._heap, (max(when, self.now), self._seq, fn, args))
+
+    def call_later(self, delay: float, fn: Callable, *args) -> None:
+        self.call_at(self.now + delay, fn, *args)
+
+    def call_every(self, interval: float, fn: Callable, first: Optional[float] = None) -> None:
+        def tick() -> None:
+            fn()
+            self.call_later(interval, tick)
+        self.call_at(self.now + interval if first is None else first, tick)
+
+    def run(self, until: float = float('inf'), stop: Callable[[], bool] = lambda: False) -> None:
+        while self._heap and not stop():
+            when, _, fn, args = self._heap[0]
+            if when > until:
+                break
+            heapq.heappop(self._heap)
+            self.now = when
+            fn(*args)
+            self.events_run += 1
+
+
+class SimHost:
+    """A simulated machine: one uplink of `bandwidth` bytes/s shared by every connection it opens."""
+
+    def __init__(self, clock: VirtualClock, bandwidth: float):
+        self.clock = clock
+        self.bandwidth = float(bandwidth)
+        self._uplink_free_at = 0.0
+        self.bytes_sent = 0
+
+    def transmit(self, n_bytes: int) -> float:
+        start = max(self.clock.now, self._uplink_free_at)
+        self._uplink_free_at = start + n_bytes / self.bandwidth
+        self.bytes_sent += n_bytes
+        return self._uplink_free_at
+
+
+class SimWire(WireCommands):
+    """
+    One direction of a simulated TCP connection, delivering into the remote
+    LogicCallbacks. The stream is reliable and ordered like TCP: a lost segment
+    costs a retransmission timeout instead of dropping the message.
+    """
+    # every simulated node runs the same code, so negotiable extensions are on; nodes decide whether to use them.
+    # Local pieces need a shared disk and peer exchange a Membership, neither of which the simulator builds, so
+    # those stay off unless a caller turns them on for a wire.
+    allowed_fast = True
+    local_pieces = False
+    peer_exchange = False
+
+    def __init__(self, clock: VirtualClock, host: SimHost, remote: LogicCallbacks, latency: float,
+                 loss: float = 0.0, rng: Optional[random.Random] = None, rto: float = 0.2):
+        self.clock = clock
+        self.host = host
+        self.remote = remote
+        self.latency = latency
+        self.loss = loss
+        self.rng = rng or random.Random(0)
+        self.rto = max(rto, 2 * latency)
+        self.peer: Optional['SimWire'] = None
+        self.rtt = 2 * latency
+        self.bytes_sent = 0
+        self._last_delivery = 0.0
+        self._closed = False
+        self._unsent: deque[tuple[float, int]] = deque()  # (time the uplink finishes a frame, its size)
+        self._unsent_bytes = 0
+
+    @property
+    def write_buffer_size(self) -> int:
+        """Bytes handed to this wire that the host's uplink has not finished sending, like a transport buffer."""
+        while self._unsent and self._unsent[0][0] <= self.clock.now:
+            self._unsent_bytes -= self._unsent.popleft()[1]
+        return self._unsent_bytes
+
+    def _deliver(self, n_bytes: int, fn: Callable, *args) -> None:
+        if self._closed:
+            return
+        self.bytes_sent += n_bytes
+        sent_at = self.host.transmit(n_bytes)
+        self._unsent.append((sent_at, n_bytes))
+        self._unsent_bytes += n_bytes
+        at = sent_at + self.latency
+        while self.loss and self.rng.random() < self.loss:
+            at += self.rto
+        at = max(at, self._last_delivery)
+        self._last_delivery = at
+        self.clock.call_at(at, self._fire, fn, args)
+
+    def _fire(self, fn: Callable, args: tuple) -> None:
+        if not self._closed:
+            fn(*args)
+
+    def send_handshake(self, peer_id: int) -> None:
+        self._deliver(32, self.remote.on_handshake, peer_id)
+
+    def send_choke(self) -> None:
+        self._deliver(_CTRL, self.remote.on_choke)
+
+    def send_unchoke(self) -> None:
+        self._deliver(_CTRL, self.remote.on_unchoke)
+
+    def send_interested(self) -> None:
+        self._deliver(_CTRL, self.remote.on_interested)
+
+    def send_not_interested(self) -> None:
+        self._deliver(_CTRL, self.remote.on_not_interested)
+
+    def send_have(self, index: int) -> None:
+        self._deliver(_INDEXED, self.remote.on_have, index)
+
+    def send_bitfield(self, bits: bytes) -> None:
+        self._deliver(_CTRL + len(bits), self.remote.on_bitfield, bytes(bits))
+
+    def send_have_all(self) -> None:
+        self._deliver(_CTRL, self.remote.on_have_all)
+
+    def send_have_none(self) -> None:
+        self._deliver(_CTRL, self.remote.on_have_none)
+
+    def send_request(self, index: int) -> None:
+        self._deliver(_INDEXED, self.remote.on_request, index)
+
+    def send_piece(self, index: int, data: bytes) -> None:
+        self._deliver(_INDEXED + len(data), self.remote.on_piece, index, data)
+
+    def send_piece_ref(self, index: int, path: str) -> None:
+        self._deliver(_CTRL + len(enc_piece_ref(index, path)), self.remote.on_piece_ref, index, path)
+
+    def send_peer_exchange(self, entries: list[tuple[bool, int, str, int]]) -> None:
+        entries = list(entries)
+        self._deliver(_CTRL + len(enc_peer_exchange(entries)), self.remote.on_peer_exchange, entries)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self.clock.call_later(self.latency, self.remote.on_disconnect)
+        if self.peer is not None:
+            self.peer.close()
+
+
+def connect_pair(clock: VirtualClock,
+                 a_host: SimHost, a_logic: LogicCallbacks, a_id: int,
+                 b_host: SimHost, b_logic: LogicCallbacks, b_id: int,
+                 latency: float, loss: float = 0.0, rng: Optional[random.Random] = None) -> tuple[SimWire, SimWire]:
+    """Wire two logic objects together (a dials b) and exchange handshakes, as Connector + PeerConnection would."""
+    a_to_b = SimWire(clock, a_host, b_logic, latency, loss, rng)
+    b_to_a = SimWire(clock, b_host, a_logic, latency, loss, rng)
+    a_to_b.peer, b_to_a.peer = b_to_a, a_to_b
+    for logic, outbound in ((a_logic, True), (b_logic, False)):
+        if hasattr(logic, 'mark_outbound'):
+            logic.mark_outbound(outbound)
+    # each side's wire is the one carrying its frames to the other side
+    if hasattr(a_logic, 'set_wire'):
+        a_logic.set_wire(a_to_b)
+    if hasattr(b_logic, 'set_wire'):
+        b_logic.set_wire(b_to_a)
+    a_to_b.send_handshake(a_id)
+    b_to_a.send_handshake(b_id)
+    return a_to_b, b_to_a
@@ -0,0 +1,47 @@
+import logging
+import socket
+import struct
+from dataclasses import dataclass
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SocketOptions:
+    # Control frames are 5-9 bytes; without TCP_NODELAY they can sit behind Nagle for a full RTT
+    nodelay: bool = True
+    # None keeps the kernel default (and its autotuning); PIECE frames can be several MiB
+    sndbuf: Optional[int] = None
+    rcvbuf: Optional[int] = None
+
+    def apply(self, sock: Optional[socket.socket]) -> None:
+        if sock is None:
+            return
+        try:
+            if sock.family in (socket.AF_INET, socket.AF_INET6):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.nodelay))
+            if self.sndbuf is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, int(self.sndbuf))
+            if self.rcvbuf is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(self.rcvbuf))
+        except OSError as e:
+            logger.warning(f'Failed to apply socket options {self}: {e}')
+
+
+# offset of tcpi_rtt (microseconds) in Linux's struct tcp_info
+_TCPI_RTT_OFFSET = 68
+
+
+def tcp_rtt(sock: Optional[socket.socket]) -> Optional[float]:
+    """The kernel's smoothed RTT for a TCP socket in seconds, where the platform exposes TCP_INFO."""
+    if sock is None or not hasattr(socket, 'TCP_INFO') or sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, _TCPI_RTT_OFFSET + 4)
+    except OSError:
+        return None
+    if len(info) < _TCPI_RTT_OFFSET + 4:
+        return None
+    (usec,) = struct.unpack_from('I', info, _TCPI_RTT_OFFSET)
+    return usec / 1e6 if usec else None
@@ -0,0 +1,80 @@
+import json
+import struct
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+from .codec import dec_compact_bitfield, dec_peer_exchange
+from .constants import MessageType
+
+_INDEXED = (MessageType.HAVE, MessageType.REQUEST, MessageType.PIECE, MessageType.COMPRESSED_PIECE,
+            MessageType.PIECE_REF)
+
+
+class EventTrace:
+    """
+    NDJSON trace of protocol events, one object per line:
+
+        {"t": 1.234567, "peer": 1002, "dir": "in", "ev": "piece", "index": 7, "size": 16384}
+
+    The first line is {"ev": "meta", ...} with the node configuration, which the
+    replay tool (bench/replay.py) needs to rebuild the PeerNode.
+    """
+
+    def __init__(self, path: str | Path, meta: dict):
+        self.path = Path(path)
+        self._f = self.path.open('w', encoding='utf-8', buffering=1 << 20)
+        self._t0 = time.monotonic()
+        self._dumps = json.JSONEncoder(separators=(',', ':')).encode
+        self._f.write(self._dumps({'ev': 'meta', **meta}) + '\n')
+
+    def record(self, peer: Optional[int], direction: str, ev: str, **fields) -> None:
+        entry = {'t': round(time.monotonic() - self._t0, 6), 'peer': peer, 'dir': direction, 'ev': ev}
+        entry.update(fields)
+        self._f.write(self._dumps(entry) + '\n')
+
+    def record_frame(self, peer: Optional[int], direction: str, mtype: MessageType, payload: bytes) -> None:
+        if mtype in _INDEXED and len(payload) >= 4:
+            (index,) = struct.unpack_from('>I', payload)
+            if mtype == MessageType.PIECE:
+                self.record(peer, direction, 'piece', index=index, size=len(payload) - 4)
+            elif mtype == MessageType.COMPRESSED_PIECE:
+                self.record(peer, direction, 'compressed_piece', index=index, size=len(payload) - 5)
+            else:
+                self.record(peer, direction, mtype.name.lower(), index=index)
+        elif mtype == MessageType.BITFIELD:
+            self.record(peer, direction, 'bitfield', bits=bytes(payload).hex())
+        elif mtype == MessageType.COMPACT_BITFIELD:
+            # stored dense so replay does not depend on the encoding that happened to win
+            self.record(peer, direction, 'bitfield', bits=dec_compact_bitfield(payload).hex())
+        elif mtype == MessageType.PEER_EXCHANGE:
+            self.record(peer, direction, 'peer_exchange', entries=[list(e) for e in dec_peer_exchange(payload)])
+        else:
+            self.record(peer, direction, mtype.name.lower())
+
+    def close(self) -> None:
+        self._f.close()
+
+
+# Set by open_trace(); PeerConnection records events only when this is not None
+TRACE: Optional[EventTrace] = None
+
+
+def open_trace(path: str | Path, meta: dict) -> EventTrace:
+    global TRACE
+    TRACE = EventTrace(path, meta)
+    return TRACE
+
+
+def close_trace() -> None:
+    global TRACE
+    if TRACE is not None:
+        TRACE.close()
+        TRACE = None
+
+
+def read_trace(path: str | Path) -> Iterator[dict]:
+    with Path(path).open('r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
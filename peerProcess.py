@@ -1,42 +1,423 @@
 #!/usr/bin/env python3
 import argparse
 import asyncio
+import multiprocessing
 import os
+import signal
+import sys
 from pathlib import Path
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 from util.logging_config import configure_logging
 
 from net.connector import Connector
+from net.constants import EXT_COMPACT_BITFIELD, EXT_PEER_EXCHANGE, EXT_KEEPALIVE, EXT_ALLOWED_FAST
+from net.compression import codec_flags, codec_names
+from net.socket_options import SocketOptions
+from net.trace import open_trace, close_trace
+from logic.choking_manager import Proximity
+from logic.delta import reuse_previous
+from logic.membership import Membership
 from logic.peer_node import PeerNode
+from logic.piece_store import PieceStore
+from logic.session import Session
+from logic.shared_state import SharedSwarmState
+from logic.streaming import StreamReader
 from util.config import CommonConfig, PeerInfoTable, PeerRow
+from util.manifest import Manifest, iter_pieces
+from util.memory import set_budget
+from util.event_loop import LOOP_CHOICES, install_event_loop
+from util.metrics import serve_metrics, run_snapshot_loop, run_loop_lag_monitor
+from util.profiling import ProfilingSession
 import contextlib
 
+logger = logging.getLogger(__name__)
 
-async def main() -> None:
-    peer_id = get_peer_id()
+
+async def main(args: argparse.Namespace) -> None:
+    peer_id = args.peer_id
     configure_logging(peer_id, to_console=True, log_dir=".")
 
-    common, peers, me = load_configs(peer_id)
+    common, peers, me = load_configs(peer_id, args.listen)
     work_dir, data_dir, start_full = await prepare_directories(peer_id, common, me)
-    node = build_node(common, peers, data_dir, start_full, peer_id)
-    connector = build_connector(me, peer_id, node)
-    await run_network(node, connector, peers)
+    manifest = load_manifest(args, common, work_dir, start_full)
+    store = None
+    if args.previous and not start_full:
+        store = PieceStore(common.total_pieces, common.piece_size, common.last_piece_size, str(data_dir))
+        reuse_previous(store, manifest, args.previous)
+    node = build_node(common, peers, data_dir, start_full, peer_id,
+                      membership=build_membership(peers, me, args.member_timeout), super_seed=args.super_seed,
+                      proximity=proximity_from_args(args, peers, me), exploration=args.explore,
+                      allowed_fast=args.allowed_fast, stream_window=args.stream_window,
+                      manifest=manifest, store=store, dedup=args.dedup, batch_interval=args.batch_interval,
+                      upload_buffer=args.upload_buffer, upload_queue=args.upload_queue)
+    connector = build_connector(me, peer_id, node, sock_opts=socket_options_from_args(args),
+                                extensions=extensions_from_args(args), idle_timeout=idle_timeout_from_args(args),
+                                unix_dir=args.unix_dir)
+    services = start_services(args)
+    if args.trace:
+        open_trace(f"trace_peer_{peer_id}.ndjson", trace_meta(common, peers, peer_id, start_full))
+    stream = asyncio.create_task(stream_to_file(node, args.stream_out)) if args.stream_out else None
+    try:
+        await run_network(node, connector, peers, stream=stream)
+    finally:
+        await stop_services(services)
+        close_trace()
 
 
-def get_peer_id() -> int:
+def parse_args() -> argparse.Namespace:
     ap = argparse.ArgumentParser()
     ap.add_argument("peer_id", type=int)
+    ap.add_argument("--workers", type=int, default=1,
+                    help="number of worker processes sharing the listening port (SO_REUSEPORT)")
+    ap.add_argument("--loop", choices=LOOP_CHOICES, default="auto",
+                    help="event loop implementation; 'auto' uses uvloop when installed")
+    ap.add_argument("--no-nodelay", dest="nodelay", action="store_false",
+                    help="leave Nagle's algorithm enabled on peer sockets")
+    ap.add_argument("--sndbuf", type=int, default=None, help="SO_SNDBUF in bytes for peer sockets")
+    ap.add_argument("--rcvbuf", type=int, default=None, help="SO_RCVBUF in bytes for peer sockets")
+    ap.add_argument("--metrics-port", type=int, default=None,
+                    help="serve Prometheus metrics over HTTP on 127.0.0.1:PORT (PORT+i for worker i)")
+    ap.add_argument("--metrics-socket", type=str, default=None,
+                    help="serve Prometheus metrics on this Unix socket path")
+    ap.add_argument("--metrics-file", type=str, default=None,
+                    help="periodically write a JSON metrics snapshot to this file")
+    ap.add_argument("--metrics-interval", type=float, default=5.0, help="seconds between metrics snapshots")
+    ap.add_argument("--profile", action="store_true",
+                    help="time protocol handlers, watch for loop stalls and capture a cProfile window; "
+                         "reports are written next to the log")
+    ap.add_argument("--profile-delay", type=float, default=0.0, help="seconds to wait before profiling")
+    ap.add_argument("--profile-window", type=float, default=30.0, help="length of the cProfile capture")
+    ap.add_argument("--block-threshold", type=float, default=0.1,
+                    help="report callbacks that block the event loop longer than this many seconds")
+    ap.add_argument("--compact-bitfield", action="store_true",
+                    help="offer the compact bitfield extension (HAVE_ALL/HAVE_NONE, run-length/sparse bitfields)")
+    ap.add_argument("--compress", choices=["off", "auto", *codec_names()], default="off",
+                    help="offer PIECE compression; 'auto' offers every installed codec (zlib, lz4, zstd)")
+    ap.add_argument("--trace", action="store_true",
+                    help="record every protocol event to trace_peer_<id>.ndjson next to the log (see bench/replay.py)")
+    ap.add_argument("--files", nargs="+", metavar="CFG", default=None,
+                    help="serve several files from one process; each CFG is a Common.cfg-style file. "
+                         "A file is seeded when peer_<id>/<FileName> already exists")
+    ap.add_argument("--unchoke-slots", type=int, default=None,
+                    help="unchoke slots shared by all --files (default: the largest NumberOfPreferredNeighbors)")
+    ap.add_argument("--super-seed", action="store_true",
+                    help="when starting with the full file, hand out pieces one at a time so each is uploaded "
+                         "about once before the swarm has every piece")
+    ap.add_argument("--prefer-nearby", action="store_true",
+                    help="favor same-locality (PeerInfo.cfg fifth column) and low-RTT peers when unchoking")
+    ap.add_argument("--explore", type=float, default=0.25,
+                    help="with --prefer-nearby, fraction of preferred slots and optimistic picks left random")
+    ap.add_argument("--idle-timeout", type=float, default=0.0,
+                    help="send keepalives and close connections that stay silent this many seconds "
+                         "(e.g. 120); 0 disables")
+    ap.add_argument("--allowed-fast", type=int, default=0,
+                    help="pieces each peer may request while choked, so new peers start at once "
+                         "(e.g. 4); 0 disables")
+    ap.add_argument("--stream-window", type=int, default=0,
+                    help="fetch the next N missing pieces in file order before others (streaming); 0 keeps random order")
+    ap.add_argument("--stream-out", type=str, default=None, metavar="PATH",
+                    help="write the file to PATH (e.g. a FIFO) in order while it downloads; implies --stream-window 16")
+    ap.add_argument("--unix-dir", type=str, default=None, metavar="DIR",
+                    help="also listen on DIR/p2p-<port>.sock and reach peers on this host through theirs; "
+                         "pieces are then handed over as hard links instead of through the socket")
+    ap.add_argument("--manifest", type=str, default=None, metavar="PATH",
+                    help="piece hashes of this file version (see util/manifest.py); received pieces are checked "
+                         "against it. A seed writes it when PATH does not exist")
+    ap.add_argument("--previous", type=str, default=None, metavar="FILE",
+                    help="an older local version of the file; pieces it shares with --manifest are not downloaded")
+    ap.add_argument("--dedup", action="store_true",
+                    help="with --manifest, fetch each distinct piece content once and fill identical pieces locally")
+    ap.add_argument("--batch-interval", type=float, default=0.0,
+                    help="every this many seconds plan rarest-first requests across all unchoking neighbors "
+                         "(NumPy is used when installed); 0 keeps per-neighbor random picks")
+    ap.add_argument("--upload-buffer", type=int, default=0, metavar="BYTES",
+                    help="queue incoming requests per peer and serve them by weighted fair queuing, keeping at "
+                         "most this many unsent bytes in the sockets; 0 serves each request as it arrives")
+    ap.add_argument("--upload-queue", type=int, default=0, metavar="BYTES",
+                    help="with --upload-buffer, requests a peer may have queued; past it the peer is choked "
+                         "until its queue drains (default 8 pieces)")
+    ap.add_argument("--memory-limit", type=int, default=0, metavar="BYTES",
+                    help="budget for receive buffers and unsent socket data in each process; near it, reads "
+                         "pause between frames and uploads wait. Implies --upload-buffer of a quarter of it")
+    ap.add_argument("--peer-exchange", action="store_true",
+                    help="gossip swarm members joining and leaving, so peers missing from PeerInfo.cfg can join")
+    ap.add_argument("--listen", type=str, default=None, metavar="HOST:PORT",
+                    help="address to listen on when this peer is not in PeerInfo.cfg (joins through its rows)")
+    ap.add_argument("--member-timeout", type=float, default=0.0,
+                    help="drop peers we have not been connected to for this many seconds from the swarm, so "
+                         "completion no longer waits for them; 0 (default) waits for every member forever")
     args = ap.parse_args()
-    return args.peer_id
+    if args.files is not None and (args.workers > 1 or args.trace):
+        ap.error("--files cannot be combined with --workers or --trace")
+    if args.previous and not args.manifest:
+        ap.error("--previous needs --manifest")
+    if args.dedup and not args.manifest:
+        ap.error("--dedup needs --manifest")
+    if args.manifest and args.files is not None:
+        ap.error("--manifest cannot be combined with --files")
+    if args.prefer_nearby and args.files is not None:
+        # the session ranks (file, peer) pairs by upload alone, so proximity would never be consulted
+        ap.error("--prefer-nearby cannot be combined with --files")
+    if args.unix_dir and args.workers > 1:
+        ap.error("--unix-dir cannot be combined with --workers")
+    if args.workers > 1 and (args.member_timeout > 0 or args.peer_exchange):
+        # each worker sees only its shard of connections, so none of them can tell who left or joined
+        ap.error("--member-timeout and --peer-exchange cannot be combined with --workers")
+    if args.stream_out and (args.files is not None or args.workers > 1):
+        ap.error("--stream-out cannot be combined with --files or --workers")
+    if args.stream_out and args.stream_window == 0:
+        args.stream_window = 16
+    if args.memory_limit and not args.upload_buffer:
+        args.upload_buffer = args.memory_limit // 4
+    return args
+
+
+def socket_options_from_args(args: argparse.Namespace) -> SocketOptions:
+    return SocketOptions(nodelay=args.nodelay, sndbuf=args.sndbuf, rcvbuf=args.rcvbuf)
+
+
+def extensions_from_args(args: argparse.Namespace) -> int:
+    extensions = 0
+    if args.compact_bitfield:
+        extensions |= EXT_COMPACT_BITFIELD
+    if args.compress != "off":
+        extensions |= codec_flags(None if args.compress == "auto" else [args.compress])
+    if args.peer_exchange:
+        extensions |= EXT_PEER_EXCHANGE
+    if args.idle_timeout > 0:
+        extensions |= EXT_KEEPALIVE
+    if args.allowed_fast > 0:
+        extensions |= EXT_ALLOWED_FAST
+    return extensions
+
+
+def idle_timeout_from_args(args: argparse.Namespace) -> Optional[float]:
+    return args.idle_timeout if args.idle_timeout > 0 else None
+
+
+def proximity_from_args(args: argparse.Namespace, peers: PeerInfoTable, me: PeerRow) -> Optional[Proximity]:
+    if not args.prefer_nearby:
+        return None
+    return Proximity(me.locality, {r.peer_id: r.locality for r in peers.rows if r.locality is not None})
+
+
+def build_membership(peers: PeerInfoTable, me: PeerRow, timeout: float) -> Membership:
+    return Membership(me.peer_id, ((r.peer_id, r.host, r.port) for r in peers.rows),
+                      host=me.host, port=me.port, timeout=timeout or None)
+
+
+def start_services(args: argparse.Namespace, worker_index: Optional[int] = None) -> list[asyncio.Task]:
+    suffix = "" if worker_index is None else f".w{worker_index}"
+    tasks = []
+    if args.metrics_port is not None or args.metrics_socket is not None:
+        port = args.metrics_port + (worker_index or 0) if args.metrics_port is not None else None
+        unix_path = args.metrics_socket + suffix if args.metrics_socket is not None else None
+        tasks.append(asyncio.create_task(serve_metrics(port=port, unix_path=unix_path)))
+    if args.metrics_file is not None:
+        tasks.append(asyncio.create_task(run_snapshot_loop(args.metrics_file + suffix, args.metrics_interval)))
+    if tasks:
+        tasks.append(asyncio.create_task(run_loop_lag_monitor()))
+    if args.memory_limit:
+        tasks.append(asyncio.create_task(set_budget(args.memory_limit).run()))
+    if args.profile:
+        session = ProfilingSession(args.peer_id, log_dir=".", suffix=suffix, window=args.profile_window,
+                                   delay=args.profile_delay, block_threshold=args.block_threshold)
+        tasks.append(asyncio.create_task(session.run()))
+    return tasks
+
+
+def trace_meta(common: CommonConfig, peers: PeerInfoTable, peer_id: int, start_full: bool) -> dict:
+    return {
+        "self_id": peer_id,
+        "all_peers": [r.peer_id for r in peers.rows],
+        "start_full": start_full,
+        "total_pieces": common.total_pieces,
+        "piece_size": common.piece_size,
+        "last_piece_size": common.last_piece_size,
+        "k": common.num_preferred_neighbors,
+        "preferred_interval": common.unchoking_interval,
+        "optimistic_interval": common.optimistic_unchoking_interval,
+        "file_name": common.file_name,
+    }
+
+
+async def stop_services(tasks: list[asyncio.Task]) -> None:
+    for t in tasks:
+        t.cancel()
+    for t in tasks:
+        with contextlib.suppress(asyncio.CancelledError):
+            await t
+
+
+async def run_session(args: argparse.Namespace) -> None:
+    peer_id = args.peer_id
+    configure_logging(peer_id, to_console=True, log_dir=".")
+
+    peers = PeerInfoTable.from_file("PeerInfo.cfg")
+    me = find_self(peers, peer_id, args.listen)
+    commons = [CommonConfig.from_file(path) for path in args.files]
+    slots = args.unchoke_slots if args.unchoke_slots is not None else max(c.num_preferred_neighbors for c in commons)
+    session = Session(slots, min(c.unchoking_interval for c in commons),
+                      min(c.optimistic_unchoking_interval for c in commons))
 
+    work_dir = Path.cwd() / f"peer_{peer_id}"
+    for common in commons:
+        data_dir = work_dir / f"pieces_{common.content_id.hex()}"
+        data_dir.mkdir(parents=True, exist_ok=True)
+        start_full = (work_dir / common.file_name).exists()
+        if start_full:
+            await ensure_seed_has_pieces(work_dir, common, peer_id, data_dir)
+        session.add(common.content_id, build_node(common, peers, data_dir, start_full, peer_id,
+                                                  membership=build_membership(peers, me, args.member_timeout),
+                                                  super_seed=args.super_seed,
+                                                  allowed_fast=args.allowed_fast,
+                                                  stream_window=args.stream_window,
+                                                  upload_buffer=args.upload_buffer,
+                                                  upload_queue=args.upload_queue))
 
-def load_configs(peer_id: int) -> tuple[CommonConfig, PeerInfoTable, PeerRow]:
+    connector = Connector(
+        me.host,
+        me.port,
+        local_peer_id=peer_id,
+        router=session.route,
+        idle_timeout=idle_timeout_from_args(args),
+        socket_options=socket_options_from_args(args),
+        extensions=extensions_from_args(args),
+        unix_dir=args.unix_dir,
+    )
+    services = start_services(args)
+    _ = asyncio.create_task(connector.serve())
+    for content_id, node in session.nodes.items():
+        node.dial = dialer(connector, content_id)
+        services.append(asyncio.create_task(node.run_membership_loop()))
+        for row in peers.earlier_peers(peer_id):
+            _ = asyncio.create_task(connector.connect_with_retry(row.host, row.port, content_id=content_id))
+
+    choke_task = asyncio.create_task(session.run_choking_loops())
+    try:
+        await session.wait_until_all_complete()
+    finally:
+        choke_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await choke_task
+        for node in session.nodes.values():
+            node.leave_swarm()
+            if node.is_complete():
+                node.store.reconstruct_full_file(node.file_name)
+                node.store.cleanup_pieces()
+        await connector.close_all()
+        await stop_services(services)
+
+
+def run_sharded(args: argparse.Namespace) -> None:
+    peer_id = args.peer_id
+    configure_logging(peer_id, to_console=True, log_dir=".")
+
+    common, peers, me = load_configs(peer_id, args.listen)
+    work_dir, data_dir, start_full = asyncio.run(prepare_directories(peer_id, common, me))
+    manifest = load_manifest(args, common, work_dir, start_full)
+    shared = SharedSwarmState.create(common.total_pieces, [r.peer_id for r in peers.rows], start_full)
+    try:
+        if args.previous and not start_full:
+            reuse_previous(PieceStore(common.total_pieces, common.piece_size, common.last_piece_size,
+                                      str(data_dir), bits=shared.pieces), manifest, args.previous)
+        procs = [multiprocessing.Process(target=run_worker, args=(args, i, shared),
+                                         name=f"peer-{peer_id}-worker-{i}")
+                 for i in range(args.workers)]
+        # SIGTERM unwinds through the finally below instead of leaving the workers running
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        try:
+            for p in procs:
+                p.start()
+            for p in procs:
+                p.join()
+        finally:
+            for p in procs:
+                if p.is_alive():
+                    p.terminate()
+            for p in procs:
+                if p.pid is not None:
+                    p.join()
+
+        store = PieceStore(common.total_pieces, common.piece_size, common.last_piece_size, str(data_dir),
+                           bits=shared.pieces)
+        store.reconstruct_full_file(common.file_name)
+        store.cleanup_pieces()
+    finally:
+        shared.close()
+
+
+def run_worker(args: argparse.Namespace, worker_index: int, shared: SharedSwarmState) -> None:
+    with contextlib.suppress(asyncio.CancelledError):
+        asyncio.run(worker_main(args, worker_index, shared))
+
+
+async def exit_with_parent(task: asyncio.Task, interval: float = 1.0) -> None:
+    # a SIGKILLed parent cannot stop its workers, so each worker watches for it
+    parent = multiprocessing.parent_process()
+    while parent is not None and parent.is_alive():
+        await asyncio.sleep(interval)
+    task.cancel()
+
+
+async def worker_main(args: argparse.Namespace, worker_index: int, shared: SharedSwarmState) -> None:
+    peer_id = args.peer_id
+    configure_logging(peer_id, to_console=True, log_dir=".")
+
+    common, peers, me = load_configs(peer_id, args.listen)
+    data_dir = Path.cwd() / f"peer_{peer_id}" / "pieces"
+    node = build_node(common, peers, data_dir, me.has_file == 1, peer_id,
+                      shared=shared, worker_index=worker_index, super_seed=args.super_seed,
+                      proximity=proximity_from_args(args, peers, me), exploration=args.explore,
+                      allowed_fast=args.allowed_fast, stream_window=args.stream_window,
+                      manifest=Manifest.load(args.manifest) if args.manifest else None, dedup=args.dedup,
+                      batch_interval=args.batch_interval, upload_buffer=args.upload_buffer,
+                      upload_queue=args.upload_queue)
+    connector = build_connector(me, peer_id, node, reuse_port=True, sock_opts=socket_options_from_args(args),
+                                extensions=extensions_from_args(args), idle_timeout=idle_timeout_from_args(args))
+    services = start_services(args, worker_index)
+    services.append(asyncio.create_task(node.run_shard_sync()))
+    services.append(asyncio.create_task(exit_with_parent(asyncio.current_task())))
+    if args.trace:
+        open_trace(f"trace_peer_{peer_id}.w{worker_index}.ndjson",
+                   trace_meta(common, peers, peer_id, me.has_file == 1))
+    try:
+        await run_network(node, connector, peers, shard=(worker_index, args.workers), finalize=False)
+    finally:
+        await stop_services(services)
+        close_trace()
+
+
+def load_configs(peer_id: int, listen: Optional[str] = None) -> tuple[CommonConfig, PeerInfoTable, PeerRow]:
     common = CommonConfig.from_file("Common.cfg")
     peers = PeerInfoTable.from_file("PeerInfo.cfg")
-    me = peers.get(peer_id)
+    me = find_self(peers, peer_id, listen)
     return common, peers, me
 
 
+def find_self(peers: PeerInfoTable, peer_id: int, listen: Optional[str] = None) -> PeerRow:
+    if peer_id in peers.by_id:
+        return peers.get(peer_id)
+    if listen is None:
+        raise ValueError(f"peer {peer_id} is not in PeerInfo.cfg; pass --listen HOST:PORT to join the swarm")
+    host, _, port = listen.rpartition(":")
+    return PeerRow(peer_id, host or "127.0.0.1", int(port), 0)
+
+
+def load_manifest(args: argparse.Namespace, common, work_dir: Path, start_full: bool) -> Optional[Manifest]:
+    """The --manifest of this version; a seed writes it from its copy when the file does not exist yet."""
+    if not args.manifest:
+        return None
+    path = Path(args.manifest)
+    if not path.exists() and start_full:
+        Manifest.build(work_dir / common.file_name, common.piece_size).save(path)
+    manifest = Manifest.load(path)
+    manifest.check(common)
+    return manifest
+
+
 async def prepare_directories(peer_id: int, common, me) -> tuple[Path, Path, bool]:
     work_dir = Path.cwd() / f"peer_{peer_id}"
     data_dir = work_dir / "pieces"
@@ -48,23 +429,30 @@ async def prepare_directories(peer_id: int, common, me) -> tuple[Path, Path, boo
     return work_dir, data_dir, start_full
 
 
-async def ensure_seed_has_pieces(work_dir: Path, common, peer_id: int) -> None:
+async def ensure_seed_has_pieces(work_dir: Path, common, peer_id: int, data_dir: Optional[Path] = None) -> None:
     src = work_dir / common.file_name
     if not src.exists():
         raise FileNotFoundError(f"Seed peer {peer_id} missing source file: {src}")
 
-    pieces = list((work_dir / "pieces").glob("piece_*.bin"))
+    data_dir = data_dir if data_dir is not None else work_dir / "pieces"
+    pieces = list(data_dir.glob("piece_*.bin"))
     if len(pieces) != common.total_pieces:
         await slice_into_pieces(
             src,
-            work_dir / "pieces",
+            data_dir,
             common.piece_size,
             common.total_pieces,
             common.last_piece_size,
         )
 
 
-def build_node(common, peers, data_dir, start_full, peer_id: int) -> PeerNode:
+def build_node(common, peers, data_dir, start_full, peer_id: int,
+               shared: Optional[SharedSwarmState] = None, worker_index: int = 0,
+               membership: Optional[Membership] = None, super_seed: bool = False,
+               proximity: Optional[Proximity] = None, exploration: float = 0.0,
+               allowed_fast: int = 0, stream_window: int = 0, manifest: Optional[Manifest] = None,
+               store: Optional[PieceStore] = None, dedup: bool = False,
+               batch_interval: float = 0.0, upload_buffer: int = 0, upload_queue: int = 0) -> PeerNode:
     return PeerNode(
         total_pieces=common.total_pieces,
         piece_size=common.piece_size,
@@ -77,49 +465,137 @@ def build_node(common, peers, data_dir, start_full, peer_id: int) -> PeerNode:
         self_id=peer_id,
         all_peer_ids={r.peer_id for r in peers.rows},
         file_name=common.file_name,
+        shared=shared,
+        worker_index=worker_index,
+        membership=membership,
+        super_seed=super_seed,
+        proximity=proximity,
+        exploration=exploration,
+        allowed_fast=allowed_fast,
+        stream_window=stream_window,
+        manifest=manifest,
+        store=store,
+        dedup=dedup,
+        batch_interval=batch_interval,
+        upload_buffer=upload_buffer,
+        upload_queue=upload_queue,
     )
 
 
-def build_connector(me, peer_id: int, node: PeerNode) -> Connector:
+def build_connector(me, peer_id: int, node: PeerNode, reuse_port: bool = False,
+                    sock_opts: Optional[SocketOptions] = None, extensions: int = 0,
+                    idle_timeout: Optional[float] = None, unix_dir: Optional[str] = None) -> Connector:
     connector = Connector(
         me.host,
         me.port,
         local_peer_id=peer_id,
         logic_factory=node.make_callbacks,
+        idle_timeout=idle_timeout,
+        reuse_port=reuse_port,
+        socket_options=sock_opts,
+        extensions=extensions,
+        unix_dir=unix_dir,
     )
     node.connector = connector
     return connector
 
 
-async def run_network(node: PeerNode, connector: Connector, peers) -> None:
+def dialer(connector: Connector, content_id: Optional[bytes] = None):
+    def dial(host: str, port: int) -> None:
+        if content_id is None:
+            _ = asyncio.create_task(connector.connect_with_retry(host, port))
+        else:
+            _ = asyncio.create_task(connector.connect_with_retry(host, port, content_id=content_id))
+    return dial
+
+
+async def stream_to_file(node: PeerNode, path: str, chunk: int = 1 << 20) -> None:
+    """
+    Writes the file to `path` in order while it downloads. The file is opened, written and closed on one
+    worker thread, in that order, so a slow reader at the other end of a FIFO or pipe holds up the stream
+    but not the event loop. Write errors, such as the reader going away, end the stream but not the download.
+    """
+    loop = asyncio.get_running_loop()
+    io = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stream-out')
+    reader = StreamReader(node)
+    out = None
+    try:
+        # opening a FIFO waits until something opens it for reading
+        out = await loop.run_in_executor(io, open, path, "wb")
+        while data := await reader.read(chunk):
+            await loop.run_in_executor(io, write_and_flush, out, data)
+    except OSError as e:
+        logger.error(f'stops streaming to {path}: {e}')
+    finally:
+        if out is not None:
+            io.submit(out.close)
+        io.shutdown(wait=False)
+
+
+async def stop_stream(stream: asyncio.Task) -> None:
+    """Cancels the --stream-out task unless it already finished, and logs how it failed if it did."""
+    stream.cancel()
+    await asyncio.wait([stream])
+    if not stream.cancelled() and stream.exception() is not None:
+        e = stream.exception()
+        logger.error(f'streaming failed: {type(e).__name__}: {e}')
+
+
+def write_and_flush(out, data: bytes) -> None:
+    out.write(data)
+    out.flush()
+
+
+async def run_network(node: PeerNode, connector: Connector, peers,
+                      shard: tuple[int, int] = (0, 1), finalize: bool = True,
+                      stream: Optional[asyncio.Task] = None) -> None:
+    shard_index, shard_count = shard
     _ = asyncio.create_task(connector.serve())
-    for row in peers.earlier_peers(node.self_id):
+    for i, row in enumerate(peers.earlier_peers(node.self_id)):
+        if i % shard_count != shard_index:
+            continue
         _ = asyncio.create_task(connector.connect_with_retry(row.host, row.port))
 
+    node.dial = dialer(connector)
     choke_task = asyncio.create_task(node.run_choking_loops())
+    member_task = asyncio.create_task(node.run_membership_loop())
     try:
         await node.wait_until_all_complete()
+        if stream is not None:
+            # the stream reads piece files, so it has to finish before they are merged and removed
+            await asyncio.wait([stream])
     finally:
-        choke_task.cancel()
-        with contextlib.suppress(asyncio.CancelledError):
-            await choke_task
-        node.store.reconstruct_full_file(node.file_name)
-        node.store.cleanup_pieces()
+        for t in (choke_task, member_task):
+            t.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await t
+        if stream is not None:
+            await stop_stream(stream)
+        node.leave_swarm()
+        if finalize:
+            node.store.reconstruct_full_file(node.file_name)
+            node.store.cleanup_pieces()
         await connector.close_all()
 
 
 async def slice_into_pieces(src_path: Path, out_dir: Path, piece_size: int, total_pieces: int,
                             last_piece_size: int) -> None:
-    data = src_path.read_bytes()
-    offset = 0
+    # one piece in memory at a time, however large the file
+    chunks = iter_pieces(src_path, piece_size)
     for i in range(total_pieces):
         size = last_piece_size if i == total_pieces - 1 else piece_size
-        chunk = data[offset: offset + size]
+        chunk = next(chunks, b'')[:size]
         if len(chunk) != size:
             raise ValueError(f'Source file too small for piece {i} (expected {size}, got {len(chunk)})')
         (out_dir / f'piece_{i:06d}.bin').write_bytes(chunk)
-        offset += size
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    args = parse_args()
+    install_event_loop(args.loop)
+    if args.files is not None:
+        asyncio.run(run_session(args))
+    elif args.workers > 1:
+        run_sharded(args)
+    else:
+        asyncio.run(main(args))
@@ -0,0 +1,38 @@
+import pytest
+
+from logic.allowed_fast import allowed_fast_set
+from logic.peer_node import PeerNode
+from logic.piece_store import MemoryPieceStore
+
+
+def test_same_inputs_same_set():
+    assert allowed_fast_set(1002, 500, 4, b'f:500') == allowed_fast_set(1002, 500, 4, b'f:500')
+    assert len(allowed_fast_set(1002, 500, 4, b'f:500')) == 4
+
+
+@pytest.mark.parametrize('other', [(1003, 500, 4, b'f:500'), (1002, 500, 4, b'g:500')])
+def test_peer_and_file_change_the_set(other):
+    assert allowed_fast_set(1002, 500, 4, b'f:500') != allowed_fast_set(*other)
+
+
+def test_count_capped_by_pieces():
+    assert allowed_fast_set(7, 3, 10) == frozenset({0, 1, 2})
+    assert allowed_fast_set(7, 100, 0) == frozenset()
+
+
+def test_a_larger_count_keeps_the_smaller_set():
+    assert allowed_fast_set(7, 1000, 4, b's') <= allowed_fast_set(7, 1000, 8, b's')
+
+
+def _node(self_id: int, pieces: int, k: int) -> PeerNode:
+    store = MemoryPieceStore(pieces, 1024, 1024, start_full=self_id == 1)
+    return PeerNode(pieces, 1024, 1024, '', self_id == 1, 1, 5, 15, self_id, {1, 2}, 'f', store=store,
+                    allowed_fast=k)
+
+
+@pytest.mark.parametrize('pieces,k', [(64, 4), (1000, 10), (3, 8)])
+def test_both_ends_derive_the_same_set(pieces, k):
+    uploader, requester = _node(1, pieces, k), _node(2, pieces, k)
+    # what the uploader lets peer 2 fetch while choked is what peer 2 asks for
+    assert uploader.fast_set(2) == requester.fast_set(requester.self_id)
+    assert len(uploader.fast_set(2)) == min(k, pieces)
@@ -0,0 +1,128 @@
+import random
+
+import pytest
+
+from logic import batch_scheduler
+from logic.bitfield import Bitfield
+from logic.callbacks import LogicCallbacks
+from logic.peer_node import PeerNode
+from logic.piece_store import MemoryPieceStore
+from net.sim import SimHost, SimWire, VirtualClock
+
+PIECES = 2048
+PIECE_SIZE = 1024
+
+BACKENDS = ['python']
+try:
+    import numpy
+    BACKENDS.append('numpy')
+except ImportError:
+    numpy = None
+
+
+class Quiet(LogicCallbacks):
+    def __getattr__(self, name):
+        return lambda *args: None
+
+
+def _bits(rng: random.Random, form: str) -> Bitfield:
+    if form == 'full':
+        return Bitfield.full(PIECES)
+    if form == 'sparse':
+        return Bitfield.from_bytes(PIECES, _packed(rng.sample(range(PIECES), 3)))
+    return Bitfield.from_bytes(PIECES, _packed(rng.sample(range(PIECES), PIECES // 3)))
+
+
+def _packed(indices) -> bytes:
+    out = bytearray((PIECES + 7) // 8)
+    for i in indices:
+        out[i >> 3] |= 0x80 >> (i & 7)
+    return bytes(out)
+
+
+def _swarm(seed: int) -> PeerNode:
+    """A node missing most pieces, with neighbors of every bitfield form; even peer ids unchoke us."""
+    rng = random.Random(seed)
+    store = MemoryPieceStore(PIECES, PIECE_SIZE, PIECE_SIZE)
+    forms = ['full', 'sparse', 'dense', 'dense', 'sparse', 'dense', 'full', 'dense']
+    node = PeerNode(PIECES, PIECE_SIZE, PIECE_SIZE, '', False, 3, 5, 15, 1, set(range(1, len(forms) + 2)), 'f',
+                    store=store, batch_interval=4.0)
+    for i in rng.sample(range(PIECES), PIECES // 4):
+        node.local_bits.set(i, True)
+    clock = VirtualClock()
+    for peer_id, form in enumerate(forms, start=2):
+        logic = node.make_callbacks()
+        logic.set_wire(SimWire(clock, SimHost(clock, 1e6), Quiet(), 0.01))
+        logic.on_handshake(peer_id)
+        logic.on_bitfield(_bits(rng, form).to_bytes())
+        logic.they_choke_us = peer_id % 2 == 1
+    for index in rng.sample(node.local_bits.missing_from(Bitfield.full(PIECES)), 5):
+        node.requests.mark_inflight(3, index)
+    return node
+
+
+def _use(monkeypatch, backend: str) -> None:
+    monkeypatch.setattr(batch_scheduler, 'np', numpy if backend == 'numpy' else None)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_plan_only_holds_pieces_the_neighbor_could_pick(monkeypatch, backend):
+    _use(monkeypatch, backend)
+    node = _swarm(1)
+    random.seed(0)
+    plan, depth = node.batch.plan()
+    assert plan and set(plan) <= {ns.peer_id for ns in node.neighbors() if not ns.logic.they_choke_us}
+    planned = [j for queue in plan.values() for j in queue]
+    assert len(planned) == len(set(planned))
+    for peer_id, queue in plan.items():
+        logic = node.neighbor_logic(peer_id)
+        candidates = {i for i in range(PIECES) if not node.local_bits.get(i) and logic.their_bits.get(i)
+                      and i not in node.requests.inflight_peer_by_piece}
+        assert set(queue) <= candidates
+        assert depth.get(peer_id, 1) <= node.batch.max_outstanding
+    # RequestManager hands out the planned queue before picking at random
+    node.requests.planned = {p: list(q) for p, q in plan.items()}
+    node.requests.depth = depth
+    for peer_id, queue in plan.items():
+        logic = node.neighbor_logic(peer_id)
+        assert node.requests.choose_for_neighbor(peer_id, logic.their_bits, node.local_bits) == queue[0]
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_plan_takes_rarest_pieces_first(monkeypatch, backend):
+    _use(monkeypatch, backend)
+    node = _swarm(2)
+    random.seed(0)
+    plan, _ = node.batch.plan()
+    counts = batch_scheduler._counts_python([ns.logic.their_bits for ns in node.neighbors()], PIECES)
+    planned = {j for queue in plan.values() for j in queue}
+    skipped = [j for j in range(PIECES) if not node.local_bits.get(j) and j not in planned
+               and j not in node.requests.inflight_peer_by_piece]
+    checked = 0
+    # a needed piece is left out only when every neighbor holding it was already given rarer pieces
+    for j in skipped:
+        for peer_id, queue in plan.items():
+            if node.neighbor_logic(peer_id).their_bits.get(j):
+                assert max(counts[i] for i in queue) <= counts[j]
+                checked += 1
+    assert checked
+
+
+@pytest.mark.skipif(numpy is None, reason='NumPy is not installed')
+def test_backends_agree():
+    node = _swarm(3)
+    bitfields = [ns.logic.their_bits for ns in node.neighbors()]
+    naive = [sum(bits.get(j) for bits in bitfields) for j in range(PIECES)]
+    assert batch_scheduler._counts_python(bitfields, PIECES) == naive
+    assert batch_scheduler._counts_numpy(bitfields, PIECES) == naive
+    by_python = batch_scheduler._holders_python(bitfields, PIECES)
+    by_numpy = batch_scheduler._holders_numpy(bitfields, PIECES)
+    for j in range(PIECES):
+        assert by_python(j) == by_numpy(j) == [k for k, bits in enumerate(bitfields) if bits.get(j)]
+
+
+def test_plan_keeps_compact_bitfields_compact():
+    node = _swarm(4)
+    node.batch.plan()
+    kinds = {type(ns.logic.their_bits).__name__ for ns in node.neighbors()}
+    assert {'_FullBitfield', '_SparseBitfield'} <= kinds
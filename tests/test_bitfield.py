@@ -0,0 +1,101 @@
+import random
+
+import pytest
+
+from logic.bitfield import Bitfield
+from net.codec import dec_compact_bitfield, enc_compact_bitfield
+
+PIECES = 4096  # up to PIECES >> 9 == 8 pieces stay sparse
+SPARSE_LIMIT = PIECES >> 9
+
+
+def _dense(indices) -> Bitfield:
+    bits = Bitfield(PIECES)
+    for i in indices:
+        bits.set(i, True)
+    return bits
+
+
+def _forms() -> dict[str, Bitfield]:
+    rng = random.Random(0)
+    return {
+        'empty': Bitfield.empty(PIECES),
+        'sparse': Bitfield.from_bytes(PIECES, _dense(rng.sample(range(PIECES), 5)).to_bytes()),
+        'dense': Bitfield.from_bytes(PIECES, _dense(rng.sample(range(PIECES), PIECES // 2)).to_bytes()),
+        'full': Bitfield.full(PIECES),
+    }
+
+
+def _kind(bits: Bitfield) -> str:
+    return type(bits).__name__
+
+
+def test_forms_chosen_by_from_bytes():
+    forms = _forms()
+    assert _kind(forms['empty']) == _kind(forms['sparse']) == '_SparseBitfield'
+    assert _kind(forms['dense']) == 'Bitfield'
+    assert _kind(forms['full']) == '_FullBitfield'
+    assert _kind(Bitfield.from_bytes(PIECES, Bitfield.full(PIECES).to_bytes())) == '_FullBitfield'
+
+
+def test_empty_promotes_to_dense_past_the_sparse_limit():
+    bits = Bitfield.empty(PIECES)
+    held = list(range(0, 8 * (SPARSE_LIMIT + 1), 8))
+    for i in held[:-1]:
+        bits.set(i, True)
+    assert _kind(bits) == '_SparseBitfield' and bits.count() == SPARSE_LIMIT
+    bits.set(held[-1], True)
+    assert _kind(bits) == 'Bitfield'
+    assert bits.count() == len(held)
+    assert sorted(bits.indices()) == held
+    assert bits.to_bytes() == _dense(held).to_bytes()
+    bits.set(PIECES + 3, True)  # out of range is ignored in every form
+    assert bits.count() == len(held)
+
+
+def test_full_turns_dense_when_a_piece_is_cleared():
+    bits = Bitfield.full(PIECES)
+    bits.set(7, True)
+    assert _kind(bits) == '_FullBitfield'
+    bits.set(7, False)
+    assert _kind(bits) == 'Bitfield'
+    assert bits.count() == PIECES - 1
+    assert not bits.get(7) and bits.get(6) and bits.get(PIECES - 1)
+    assert bits.to_bytes() == _dense(i for i in range(PIECES) if i != 7).to_bytes()
+
+
+def test_last_byte_spare_bits_stay_clear():
+    n = 13
+    assert Bitfield.full(n).to_bytes() == b'\xff\xf8'
+    bits = Bitfield.full(n)
+    bits.set(0, False)
+    assert bits.to_bytes() == b'\x7f\xf8' and bits.count() == n - 1
+
+
+@pytest.mark.parametrize('name', ['empty', 'sparse', 'dense', 'full'])
+def test_each_form_matches_its_bytes(name):
+    bits = _forms()[name]
+    raw = bits.to_bytes()
+    reference = Bitfield(PIECES, raw)
+    assert bits.count() == reference.count()
+    assert sorted(bits.indices()) == sorted(reference.indices())
+    assert all(bits.get(i) == reference.get(i) for i in range(PIECES))
+    assert not bits.get(-1) and not bits.get(PIECES)
+
+
+@pytest.mark.parametrize('mine', ['empty', 'sparse', 'dense', 'full'])
+@pytest.mark.parametrize('theirs', ['empty', 'sparse', 'dense', 'full'])
+def test_missing_from_every_pair_of_forms(mine, theirs):
+    forms = _forms()
+    ours, other = forms[mine], forms[theirs]
+    expected = [i for i in range(PIECES) if other.get(i) and not ours.get(i)]
+    assert ours.missing_from(other) == expected
+
+
+@pytest.mark.parametrize('name', ['empty', 'sparse', 'dense', 'full'])
+def test_compact_encoding_round_trip(name):
+    bits = _forms()[name]
+    raw = dec_compact_bitfield(enc_compact_bitfield(bits.to_bytes()))
+    again = Bitfield.from_bytes(PIECES, raw)
+    assert raw == bits.to_bytes()
+    assert _kind(again) == _kind(bits)
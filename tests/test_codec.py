@@ -0,0 +1,26 @@
+import pytest
+
+from net.codec import BitfieldEncoding, dec_compact_bitfield, enc_compact_bitfield, enc_varint
+
+
+def _runs_payload(n_bytes: int, runs: list[int]) -> bytes:
+    out = bytearray((BitfieldEncoding.RUNS,))
+    enc_varint(n_bytes, out)
+    for run in runs:
+        enc_varint(run, out)
+    return bytes(out)
+
+
+def test_compact_bitfield_round_trip():
+    for bits in (b'\x00' * 8, b'\xff' * 8, b'\xf0\x0f' * 4, b'\x80' + b'\x00' * 7):
+        assert dec_compact_bitfield(enc_compact_bitfield(bits)) == bits
+
+
+def test_runs_decode():
+    assert dec_compact_bitfield(_runs_payload(2, [4, 8, 4])) == b'\x0f\xf0'
+
+
+@pytest.mark.parametrize('runs', [[1 << 62], [0, 1 << 62], [8, 9], [17]])
+def test_runs_past_the_end_rejected(runs):
+    with pytest.raises(ValueError, match='past the end'):
+        dec_compact_bitfield(_runs_payload(2, runs))
@@ -0,0 +1,57 @@
+import zlib
+
+from net.compression import CODECS, PieceCompressor, codec_flags, negotiate
+from net.constants import EXT_LZ4, EXT_ZLIB, EXT_ZSTD
+
+
+def test_negotiate_uses_only_codecs_both_sides_offer():
+    assert negotiate(0) is None
+    assert negotiate(EXT_ZLIB).name == 'zlib'
+    # a codec offered by one side only never survives the AND of the two handshakes
+    assert negotiate(EXT_ZLIB & EXT_ZSTD) is None
+    assert negotiate(codec_flags(['zlib']) & codec_flags(['lz4', 'zstd'])) is None
+
+
+def test_negotiate_prefers_faster_codecs():
+    both = codec_flags()
+    names = {c.name for c in CODECS.values()}
+    expected = next(n for n in ('zstd', 'lz4', 'zlib') if n in names)
+    assert negotiate(both).name == expected
+    assert negotiate(both & ~(EXT_ZSTD | EXT_LZ4)).name == 'zlib'
+
+
+def test_codec_flags_only_installed_codecs():
+    assert codec_flags(['zlib']) == EXT_ZLIB
+    assert codec_flags(['no-such-codec']) == 0
+
+
+def test_small_pieces_are_not_tried():
+    c = PieceCompressor(CODECS[1], min_size=512)
+    assert not c.should_try(511)
+    assert c.should_try(512)
+
+
+def test_incompressible_pieces_back_off_exponentially():
+    c = PieceCompressor(CODECS[1], max_skip=4)
+    skipped = []
+    for _ in range(4):
+        assert c.should_try(4096)
+        assert not c.accept(4096, 4096)
+        n = 0
+        while not c.should_try(4096):
+            n += 1
+        skipped.append(n)
+    assert skipped == [1, 2, 4, 4]
+
+
+def test_a_hit_resets_the_backoff():
+    c = PieceCompressor(CODECS[1])
+    for _ in range(3):
+        c.should_try(4096)
+        c.accept(4096, 4096)
+        while not c.should_try(4096):
+            pass
+    assert c.accept(4096, len(zlib.compress(bytes(4096))))
+    assert c.should_try(4096)
+    c.accept(4096, 4096)
+    assert not c.should_try(4096) and c.should_try(4096)  # back to skipping one
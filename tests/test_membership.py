@@ -0,0 +1,129 @@
+import asyncio
+
+from logic.membership import Membership
+from logic.peer_node import PeerNode
+from logic.piece_store import MemoryPieceStore
+
+PIECES = 8
+PIECE_SIZE = 1024
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class Wire:
+    """Records what the node sends; speaks peer exchange."""
+    peer_exchange = True
+
+    def __init__(self):
+        self.exchanged: list[list[tuple[bool, int, str, int]]] = []
+
+    def send_peer_exchange(self, entries) -> None:
+        self.exchanged.append(list(entries))
+
+    def __getattr__(self, name):
+        return lambda *args: None
+
+
+def _membership(clock: Clock, timeout=10.0, self_id: int = 1) -> Membership:
+    rows = [(1, 'h1', 6001), (2, 'h2', 6002), (3, 'h3', 6003)]
+    return Membership(self_id, rows, host=f'h{self_id}', port=6000 + self_id, timeout=timeout, clock=clock)
+
+
+def _node(membership: Membership) -> PeerNode:
+    store = MemoryPieceStore(PIECES, PIECE_SIZE, PIECE_SIZE, start_full=True)
+    return PeerNode(PIECES, PIECE_SIZE, PIECE_SIZE, '', True, 1, 5, 15, membership.self_id, membership.live_ids(),
+                    'f', store=store, membership=membership)
+
+
+def _connect(node: PeerNode, peer_id: int) -> Wire:
+    wire = Wire()
+    logic = node.make_callbacks()
+    logic.set_wire(wire)
+    logic.on_handshake(peer_id)
+    return wire
+
+
+def test_members_expire_only_after_the_timeout_without_a_connection():
+    clock = Clock()
+    m = _membership(clock)
+    m.connected(2)
+    clock.now = 5.0
+    m.disconnected(2)
+    assert m.live_ids() == {1, 2, 3}
+    clock.now = 11.0
+    assert m.expire() == [3]  # never connected since the start
+    clock.now = 14.0
+    m.connected(2)  # reconnected in time
+    clock.now = 30.0
+    assert m.expire() == []
+    m.disconnected(2)
+    clock.now = 39.0
+    assert m.expire() == []
+    clock.now = 41.0
+    assert m.expire() == [2]
+    assert m.live_ids() == {1}
+
+
+def test_no_timeout_never_expires():
+    clock = Clock()
+    m = _membership(clock, timeout=None)
+    m.disconnected(2)
+    clock.now = 1e9
+    assert m.expire() == [] and m.live_ids() == {1, 2, 3}
+
+
+def test_join_and_leave_report_news_only():
+    m = Membership.static(1, [1, 2])
+    assert m.join(4, 'h4', 6004)
+    assert not m.join(4, 'h4', 6004)
+    assert m.join(2, 'h2', 6002)  # address learned
+    assert m.address(2) == ('h2', 6002)
+    m.connected(2)
+    assert not m.leave(2)  # we are connected to it, so it is still here
+    assert m.leave(4) and not m.leave(4)
+    assert m.join(4) and 4 in m.live_ids()
+
+
+def test_gossiped_peer_is_merged_dialed_and_relayed():
+    clock = Clock()
+    m = _membership(clock, self_id=9)
+    node = _node(m)
+    # the higher id dials, so 9 dials the newcomer 4
+    dialed = []
+    node.dial = lambda host, port: dialed.append((host, port))
+    source, other = _connect(node, 2), _connect(node, 3)
+    entries = [(True, 4, 'h4', 6004), (True, 2, 'h2', 6002)]
+    node.handle_peer_exchange(node.neighbor_logic(2), entries)
+    assert 4 in m.live_ids() and m.address(4) == ('h4', 6004)
+    assert dialed == [('h4', 6004)]
+    # only the news goes on, and not back to where it came from
+    assert other.exchanged[-1] == [(True, 4, 'h4', 6004)]
+    assert all((True, 4, 'h4', 6004) not in sent for sent in source.exchanged)
+
+
+def test_completion_once_a_dead_peer_is_dropped():
+    clock = Clock()
+    m = _membership(clock)
+    node = _node(m)
+    _connect(node, 2)
+    node.mark_peer_complete(2)
+
+    async def run() -> bool:
+        loop = asyncio.create_task(node.run_membership_loop(interval=0.01))
+        try:
+            await asyncio.sleep(0.05)
+            waiting = not node._all_done.is_set()
+            clock.now = 11.0  # peer 3 was never connected and is now past the timeout
+            await asyncio.wait_for(node.wait_until_all_complete(), 1.0)
+            return waiting
+        finally:
+            loop.cancel()
+
+    assert asyncio.run(run())
+    assert m.live_ids() == {1, 2}
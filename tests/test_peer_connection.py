@@ -0,0 +1,134 @@
+import asyncio
+import os
+
+from net.compression import codec_flags
+from net.constants import EXT_KEEPALIVE
+from net.peer_connection import PeerConnection
+from util import memory
+from util.metrics import COMPRESSION_BYTES, PEER_BYTES_SENT, PEER_WRITE_BUFFER
+
+IDLE_TIMEOUT = 0.3
+
+
+class Quiet:
+    def __getattr__(self, name):
+        return lambda *args: None
+
+
+async def _pair(server_ext: int = EXT_KEEPALIVE, client_ext: int = EXT_KEEPALIVE) -> list[PeerConnection]:
+    """The accepted connection first, then the one that dialed."""
+    conns = []
+
+    async def accept(reader, writer):
+        conn = PeerConnection(reader, writer, Quiet(), 2, idle_timeout=IDLE_TIMEOUT, extensions=server_ext)
+        conns.append(conn)
+        await conn.start()
+
+    server = await asyncio.start_server(accept, '127.0.0.1', 0)
+    reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+    conn = PeerConnection(reader, writer, Quiet(), 1, idle_timeout=IDLE_TIMEOUT, extensions=client_ext)
+    conns.append(conn)
+    await conn.start()
+    await asyncio.sleep(0.1)
+    server.close()
+    return conns
+
+
+def test_paused_reads_do_not_trip_idle_timeout():
+    async def run() -> list[bool]:
+        conns = await _pair()
+        budget = memory.set_budget(1000)
+        budget.update('test', 'hog', 950)
+        conns[-1].send_have(0)  # wakes the reader so it pauses at the next frame boundary
+        await asyncio.sleep(5 * IDLE_TIMEOUT)
+        budget.update('test', 'hog', 0)
+        await asyncio.sleep(2 * IDLE_TIMEOUT)
+        closed = [conn._closed for conn in conns]
+        for conn in conns:
+            conn.close()
+        return closed
+
+    try:
+        assert asyncio.run(run()) == [False, False]
+    finally:
+        memory.clear_budget()
+
+
+def _compressed_bytes() -> tuple[float, float]:
+    return COMPRESSION_BYTES.labels('raw').value, COMPRESSION_BYTES.labels('compressed').value
+
+
+def test_compression_needs_a_codec_both_sides_offer():
+    async def run() -> list:
+        seen = []
+        for server_ext, client_ext in ((codec_flags(['zlib']), codec_flags(['zlib'])),
+                                       (codec_flags(['zlib']), 0),
+                                       (0, codec_flags(['zlib']))):
+            conns = await _pair(server_ext, client_ext)
+            seen.append([conn._compressor.codec.name if conn._compressor else None for conn in conns])
+            for conn in conns:
+                conn.close()
+        return seen
+
+    assert asyncio.run(run()) == [['zlib', 'zlib'], [None, None], [None, None]]
+
+
+def test_compressed_bytes_counted_once_written():
+    async def run() -> tuple:
+        server, client = await _pair(codec_flags(['zlib']), codec_flags(['zlib']))
+        before = _compressed_bytes()
+        client.send_piece(0, bytes(16384))
+        await asyncio.gather(*client._pending)
+        sent = _compressed_bytes()
+        # closed while the executor compresses: cancelled, so not counted
+        client.send_piece(1, bytes(16384))
+        client.close()
+        await asyncio.sleep(0.05)
+        after_close = _compressed_bytes()
+        server.close()
+        return before, sent, after_close
+
+    before, sent, after_close = asyncio.run(run())
+    assert sent[0] - before[0] == 16384 and 0 < sent[1] - before[1] < 16384
+    assert after_close == sent
+
+
+def test_incompressible_piece_sent_raw_and_not_counted():
+    async def run() -> tuple:
+        server, client = await _pair(codec_flags(['zlib']), codec_flags(['zlib']))
+        before = _compressed_bytes()
+        client.send_piece(0, os.urandom(16384))
+        await asyncio.gather(*client._pending)
+        after = _compressed_bytes()
+        skipping = not client._compressor.should_try(16384)
+        for conn in (server, client):
+            conn.close()
+        return before, after, skipping
+
+    before, after, skipping = asyncio.run(run())
+    assert after == before
+    assert skipping  # the miss makes the next piece skip compression
+
+
+def _series(metric) -> set[str]:
+    return {values[0] for values, _ in metric._series()}
+
+
+def test_reconnect_keeps_the_newer_connections_series():
+    async def run() -> list:
+        old = await _pair()
+        old[-1].send_have(0)
+        new = await _pair()
+        seen = [_series(PEER_WRITE_BUFFER) >= {'1', '2'}]
+        for conn in old:
+            conn.close()
+        # both ends of the newer pair share the ids, so their series outlive the older pair
+        seen.append(_series(PEER_WRITE_BUFFER) >= {'1', '2'})
+        seen.append(PEER_WRITE_BUFFER.labels(1)._fn == new[0]._w.transport.get_write_buffer_size)
+        for conn in new:
+            conn.close()
+        seen.append(_series(PEER_WRITE_BUFFER) & {'1', '2'})
+        seen.append(_series(PEER_BYTES_SENT) & {'1', '2'})
+        return seen
+
+    assert asyncio.run(run()) == [True, True, True, set(), set()]
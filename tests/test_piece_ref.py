@@ -0,0 +1,84 @@
+from logic.callbacks import LogicCallbacks
+from logic.peer_node import PeerNode
+from logic.piece_store import PieceStore
+from net.sim import SimHost, SimWire, VirtualClock, connect_pair
+from util.manifest import Manifest, piece_hash
+
+PIECE_SIZE = 16
+CONTENT = [bytes([i]) * PIECE_SIZE for i in range(4)]
+
+
+class Quiet(LogicCallbacks):
+    def __getattr__(self, name):
+        return lambda *args: None
+
+
+def _node(tmp_path) -> tuple[PeerNode, object]:
+    manifest = Manifest('f', len(CONTENT) * PIECE_SIZE, PIECE_SIZE, [piece_hash(c) for c in CONTENT])
+    store = PieceStore(len(CONTENT), PIECE_SIZE, PIECE_SIZE, str(tmp_path / 'ours'))
+    node = PeerNode(len(CONTENT), PIECE_SIZE, PIECE_SIZE, '', False, 1, 5, 15, 1, {1, 2}, 'f',
+                    store=store, manifest=manifest)
+    clock = VirtualClock()
+    logic = node.make_callbacks()
+    logic.set_wire(SimWire(clock, SimHost(clock, 1e6), Quiet(), 0.01))
+    logic.on_handshake(2)
+    return node, logic
+
+
+def _offer(tmp_path, index: int, data: bytes) -> str:
+    theirs = tmp_path / 'theirs'
+    theirs.mkdir(exist_ok=True)
+    path = theirs / f'piece_{index:06d}.bin'
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_piece_ref_matching_manifest_is_linked(tmp_path):
+    node, logic = _node(tmp_path)
+    node.requests.mark_inflight(2, 1)
+    node.handle_piece_ref(logic, 1, _offer(tmp_path, 1, CONTENT[1]))
+    assert node.store.have(1) and node.local_bits.get(1)
+    assert node.store.read_piece(1) == CONTENT[1]
+
+
+def test_piece_ref_with_bad_hash_is_dropped(tmp_path):
+    node, logic = _node(tmp_path)
+    node.requests.mark_inflight(2, 1)
+    node.handle_piece_ref(logic, 1, _offer(tmp_path, 1, b'\xee' * PIECE_SIZE))
+    assert not node.store.have(1) and not node.local_bits.get(1)
+    assert not (tmp_path / 'ours' / 'piece_000001.bin').exists()
+    assert 1 not in node.requests.inflight_peer_by_piece
+
+
+def test_piece_ref_with_wrong_size_is_dropped(tmp_path):
+    node, logic = _node(tmp_path)
+    node.requests.mark_inflight(2, 1)
+    node.handle_piece_ref(logic, 1, _offer(tmp_path, 1, CONTENT[1] + b'x'))
+    assert not node.store.have(1)
+    assert 1 not in node.requests.inflight_peer_by_piece
+
+
+def test_simulated_wires_carry_piece_refs(tmp_path):
+    manifest = Manifest('f', len(CONTENT) * PIECE_SIZE, PIECE_SIZE, [piece_hash(c) for c in CONTENT])
+    seed_store = PieceStore(len(CONTENT), PIECE_SIZE, PIECE_SIZE, str(tmp_path / 'seed'))
+    for i, data in enumerate(CONTENT):
+        seed_store.write_piece(i, data)
+    leech_store = PieceStore(len(CONTENT), PIECE_SIZE, PIECE_SIZE, str(tmp_path / 'leech'))
+    nodes = []
+    for peer_id, store in ((1, seed_store), (2, leech_store)):
+        nodes.append(PeerNode(len(CONTENT), PIECE_SIZE, PIECE_SIZE, '', peer_id == 1, 1, 5, 15, peer_id, {1, 2}, 'f',
+                              store=store, manifest=manifest))
+    seed, leech = nodes
+    linked = []
+    handle = leech.handle_piece_ref
+    leech.handle_piece_ref = lambda logic, index, path: (linked.append(index), handle(logic, index, path))
+    clock = VirtualClock()
+    wires = connect_pair(clock, SimHost(clock, 1e6), leech.make_callbacks(), 2,
+                         SimHost(clock, 1e6), seed.make_callbacks(), 1, 0.01)
+    for wire in wires:
+        wire.local_pieces = True
+    clock.run(until=0.1)
+    seed.apply_preferred([2])
+    clock.run(until=5.0)
+    assert [leech.store.read_piece(i) for i in range(len(CONTENT))] == CONTENT
+    assert sorted(linked) == list(range(len(CONTENT)))
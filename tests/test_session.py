@@ -0,0 +1,52 @@
+from logic.callbacks import LogicCallbacks
+from logic.peer_node import PeerNode
+from logic.piece_store import MemoryPieceStore
+from logic.session import Session
+from net.sim import SimHost, SimWire, VirtualClock
+
+PIECES = 16
+PIECE_SIZE = 1024
+
+
+class Quiet(LogicCallbacks):
+    def __getattr__(self, name):
+        return lambda *args: None
+
+
+class Backlog(SimWire):
+    write_buffer_size = 3000
+
+
+def _node(**kwargs) -> PeerNode:
+    store = MemoryPieceStore(PIECES, PIECE_SIZE, PIECE_SIZE, start_full=True)
+    return PeerNode(PIECES, PIECE_SIZE, PIECE_SIZE, '', True, 1, 5, 15, 1, {1, 2}, 'f', store=store, **kwargs)
+
+
+def _connect(node: PeerNode, clock: VirtualClock, wire_type=SimWire) -> None:
+    logic = node.make_callbacks()
+    logic.set_wire(wire_type(clock, SimHost(clock, 1e6), Quiet(), 0.01))
+    logic.on_handshake(2)
+
+
+def test_preferred_round_runs_each_files_upkeep():
+    ticks = []
+    session = Session(slots=1, preferred_interval=5, optimistic_interval=15)
+    for cid in (b'a' * 8, b'b' * 8):
+        node = _node(super_seed=True)
+        node.super_seed.tick = lambda cid=cid: ticks.append(cid)
+        session.add(cid, node)
+    session.run_preferred_round()
+    assert sorted(ticks) == [b'a' * 8, b'b' * 8]
+
+
+def test_files_share_one_upload_buffer():
+    clock = VirtualClock()
+    session = Session(slots=1, preferred_interval=5, optimistic_interval=15)
+    busy, idle = _node(upload_buffer=4000), _node(upload_buffer=4000)
+    session.add(b'a' * 8, busy)
+    session.add(b'b' * 8, idle)
+    _connect(busy, clock, Backlog)
+    _connect(idle, clock)
+    # the other file's unsent bytes count against this file's buffer too
+    assert idle.uploads.buffered() == busy.uploads.buffered() == session.upload_backlog()
+    assert idle.uploads.buffered() - idle.uploads._buffered() >= 3000
@@ -0,0 +1,96 @@
+from logic.peer_node import PeerNode
+from logic.piece_store import MemoryPieceStore
+
+PIECE_SIZE = 1024
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class Wire:
+    """Records the HAVEs, bitfields and pieces a neighbor is sent."""
+    compact_bitfield = allowed_fast = local_pieces = peer_exchange = False
+
+    def __init__(self):
+        self.haves: list[int] = []
+        self.bitfields = 0
+        self.pieces: list[int] = []
+
+    def send_have(self, index: int) -> None:
+        self.haves.append(index)
+
+    def send_bitfield(self, bits: bytes) -> None:
+        self.bitfields += 1
+
+    def send_piece(self, index: int, data: bytes) -> None:
+        self.pieces.append(index)
+
+    def __getattr__(self, name):
+        return lambda *args: None
+
+
+def _seed(pieces: int, clock: Clock, neighbors=(2, 3, 4)) -> tuple[PeerNode, dict]:
+    store = MemoryPieceStore(pieces, PIECE_SIZE, PIECE_SIZE, start_full=True)
+    node = PeerNode(pieces, PIECE_SIZE, PIECE_SIZE, '', True, 3, 5, 15, 1, {1, *neighbors}, 'f',
+                    store=store, super_seed=True)
+    node.super_seed.clock = clock
+    wires = {}
+    for peer_id in neighbors:
+        wires[peer_id] = Wire()
+        logic = node.make_callbacks()
+        logic.set_wire(wires[peer_id])
+        logic.on_handshake(peer_id)
+    return node, wires
+
+
+def test_each_neighbor_is_offered_one_distinct_piece():
+    node, wires = _seed(16, Clock())
+    offered = [w.haves for w in wires.values()]
+    assert all(len(h) == 1 for h in offered)
+    assert len({h[0] for h in offered}) == len(offered)
+    assert not any(w.bitfields for w in wires.values())
+
+
+def test_only_the_offered_piece_is_served():
+    node, wires = _seed(16, Clock())
+    mine, theirs = wires[2].haves[0], wires[3].haves[0]
+    node.apply_preferred([2])
+    node.neighbor_logic(2).on_request(theirs)
+    node.neighbor_logic(2).on_request(mine)
+    assert wires[2].pieces == [mine]
+
+
+def test_next_piece_once_another_neighbor_has_the_offered_one():
+    node, wires = _seed(16, Clock())
+    offered = wires[2].haves[0]
+    node.neighbor_logic(2).on_have(offered)
+    assert wires[2].haves == [offered]  # others still lack it, so 2 should pass it on first
+    node.neighbor_logic(3).on_have(offered)
+    assert len(wires[2].haves) == 2 and wires[2].haves[1] != offered
+    assert node.super_seed.may_serve(2, wires[2].haves[1])
+
+
+def test_reoffer_after_holding_a_piece_too_long():
+    clock = Clock()
+    node, wires = _seed(16, clock)
+    offered = wires[4].haves[0]
+    node.neighbor_logic(4).on_have(offered)
+    clock.now = node.super_seed.reoffer_after - 1
+    node.super_seed.tick()
+    assert wires[4].haves == [offered]
+    clock.now = node.super_seed.reoffer_after
+    node.super_seed.tick()
+    assert len(wires[4].haves) == 2
+
+
+def test_bitfield_once_every_piece_has_a_copy():
+    node, wires = _seed(3, Clock())
+    for peer_id, wire in wires.items():
+        node.neighbor_logic(peer_id).on_have(wire.haves[0])
+    assert node.super_seed is None
+    assert all(w.bitfields == 1 for w in wires.values())
@@ -0,0 +1,78 @@
+from logic.callbacks import LogicCallbacks
+from logic.peer_node import PeerNode
+from logic.piece_store import MemoryPieceStore
+from net.sim import SimHost, SimWire, VirtualClock
+
+PIECES = 8
+PIECE_SIZE = 16384
+LATENCY = 0.01
+
+
+class Requester(LogicCallbacks):
+    """The far end of the uploader's wire: records what arrives and, like PeerLogic, re-requests on unchoke."""
+
+    def __init__(self, clock: VirtualClock):
+        self.clock = clock
+        self.wants: list[int] = []
+        self.uploader = None
+        self.events: list[str] = []
+        self.got: set[int] = set()
+
+    def request(self) -> None:
+        for i in self.wants:
+            if i not in self.got:
+                self.clock.call_later(LATENCY, self.uploader.on_request, i)
+
+    def on_choke(self) -> None:
+        self.events.append('choke')
+
+    def on_unchoke(self) -> None:
+        self.events.append('unchoke')
+        self.request()
+
+    def on_piece(self, index: int, data: bytes) -> None:
+        self.got.add(index)
+
+    def __getattr__(self, name):
+        return lambda *args: None
+
+
+def _unchoked_uploader(clock: VirtualClock, requester: Requester) -> PeerNode:
+    store = MemoryPieceStore(PIECES, PIECE_SIZE, PIECE_SIZE, start_full=True)
+    node = PeerNode(PIECES, PIECE_SIZE, PIECE_SIZE, '', True, 1, 5, 15, 1, {1, 2}, 'f', store=store,
+                    upload_buffer=PIECE_SIZE, upload_queue=2 * PIECE_SIZE)
+    node.uploads.call_later = clock.call_later
+    logic = node.make_callbacks()
+    logic.set_wire(SimWire(clock, SimHost(clock, 1e6), requester, LATENCY))
+    logic.on_handshake(2)
+    requester.uploader = logic
+    node.apply_preferred([2])
+    clock.run(until=1.0)
+    requester.events.clear()
+    return node
+
+
+def test_over_limit_request_chokes_until_queue_drains():
+    clock = VirtualClock()
+    requester = Requester(clock)
+    node = _unchoked_uploader(clock, requester)
+    requester.wants = list(range(5))
+    requester.request()
+    clock.run(until=10.0)
+    # each time, the third request overflows the queue and later ones are refused without another CHOKE;
+    # after the first unchoke three pieces are still missing, so it takes two rounds
+    assert requester.events == ['choke', 'unchoke', 'choke', 'unchoke']
+    assert requester.got == set(range(5))
+    assert node.uploads.queued_bytes() == 0
+
+
+def test_no_unchoke_after_choking_round_chokes_throttled_peer():
+    clock = VirtualClock()
+    requester = Requester(clock)
+    node = _unchoked_uploader(clock, requester)
+    requester.wants = list(range(5))
+    requester.request()
+    clock.call_later(LATENCY + 0.001, node.apply_preferred, [])
+    clock.run(until=10.0)
+    assert requester.events == ['choke', 'choke']
+    assert node.we_choke_them(2)
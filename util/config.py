@@ -1,6 +1,8 @@
+import hashlib
 from dataclasses import dataclass
 from pathlib import Path
 from math import ceil
+from typing import Optional
 
 
 @dataclass
@@ -21,6 +23,12 @@ class CommonConfig:
         rem = self.file_size % self.piece_size
         return rem if rem != 0 else self.piece_size
 
+    @property
+    def content_id(self) -> bytes:
+        """8-byte id carried in the handshake so one listener can serve several files."""
+        key = f'{self.file_name}:{self.file_size}:{self.piece_size}'.encode('utf-8')
+        return hashlib.sha1(key).digest()[:8]
+
     @classmethod
     def from_file(cls, path: str | Path) -> 'CommonConfig':
         path = Path(path)
@@ -58,6 +66,8 @@ class PeerRow:
     host: str
     port: int
     has_file: int
+    # optional fifth column: a rack/zone name; peers sharing it are preferred when --prefer-nearby is on
+    locality: Optional[str] = None
 
 
 class PeerInfoTable:
@@ -77,10 +87,10 @@ class PeerInfoTable:
             if not line or line.startswith('#'):
                 continue
             parts = line.split()
-            if len(parts) != 4:
+            if len(parts) not in (4, 5):
                 raise ValueError(f'Malformed PeerInfo.cfg line: {raw}')
-            pid, host, port, has_file = parts
-            rows.append(PeerRow(int(pid), host, int(port), int(has_file)))
+            pid, host, port, has_file = parts[:4]
+            rows.append(PeerRow(int(pid), host, int(port), int(has_file), parts[4] if len(parts) == 5 else None))
         if not rows:
             raise ValueError('PeerInfo.cfg has no peers')
         return cls(rows)
@@ -89,5 +99,7 @@ class PeerInfoTable:
         return self.by_id[peer_id]
 
     def earlier_peers(self, peer_id: int) -> list[PeerRow]:
+        if peer_id not in self.by_id:
+            return list(self.rows)  # a peer joining at runtime dials everyone it knows
         idx = self.ordered_ids.index(peer_id)
         return [self.by_id[i] for i in self.ordered_ids[:idx]]
@@ -0,0 +1,29 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+LOOP_CHOICES = ('auto', 'asyncio', 'uvloop')
+
+
+def install_event_loop(kind: str = 'auto') -> str:
+    """
+    Install the event loop policy used by subsequent asyncio.run() calls and return
+    the name of the loop that was selected. 'auto' picks uvloop when it is installed.
+    """
+    if kind not in LOOP_CHOICES:
+        raise ValueError(f'Unknown event loop {kind!r}, expected one of {LOOP_CHOICES}')
+
+    if kind in ('auto', 'uvloop'):
+        try:
+            import uvloop
+        except ImportError:
+            if kind == 'uvloop':
+                raise
+            logger.debug('uvloop not installed, using the default asyncio loop')
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return 'uvloop'
+
+    asyncio.set_event_loop_policy(asyncio.DefaultEventLoopPolicy())
+    return 'asyncio'
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Per-piece SHA-256 hashes of one version of the shared file.
+
+    python -m util.manifest peer_1001/thefile.dat 16384 > thefile.manifest
+"""
+import argparse
+import hashlib
+import json
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+
+
+def piece_hash(data: bytes) -> bytes:
+    return hashlib.sha256(data).digest()
+
+
+def iter_pieces(path: str | Path, piece_size: int) -> Iterator[bytes]:
+    with open(path, 'rb') as f:
+        while chunk := f.read(piece_size):
+            yield chunk
+
+
+@dataclass
+class Manifest:
+    file_name: str
+    file_size: int
+    piece_size: int
+    hashes: list[bytes]
+
+    @classmethod
+    def build(cls, path: str | Path, piece_size: int) -> 'Manifest':
+        path = Path(path)
+        hashes = [piece_hash(chunk) for chunk in iter_pieces(path, piece_size)]
+        return cls(path.name, path.stat().st_size, piece_size, hashes)
+
+    @classmethod
+    def load(cls, path: str | Path) -> 'Manifest':
+        raw = json.loads(Path(path).read_text(encoding='utf-8'))
+        try:
+            return cls(raw['file_name'], int(raw['file_size']), int(raw['piece_size']),
+                       [bytes.fromhex(h) for h in raw['pieces']])
+        except (KeyError, ValueError) as e:
+            raise ValueError(f'Malformed manifest {path}: {e}') from e
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'file_name': self.file_name,
+            'file_size': self.file_size,
+            'piece_size': self.piece_size,
+            'hash': 'sha256',
+            'pieces': [h.hex() for h in self.hashes],
+        }, indent=1)
+
+    def save(self, path: str | Path) -> None:
+        Path(path).write_text(self.to_json(), encoding='utf-8')
+
+    def check(self, common) -> None:
+        """Raises ValueError when the manifest does not describe the file in Common.cfg."""
+        if (self.file_size, self.piece_size) != (common.file_size, common.piece_size):
+            raise ValueError(f'manifest is for {self.file_size}B in {self.piece_size}B pieces, '
+                             f'Common.cfg says {common.file_size}B in {common.piece_size}B pieces')
+        if len(self.hashes) != common.total_pieces:
+            raise ValueError(f'manifest lists {len(self.hashes)} pieces, expected {common.total_pieces}')
+
+    def matches(self, index: int, data: bytes) -> bool:
+        return 0 <= index < len(self.hashes) and piece_hash(data) == self.hashes[index]
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='Write the piece manifest of a file to stdout')
+    ap.add_argument('file')
+    ap.add_argument('piece_size', type=int)
+    args = ap.parse_args()
+    sys.stdout.write(Manifest.build(args.file, args.piece_size).to_json() + '\n')
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Hashable, Optional
+
+from util.metrics import MEMORY_BYTES, MEMORY_LIMIT
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBudget:
+    """
+    One byte budget for the whole process. Owners (a connection, a queue)
+    report how many bytes they currently hold under a category such as
+    'recv_buffer' or 'send_buffer'; values that change without us seeing it,
+    like a transport draining its write buffer, are registered with `watch`
+    and sampled by `refresh`. Above `high_water` of the limit the budget is
+    tight until usage falls back under `low_water`: connections stop reading
+    at the next frame boundary and the upload scheduler stops serving.
+    """
+
+    def __init__(self, limit: int, high_water: float = 0.9, low_water: float = 0.75):
+        if limit <= 0:
+            raise ValueError(f'memory limit must be positive, got {limit}')
+        self.limit = limit
+        self.high = int(limit * high_water)
+        self.low = int(limit * low_water)
+        self.used = 0
+        self.tight = False
+        self.times_tight = 0
+        self._warned_at = float('-inf')
+        self._by_category: dict[str, int] = {}
+        self._held: dict[tuple[str, Hashable], int] = {}
+        self._probes: dict[tuple[str, Hashable], Callable[[], int]] = {}
+        self._roomy = asyncio.Event()
+        self._roomy.set()
+        MEMORY_LIMIT.set(limit)
+
+    def update(self, category: str, owner: Hashable, n_bytes: int) -> None:
+        """Records that `owner` now holds `n_bytes` under `category`."""
+        key = (category, owner)
+        old = self._held.get(key, 0)
+        if n_bytes == old:
+            return
+        if n_bytes:
+            self._held[key] = n_bytes
+        else:
+            del self._held[key]
+        self._add(category, n_bytes - old)
+
+    def watch(self, category: str, owner: Hashable, probe: Callable[[], int]) -> None:
+        self._probes[(category, owner)] = probe
+
+    def drop(self, owner: Hashable) -> None:
+        """Forgets everything `owner` held, e.g. when its connection closes."""
+        for key in [k for k in self._held if k[1] == owner]:
+            self.update(key[0], owner, 0)
+        for key in [k for k in self._probes if k[1] == owner]:
+            del self._probes[key]
+
+    def refresh(self) -> None:
+        for (category, owner), probe in list(self._probes.items()):
+            self.update(category, owner, probe())
+
+    def usage(self) -> dict[str, int]:
+        return {c: n for c, n in self._by_category.items() if n}
+
+    def summary(self) -> str:
+        parts = ', '.join(f'{c} {n}B' for c, n in sorted(self.usage().items()))
+        return f'{self.used}/{self.limit} bytes ({parts or "nothing held"}), tight {self.times_tight} times'
+
+    async def wait(self) -> None:
+        """Returns once the budget is no longer tight."""
+        await self._roomy.wait()
+
+    async def run(self, interval: float = 0.1, report_interval: float = 30.0) -> None:
+        """Samples watched owners every `interval` and logs usage every `report_interval` seconds."""
+        since_report = 0.0
+        while True:
+            await asyncio.sleep(interval)
+            self.refresh()
+            since_report += interval
+            if since_report >= report_interval:
+                since_report = 0.0
+                logger.info(f'memory: {self.summary()}')
+
+    def _add(self, category: str, delta: int) -> None:
+        if category not in self._by_category:
+            self._by_category[category] = 0
+            MEMORY_BYTES.labels(category).set_function(lambda c=category: self._by_category[c])
+        self._by_category[category] += delta
+        self.used += delta
+        if self.tight:
+            if self.used <= self.low:
+                self.tight = False
+                self._roomy.set()
+        elif self.used >= self.high:
+            self.tight = True
+            self.times_tight += 1
+            self._roomy.clear()
+            now = time.monotonic()
+            if now - self._warned_at >= 30.0:
+                self._warned_at = now
+                logger.warning(f'memory budget is tight, pausing reads and uploads: {self.summary()}')
+
+
+# Set by set_budget(); buffers are accounted only when this is not None
+BUDGET: Optional[MemoryBudget] = None
+
+
+def set_budget(limit: int) -> MemoryBudget:
+    global BUDGET
+    BUDGET = MemoryBudget(limit)
+    return BUDGET
+
+
+def clear_budget() -> None:
+    global BUDGET
+    BUDGET = None
@@ -0,0 +1,316 @@
+import asyncio
+import bisect
+import json
+import logging
+import math
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _fmt_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = '') -> str:
+    parts = [f'{k}="{v}"' for k, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _fmt_value(v: float) -> str:
+    if v == math.inf:
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._children: dict[tuple[str, ...], '_Metric'] = {}
+
+    def labels(self, *values) -> '_Metric':
+        key = tuple(str(v) for v in values)
+        if len(key) != len(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {key}')
+        child = self._children.get(key)
+        if child is None:
+            child = self._new_child()
+            self._children[key] = child
+        return child
+
+    def remove(self, *values) -> None:
+        self._children.pop(tuple(str(v) for v in values), None)
+
+    def _new_child(self) -> '_Metric':
+        raise NotImplementedError
+
+    def _series(self) -> list[tuple[tuple[str, ...], '_Metric']]:
+        if self.labelnames:
+            return list(self._children.items())
+        return [((), self)]
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for values, m in self._series():
+            lines.extend(m._render_samples(self.name, self.labelnames, values))
+        return lines
+
+    def snapshot(self) -> object:
+        if not self.labelnames:
+            return self._value_snapshot()
+        return {','.join(values): m._value_snapshot() for values, m in self._children.items()}
+
+    def _render_samples(self, name: str, labelnames: tuple[str, ...], values: tuple[str, ...]) -> list[str]:
+        return [f'{name}{_fmt_labels(labelnames, values)} {_fmt_value(self._value_snapshot())}']
+
+    def _value_snapshot(self) -> object:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self.value = 0
+
+    def _new_child(self) -> 'Counter':
+        return Counter(self.name, self.help)
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def _value_snapshot(self) -> float:
+        return self.value
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self.value = 0
+        self._fn: Optional[Callable[[], float]] = None
+
+    def _new_child(self) -> 'Gauge':
+        return Gauge(self.name, self.help)
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set_function(self, fn: Callable[[], float]) -> None:
+        # sampled at scrape time, for values that already live elsewhere (queue lengths, buffer sizes)
+        self._fn = fn
+
+    def _value_snapshot(self) -> float:
+        if self._fn is not None:
+            try:
+                return self._fn()
+            except (AttributeError, RuntimeError, TypeError, ValueError):
+                return math.nan
+        return self.value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def _new_child(self) -> 'Histogram':
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> '_Timer':
+        return _Timer(self)
+
+    def _render_samples(self, name: str, labelnames: tuple[str, ...], values: tuple[str, ...]) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, c in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += c
+            le = f'le="{_fmt_value(bound)}"'
+            lines.append(f'{name}_bucket{_fmt_labels(labelnames, values, le)} {cumulative}')
+        lines.append(f'{name}_sum{_fmt_labels(labelnames, values)} {_fmt_value(self.sum)}')
+        lines.append(f'{name}_count{_fmt_labels(labelnames, values)} {self.count}')
+        return lines
+
+    def _value_snapshot(self) -> dict:
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': dict(zip([_fmt_value(b) for b in self.buckets + (math.inf,)], self.counts))}
+
+
+class _Timer:
+    __slots__ = ('_h', '_t0')
+
+    def __init__(self, h: Histogram):
+        self._h = h
+        self._t0 = 0.0
+
+    def __enter__(self) -> '_Timer':
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._h.observe(time.perf_counter() - self._t0)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def _get(self, cls, name: str, help_text: str, labelnames: Iterable[str], **kw) -> _Metric:
+        m = self._metrics.get(name)
+        if m is None:
+            m = cls(name, help_text, labelnames, **kw)
+            self._metrics[name] = m
+        elif not isinstance(m, cls):
+            raise ValueError(f'metric {name} already registered as {m.kind}')
+        return m
+
+    def counter(self, name: str, help_text: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._get(Counter, name, help_text, labelnames)
+
+    def gauge(self, name: str, help_text: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self._get(Gauge, name, help_text, labelnames)
+
+    def histogram(self, name: str, help_text: str, labelnames: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for m in self._metrics.values():
+            lines.extend(m.render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict[str, object]:
+        return {name: m.snapshot() for name, m in self._metrics.items()}
+
+
+REGISTRY = MetricsRegistry()
+
+# ---- process-wide metrics shared by the net/ and logic/ packages ----
+
+FRAMES_ENCODED = REGISTRY.counter('p2p_frames_encoded_total', 'Frames encoded, by message type', ('type',))
+FRAMES_DECODED = REGISTRY.counter('p2p_frames_decoded_total', 'Frames decoded, by message type', ('type',))
+PEER_BYTES_SENT = REGISTRY.counter('p2p_peer_bytes_sent_total', 'Bytes written to a peer', ('peer',))
+PEER_BYTES_RECEIVED = REGISTRY.counter('p2p_peer_bytes_received_total', 'Bytes read from a peer', ('peer',))
+PEER_WRITE_BUFFER = REGISTRY.gauge('p2p_peer_write_buffer_bytes', 'Bytes queued in the transport', ('peer',))
+PEER_READ_BUFFER = REGISTRY.gauge('p2p_peer_read_buffer_bytes', 'Undecoded bytes buffered', ('peer',))
+CONNECTIONS = REGISTRY.gauge('p2p_connections', 'Open peer connections')
+REQUESTS_INFLIGHT = REGISTRY.gauge('p2p_requests_inflight', 'Outstanding REQUESTs')
+REQUEST_LATENCY = REGISTRY.histogram('p2p_request_latency_seconds', 'REQUEST to PIECE round-trip time')
+REQUESTS_ABANDONED = REGISTRY.counter('p2p_requests_abandoned_total', 'REQUESTs cleared by choke/disconnect')
+CHOKE_CHANGES = REGISTRY.counter('p2p_choke_changes_total', 'Choke state changes we sent', ('action',))
+PREFERRED_NEIGHBORS = REGISTRY.gauge('p2p_preferred_neighbors', 'Size of the current preferred set')
+PIECES_HAVE = REGISTRY.gauge('p2p_pieces_have', 'Pieces held locally')
+COMPRESSION_BYTES = REGISTRY.counter('p2p_compression_bytes_total',
+                                     'PIECE payload bytes before/after compression', ('stage',))
+COMPRESSION_SKIPPED = REGISTRY.counter('p2p_compression_skipped_total', 'PIECEs sent raw', ('reason',))
+STORE_OP_SECONDS = REGISTRY.histogram('p2p_store_op_seconds', 'PieceStore disk operation time', ('op',))
+STORE_BYTES = REGISTRY.counter('p2p_store_bytes_total', 'Bytes moved by PieceStore', ('op',))
+MEMORY_BYTES = REGISTRY.gauge('p2p_memory_bytes', 'Bytes held against the memory budget', ('category',))
+MEMORY_LIMIT = REGISTRY.gauge('p2p_memory_limit_bytes', 'Memory budget')
+LOOP_LAG = REGISTRY.histogram('p2p_event_loop_lag_seconds', 'Event loop scheduling delay',
+                              buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+
+
+# ---- exposure ----
+
+async def _handle_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                         registry: MetricsRegistry) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5.0)
+        while (await asyncio.wait_for(reader.readline(), timeout=5.0)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        path = parts[1] if len(parts) > 1 else '/'
+        if path.split('?')[0] in ('/', '/metrics'):
+            body = registry.render_prometheus().encode()
+            status = '200 OK'
+        else:
+            body = b'not found\n'
+            status = '404 Not Found'
+        writer.write(f'HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError, OSError) as e:
+        logger.debug(f'metrics scrape failed: {e}')
+    finally:
+        writer.close()
+
+
+async def serve_metrics(host: Optional[str] = '127.0.0.1', port: Optional[int] = None,
+                        unix_path: Optional[str] = None, registry: MetricsRegistry = REGISTRY) -> None:
+    """Serve the registry in Prometheus text format over HTTP on host:port and/or a Unix socket."""
+    servers = []
+    handler = lambda r, w: _handle_scrape(r, w, registry)
+    if port is not None:
+        servers.append(await asyncio.start_server(handler, host, port))
+        logger.info(f'serves metrics on http://{host}:{port}/metrics')
+    if unix_path is not None:
+        servers.append(await asyncio.start_unix_server(handler, unix_path))
+        logger.info(f'serves metrics on unix socket {unix_path}')
+    try:
+        await asyncio.gather(*(s.serve_forever() for s in servers))
+    finally:
+        for s in servers:
+            s.close()
+
+
+async def run_snapshot_loop(path: str | Path, interval: float, registry: MetricsRegistry = REGISTRY) -> None:
+    """Periodically rewrite `path` with a JSON snapshot, including per-second rates of counters."""
+    path = Path(path)
+    prev: dict[str, object] = {}
+    prev_t = time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        snap = registry.snapshot()
+        rates = {}
+        for name, m in registry._metrics.items():
+            if isinstance(m, Counter) and name in prev:
+                rates[name] = _rate(prev[name], snap[name], now - prev_t)
+        prev, prev_t = snap, now
+        tmp = path.with_suffix(path.suffix + '.tmp')
+        tmp.write_text(json.dumps({'time': time.time(), 'metrics': snap, 'rates_per_s': rates}, indent=1),
+                       encoding='utf-8')
+        tmp.replace(path)
+
+
+def _rate(before: object, after: object, dt: float) -> object:
+    if dt <= 0:
+        return 0.0
+    if isinstance(after, dict):
+        return {k: (v - (before.get(k, 0) if isinstance(before, dict) else 0)) / dt for k, v in after.items()}
+    return (after - before) / dt
+
+
+async def run_loop_lag_monitor(interval: float = 0.1, histogram: Histogram = LOOP_LAG) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, loop.time() - t0 - interval))
@@ -0,0 +1,146 @@
+import asyncio
+import cProfile
+import io
+import logging
+import pstats
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class HandlerStats:
+    """Wall time spent in PeerConnection._dispatch, per message type."""
+
+    def __init__(self):
+        self._stats: dict[str, list[float]] = {}  # type -> [calls, total, max]
+
+    def record(self, name: str, seconds: float) -> None:
+        s = self._stats.get(name)
+        if s is None:
+            self._stats[name] = [1, seconds, seconds]
+            return
+        s[0] += 1
+        s[1] += seconds
+        if seconds > s[2]:
+            s[2] = seconds
+
+    def report(self) -> str:
+        lines = [f'{"handler":16s} {"calls":>10s} {"total s":>10s} {"mean us":>10s} {"max ms":>10s}']
+        for name, (calls, total, worst) in sorted(self._stats.items(), key=lambda kv: -kv[1][1]):
+            lines.append(f'{name:16s} {int(calls):10d} {total:10.4f} {total / calls * 1e6:10.1f} {worst * 1e3:10.3f}')
+        return '\n'.join(lines)
+
+
+# Set by enable_handler_timing(); PeerConnection._dispatch only times handlers when this is not None
+HANDLER_STATS: Optional[HandlerStats] = None
+
+
+def enable_handler_timing() -> HandlerStats:
+    global HANDLER_STATS
+    if HANDLER_STATS is None:
+        HANDLER_STATS = HandlerStats()
+    return HANDLER_STATS
+
+
+class LoopWatchdog:
+    """
+    Detects callbacks that block the event loop. The loop bumps a heartbeat; a
+    helper thread samples the loop thread's stack whenever the heartbeat is older
+    than `threshold` seconds, so the report shows what was running at the time.
+    """
+
+    def __init__(self, threshold: float, log_path: Path):
+        self.threshold = threshold
+        self.log_path = log_path
+        self.blocked: list[tuple[float, str]] = []
+        self._beat = time.monotonic()
+        self._loop_thread = threading.get_ident()
+        self._stop = threading.Event()
+
+    async def run(self) -> None:
+        self._loop_thread = threading.get_ident()
+        thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        thread.start()
+        tick = self.threshold / 4
+        try:
+            while True:
+                self._beat = time.monotonic()
+                await asyncio.sleep(tick)
+        finally:
+            self._stop.set()
+
+    def _watch(self) -> None:
+        reported_beat = None
+        while not self._stop.wait(self.threshold / 2):
+            beat = self._beat
+            stalled = time.monotonic() - beat
+            if stalled < self.threshold or beat == reported_beat:
+                continue
+            reported_beat = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else '<no frame>\n'
+            self.blocked.append((stalled, stack))
+            logger.warning(f'event loop blocked for at least {stalled * 1e3:.0f} ms')
+            with self.log_path.open('a', encoding='utf-8') as f:
+                f.write(f'--- {time.strftime("%m/%d/%Y %H:%M:%S")} loop blocked >= {stalled * 1e3:.0f} ms\n{stack}')
+
+
+class ProfilingSession:
+    """
+    Opt-in profiling for one peer process: handler timing, a loop watchdog and a
+    cProfile capture over [delay, delay + window). Reports are written to
+    `<log_dir>/profile_peer_<id><suffix>.{prof,txt}` and `slow_callbacks_peer_<id><suffix>.log`.
+    """
+
+    def __init__(self, peer_id: int, log_dir: str | Path = '.', suffix: str = '', window: float = 30.0,
+                 delay: float = 0.0, block_threshold: float = 0.1):
+        log_dir = Path(log_dir)
+        self.prof_path = log_dir / f'profile_peer_{peer_id}{suffix}.prof'
+        self.report_path = log_dir / f'profile_peer_{peer_id}{suffix}.txt'
+        self.window = window
+        self.delay = delay
+        self.handlers = enable_handler_timing()
+        self.watchdog = LoopWatchdog(block_threshold, log_dir / f'slow_callbacks_peer_{peer_id}{suffix}.log')
+        self._profiler = cProfile.Profile()
+        self._profiled = 0.0
+
+    async def run(self) -> None:
+        watchdog = asyncio.create_task(self.watchdog.run())
+        started = None
+        try:
+            await asyncio.sleep(self.delay)
+            logger.info(f'starts profiling for {self.window}s')
+            started = time.monotonic()
+            self._profiler.enable()
+            await asyncio.sleep(self.window)
+            self._profiler.disable()
+            self._profiled = time.monotonic() - started
+            started = None
+            self.write_report()
+            await asyncio.Future()  # keep the watchdog and handler timing running until cancelled
+        finally:
+            if started is not None:
+                self._profiler.disable()
+                self._profiled = time.monotonic() - started
+            self.write_report()
+            watchdog.cancel()
+
+    def write_report(self) -> None:
+        self._profiler.dump_stats(str(self.prof_path))
+        out = io.StringIO()
+        out.write(f'cProfile window: {self._profiled:.1f}s\n\n== protocol handlers (PeerConnection._dispatch) ==\n')
+        out.write(self.handlers.report() + '\n\n')
+        out.write(f'== event loop blocked > {self.watchdog.threshold * 1e3:.0f} ms: '
+                  f'{len(self.watchdog.blocked)} times (stacks in {self.watchdog.log_path.name}) ==\n\n')
+        out.write('== top functions by cumulative time ==\n')
+        try:
+            pstats.Stats(self._profiler, stream=out).sort_stats('cumulative').print_stats(40)
+        except TypeError:
+            out.write('<no samples>\n')
+        self.report_path.write_text(out.getvalue(), encoding='utf-8')
+        logger.info(f'wrote profile report {self.report_path}')